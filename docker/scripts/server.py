@@ -23,9 +23,14 @@ if __name__ == "__main__":
     parser.add_argument('--listen_port', type=int, default=9165)
     parser.add_argument('--listen_addr', type=str, default='')
     parser.add_argument('--debug_mode', action='store_true')
+    parser.add_argument('--code_cache_dir', type=str, default='')
 
     args = parser.parse_args()
 
+    if args.code_cache_dir != '':
+        SnippetRunnerLocal.code_cache = SnippetCodeCache(cache_dir=args.code_cache_dir)
+    SnippetRunnerLocal.warm_up()
+
     if args.listen_port > 0 and args.listen_addr != '':
         fpS = SocketIO(listen_port=args.listen_port, listen_addr=args.listen_addr)
     else:
@@ -1,6 +1,8 @@
 __version__ = '1.0.1'
 __all__ = ['SnippetRunner',
            'SnippetRunnerLocal',
+           'SnippetCodeCache',
+           'SnippetTimeoutService',
            'RunningConditions',
            'SnippetLoopHook',
            'SnippetStepHook',
@@ -8,8 +10,12 @@ __all__ = ['SnippetRunner',
            'COMMON_BUILTINS',
            'COMMON_MODULES',
            'ConflictSolvePolicy',
+           'FloatDeadband',
            'StepErrorApproach',
+           'StepBackend',
+           'HookSampling',
+           'HookSignal',
            ]
 from .remoteexec import *
-from .communicate import ConflictSolvePolicy
-from .hooks import StepErrorApproach
+from .communicate import ConflictSolvePolicy, FloatDeadband
+from .hooks import StepErrorApproach, StepBackend, HookSampling, HookSignal
@@ -1,4 +1,18 @@
 __all__ = ['snippet_share',
+           'snippet_struct',
+           'snippet_oneway',
+           'snippet_pure',
+           'snippet_cacheable',
+           'snippet_serverside',
+           'batch',
+           'mark_dirty',
+           'unmark_dirty',
+           'RemoteReference',
+           'prefetch_remote',
+           'resolve_remote',
+           'SharedLog',
+           'SharedTable',
+           'FloatDeadband',
            'UnsirializeFunctionHook',
            'ConflictSolvePolicy',
            'CommunicationInterface',
@@ -6,5 +20,7 @@ __all__ = ['snippet_share',
            'CommunicationLog',
            'Communicator',
            ]
-from .serializer import snippet_share, UnsirializeFunctionHook
+from .serializer import snippet_share, snippet_struct, snippet_oneway, snippet_pure, snippet_cacheable, snippet_serverside, batch, mark_dirty, unmark_dirty, RemoteReference, prefetch_remote, resolve_remote, UnsirializeFunctionHook
+from .shared import SharedLog, SharedTable
+from .sync import FloatDeadband
 from .communicator import *
@@ -1,6 +1,6 @@
 from typing import List, Dict, Tuple, Union, Callable, Optional
 from enum import Enum
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from threading import Semaphore
 import inspect
 import copy
@@ -11,11 +11,22 @@ import base64
 import io
 import uuid
 import time
+import hashlib
 
-from .serializer import dumps, loads, SirializeFunctionCaller, UnsirializeFunctionHook
-from .sync import diff, marge, apply_unsirial, SyncInstance, SyncInstanceMember, SyncSharedObject
+from .serializer import dumps, loads, log_sequences, make_fingerprint, pointers, SirializeFunctionCaller, UnsirializeFunctionHook
+from .sync import diff, marge, rebase, deadband, update_serial, apply_unsirial, root_fingerprint, expand_tables, FloatDeadband, SyncInstance, SyncInstanceMember, SyncSharedObject
 from .exceptions import *
 
+# 戻り値を待たない呼び出しを溜める最大数(超えたら同期を待たずに送る)
+MAX_QUEUED_CALLS = 256
+
+# ホストが初期化の応答で通知する対応機能(古いホストは通知しない)
+HOST_CAPABILITIES = ('contents',)
+
+def content_hash(content:str) -> str:
+    "Communicator.clientのcontentsのキー(UTF-8のSHA-256)"
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
 class ConflictSolvePolicy(Enum):
     """ConflictSolvePolicy
     """
@@ -42,6 +53,15 @@ class CommunicationInterface:
     def stop(self):
         pass # stop thread
 
+    def compile_function(self, source:str) -> Optional[Callable]:
+        return None # compile @snippet_serverside method (None to call client side)
+
+    def has_content(self, key:str) -> bool:
+        return False # content of content_hash key is already known (not uploaded)
+
+    def init_contents(self, contents:Dict[str,str]):
+        return # uploaded contents {content_hash key: content}
+
 class CommunicationIO:
     def __init__(self):
         pass
@@ -59,18 +79,99 @@ class CommunicationLog:
     def log(self, tag, command, dump):
         pass
 
+class FunctionCallCache:
+    """FunctionCallCache
+
+    @snippet_pure/@snippet_cacheableのメソッドの戻り値(シリアライズ済み)のLRUキャッシュ
+    キーはインスタンスID、メソッド名、シリアライズした引数
+
+    Args:
+        maxsize (int): 保持する最大件数(0でキャッシュしない)
+
+    Note:
+        キャッシュした時と同期済みのフィンガープリント(インスタンスと参照渡しした引数の部分木のハッシュ)が違う場合と、
+        ttlを過ぎた場合は無効
+        hits/missesでヒット数とミス数を参照できる
+    """
+    def __init__(self, maxsize:int=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Semaphore()
+
+    def key(self, instanceid:int, name:str, serial_data:Dict[str,object]) -> Tuple[int,str,str]:
+        "引数のインスタンスIDを出現順の番号に置き換えて、呼び出し毎に変わらないキーにする(参照渡しのインスタンスはIDのまま)"
+        instance = serial_data.get('instance', {})
+        numbers, values = {}, []
+        def _canonical(value):
+            if type(value) is dict:
+                if value.get('type') == 'pointer':
+                    return {'type':'pointer', 'value':_number(value['value'])}
+                return {k:_canonical(v) for k,v in value.items()}
+            elif type(value) is list:
+                return [_canonical(v) for v in value]
+            return value
+        def _number(instanceid):
+            if instance.get(instanceid, {}).get('__type__') == 'remote':
+                return f'remote:{instanceid}'
+            if instanceid not in numbers:
+                numbers[instanceid] = len(values)
+                values.append(None)
+                values[numbers[instanceid]] = _canonical(instance.get(instanceid))
+            return numbers[instanceid]
+        _number(serial_data['object'])
+        return (int(instanceid), name, json.dumps(values, sort_keys=True))
+
+    def get(self, key:Tuple[int,str,str], fingerprint:tuple) -> Tuple[bool,object]:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[1] == fingerprint and (entry[2] is None or entry[2] > time.time()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key:Tuple[int,str,str], value:object, fingerprint:tuple, ttl:Optional[float]=None):
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._entries[key] = (value, fingerprint, None if ttl is None else time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, instanceid:int):
+        "インスタンスのメソッドのキャッシュを全て無効にする"
+        with self._lock:
+            for key in [key for key in self._entries.keys() if key[0] == instanceid]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
 class Communicator:
-    def __init__(self, connection:CommunicationIO, sync_frequency:float, use_compress:bool=True, log_hook:Optional[CommunicationLog]=None):
+    def __init__(self, connection:CommunicationIO, sync_frequency:float, use_compress:bool=True, log_hook:Optional[CommunicationLog]=None, call_cache_size:int=1024):
         assert sync_frequency > 0, 'sync_frequency must > 0'
         self.connection = connection
         self.sync_frequency = sync_frequency
         self.use_compress = use_compress
         self.log_hook = log_hook
+        self.call_cache = FunctionCallCache(maxsize=call_cache_size)
         self.abort = False
     
     def _preload(self, serial_obj:dict) -> dict:
         if 'instance' in serial_obj:
             serial_obj['instance'] = {int(k):v for k,v in serial_obj['instance'].items()}
+        if 'fingerprint' in serial_obj:
+            serial_obj['fingerprint'] = {int(k):v for k,v in serial_obj['fingerprint'].items()}
         return serial_obj        
 
     def _send(self, send_object) -> int:
@@ -124,20 +225,86 @@ class Communicator:
         tick_time = min(unit_time/100, 0.001)
 
         send_recv_pair = Semaphore()
+        queued_calls_lock = Semaphore()
         responce_data = None
+        # インスタンスIDはセッション毎なので前回のキャッシュは使わない
+        self.call_cache.clear()
+
+        def _synced(call_data):
+            # 前回の同期でクライアントと共有していて、その後に変更していないインスタンスはインスタンスIDのみ送る
+            synced_instance = before_shared_object_serial.get('instance', {})
+            synced_fingerprint = before_shared_object_serial.get('fingerprint', {})
+            if len(synced_fingerprint) == 0:
+                return None
+            current_fingerprint = dumps(call_data, snippet_share_only=False, restore_id_map=idmap_shared_object, fingerprint=True)['fingerprint']
+            def _unchanged(instanceid, obj, depth):
+                return instanceid in synced_instance and instanceid in synced_fingerprint and instanceid in current_fingerprint and \
+                       current_fingerprint[instanceid][1] == synced_fingerprint[instanceid][1]
+            return _unchanged
+
+        def _known_instance():
+            _, known_caller = dumps(current_shared_object, return_caller=True, snippet_share_only=False, restore_id_map=idmap_shared_object)
+            return {instanceid:instance.obj for instanceid, instance in known_caller.out_instance.items()}
+
+        def _synced_instance():
+            # クライアントが参照するインスタンスIDは同期で変わるので、同期周期毎に_known_instanceをキャッシュする
+            nonlocal known_instance_cache
+            known_instance = known_instance_cache
+            if known_instance is None:
+                known_instance = known_instance_cache = _known_instance()
+            return known_instance
+
+        def _attach_queued_calls(send_data):
+            # send_recv_pairの中で呼び出して、溜めている呼び出しを送信順に取り出す
+            with queued_calls_lock:
+                calls = queued_calls[:]
+                queued_calls.clear()
+            if len(calls) > 0:
+                send_data['calls'] = calls
+            return send_data
+
+        def _synced_fingerprint(instanceid, serial_data):
+            # インスタンスと参照渡しした引数の同期済みの部分木のハッシュ
+            fingerprint = before_shared_object_serial.get('fingerprint', {})
+            instanceids = [instanceid] + sorted(i for i, v in serial_data.get('instance', {}).items() if v['__type__'] == 'remote')
+            return tuple(fingerprint[i][1] if i in fingerprint else None for i in instanceids)
 
         class Sender(UnsirializeFunctionHook):
+            def _dumps_call(_clz, instanceid:int, name:str, args:tuple, kwargs:dict):
+                call_data = {'instanceid':instanceid, 'name':name, 'args':args, 'kwargs':kwargs}
+                return dumps(call_data, snippet_share_only=False, restore_id_map=idmap_shared_object, remote_reference=_synced(call_data))
+
+            def _loads_return(_clz, serialized_return_data_data):
+                known_instance = None
+                if any(instancevalue.get('__type__') == 'remote' for instancevalue in serialized_return_data_data.get('instance', {}).values()):
+                    known_instance = _synced_instance()
+                return loads(serialized_return_data_data, known_instance=known_instance)[0]
+
             def function_call(_clz, instanceid:int, name:str, args:tuple, kwargs:dict):
-                serial_data = dumps({'instanceid':instanceid, 'name':name, 'args':args, 'kwargs':kwargs}, snippet_share_only=False)
+                # 呼び出しでインスタンスが変わるかもしれないのでキャッシュを無効にする
+                self.call_cache.invalidate(instanceid)
+                return _clz._loads_return(_clz._call(_clz._dumps_call(instanceid, name, args, kwargs)))
+
+            def function_cached(_clz, instanceid:int, name:str, args:tuple, kwargs:dict, ttl:Optional[float]):
+                serial_data = _clz._dumps_call(instanceid, name, args, kwargs)
+                key = self.call_cache.key(instanceid, name, serial_data)
+                fingerprint = _synced_fingerprint(instanceid, serial_data)
+                found, serialized_return_data_data = self.call_cache.get(key, fingerprint)
+                if not found:
+                    serialized_return_data_data = _clz._call(serial_data)
+                    self.call_cache.put(key, serialized_return_data_data, fingerprint, ttl)
+                return _clz._loads_return(serialized_return_data_data)
+
+            def _call(_clz, serial_data):
                 send_responce_data = {'cmd':'responce', 'data':serial_data}
                 with send_recv_pair:
-                    self._send(send_responce_data)
+                    self._send(_attach_queued_calls(send_responce_data))
                     return_data = self._recv()
                 if type(return_data) is dict and 'cmd' in return_data:
                     if return_data['cmd'] == 'return':
                         serialized_return_data_data = return_data['data']
                         self._preload(serialized_return_data_data)
-                        return loads(serialized_return_data_data)
+                        return serialized_return_data_data
                     elif return_data['cmd'] == 'exception':
                         if 'message' in return_data:
                             raise ExceptionInClientError(return_data['message'])
@@ -147,10 +314,79 @@ class Communicator:
                 else:
                     raise CommunicateError()
 
+            def function_compile(_clz, instanceid:int, name:str, source:str) -> Optional[Callable]:
+                # コンパイルできないメソッドはNoneを覚えておき、クライアント側で実行する
+                if source not in compiled_functions:
+                    try:
+                        compiled_functions[source] = reciever.compile_function(source)
+                    except Exception:
+                        compiled_functions[source] = None
+                return compiled_functions[source]
+
+            def function_send(_clz, instanceid:int, name:str, args:tuple, kwargs:dict):
+                # 呼び出し時点の引数を送るので、ここでシリアライズしておく
+                serial_data = _clz._dumps_call(instanceid, name, args, kwargs)
+                self.call_cache.invalidate(instanceid)
+                with queued_calls_lock:
+                    queued_calls.append(serial_data)
+                    overflow = len(queued_calls) >= MAX_QUEUED_CALLS
+                if overflow:
+                    _clz.flush()
+
+            def flush(_clz):
+                with send_recv_pair:
+                    send_call_data = _attach_queued_calls({'cmd':'call'})
+                    if 'calls' not in send_call_data:
+                        return
+                    self._send(send_call_data)
+                    return_data = self._recv()
+                if type(return_data) is not dict or 'cmd' not in return_data:
+                    raise CommunicateError()
+                if return_data['cmd'] == 'exception':
+                    if 'message' in return_data:
+                        raise ExceptionInClientError(return_data['message'])
+                    raise ExceptionInClientError()
+                elif return_data['cmd'] != 'called':
+                    raise CommunicateError(f'unknown command in call result {return_data["cmd"]}')
+
+            def fetch(_clz, instanceids:List[int]) -> Dict[int,object]:
+                # 取得済みのインスタンスはクライアントから内容を送らないので、既存のオブジェクトを使う
+                known_instance = _synced_instance()
+                send_fetch_data = {'cmd':'fetch', 'instances':[int(instanceid) for instanceid in instanceids]}
+                with send_recv_pair:
+                    self._send(_attach_queued_calls(send_fetch_data))
+                    return_data = self._recv()
+                    if type(return_data) is not dict or 'cmd' not in return_data:
+                        raise CommunicateError()
+                    if return_data['cmd'] == 'exception':
+                        if 'message' in return_data:
+                            raise ExceptionInClientError(return_data['message'])
+                        raise ExceptionInClientError()
+                    elif return_data['cmd'] != 'fetched':
+                        raise CommunicateError(f'unknown command in fetch result {return_data["cmd"]}')
+                    fetched = {}
+                    for serialized_fetched_data in return_data['data']:
+                        self._preload(serialized_fetched_data)
+                        fetched_object, fetched_id_map = loads(serialized_fetched_data, function_hook=_clz, return_id_map=True, known_instance=known_instance)
+                        idmap_shared_object.update(fetched_id_map)
+                        # 共有オブジェクト全体は辿り直さず、取得した部分木のみキャッシュに加える
+                        _, fetched_caller = dumps(fetched_object, return_caller=True, snippet_share_only=False, restore_id_map=idmap_shared_object)
+                        known_instance.update({instanceid:instance.obj for instanceid, instance in fetched_caller.out_instance.items()})
+                        fetched_instance.update(serialized_fetched_data['instance'])
+                        fetched[serialized_fetched_data['object']] = fetched_object
+                return fetched
+
         sender_hook = Sender()
         conflict = ConflictSolvePolicy.CLIENT_PRIORITIZED
         current_shared_object, idmap_shared_object = None, None
+        fetched_instance = {}
+        known_instance_cache = None
+        queued_calls = []
+        compiled_functions = {}
         current_shared_object_serial, before_shared_object_serial, client_shared_object_serial = {}, {}, {}
+        log_since = {}
+        float_deadband, final_sync = None, False
+        table_resend = []
 
         with send_recv_pair:
             recieved_data = self._recv()
@@ -163,9 +399,16 @@ class Communicator:
 
             try:
                 if not reciever.is_alive():
-                    responce_data = {'cmd':'end', 'result':'complete'}
-                    self._send(responce_data)
-                    break
+                    if float_deadband is not None:
+                        # 不感帯で抑制していた変化を最後の同期で反映する
+                        float_deadband, final_sync = None, True
+                    elif len(queued_calls) > 0:
+                        # 溜めている呼び出しを最後の同期で送る
+                        final_sync = True
+                    elif not final_sync:
+                        responce_data = {'cmd':'end', 'result':'complete'}
+                        self._send(responce_data)
+                        break
                 if self.abort:
                     reciever.stop()
                     responce_data = {'cmd':'end', 'result':'abort'}
@@ -179,32 +422,87 @@ class Communicator:
                     self._preload(current_shared_object_serial)
                     before_shared_object_serial = copy.deepcopy(current_shared_object_serial)
                     current_shared_object, idmap_shared_object = loads(current_shared_object_serial, function_hook=sender_hook, return_id_map=True)
+                    known_instance_cache = None
                     reciever.init_share_object(current_shared_object)
-                    responce_data = {'cmd':'init', 'data':'success'}
+                    responce_data = {'cmd':'init', 'data':'success', 'capabilities':list(HOST_CAPABILITIES)}
                 elif recieved_data['cmd'] == 'start':
                     client_configure_object_serial = recieved_data['configure']
                     self._preload(client_configure_object_serial)
                     client_configure_object = loads(client_configure_object_serial)
                     conflict = ConflictSolvePolicy(int(recieved_data['conflict']))
+                    if recieved_data.get('deadband') is not None:
+                        float_deadband = FloatDeadband.unserialized(recieved_data['deadband'])
+                    missing_contents = [str(key) for key in recieved_data.get('contents', []) if not reciever.has_content(str(key))]
+                    if len(missing_contents) > 0:
+                        # 持っていない内容のみアップロードしてもらってから開始する
+                        responce_data = {'cmd':'upload', 'contents':missing_contents}
+                    else:
+                        reciever.init_configure_object(client_configure_object)
+                        reciever.start_command()
+                elif recieved_data['cmd'] == 'upload':
+                    uploaded_contents = {str(key):content for key, content in recieved_data['contents'].items()}
+                    for key, content in uploaded_contents.items():
+                        if content_hash(content) != key:
+                            raise CommunicateError(f'content hash mismatch - {key}')
+                    reciever.init_contents(uploaded_contents)
                     reciever.init_configure_object(client_configure_object)
                     reciever.start_command()
                 elif recieved_data['cmd'] == 'sync':
-                    client_shared_object_serial = recieved_data['shared_object']
-                    self._preload(client_shared_object_serial)
-                    current_shared_object_serial = dumps(current_shared_object, snippet_share_only=False, restore_id_map=idmap_shared_object)
-                    host_update = diff(before_shared_object_serial, current_shared_object_serial)
-                    client_update = diff(before_shared_object_serial, client_shared_object_serial)
+                    with send_recv_pair:
+                        fetched, fetched_instance_value = len(fetched_instance) > 0, dict(fetched_instance)
+                        fetched_instance.clear()
+                    if fetched:
+                        # 取得したインスタンスは取得時のクライアントの状態を同期済みとする
+                        for instanceid, instancevalue in fetched_instance_value.items():
+                            if instancevalue['__type__'] != 'remote' or instanceid not in before_shared_object_serial['instance']:
+                                before_shared_object_serial['instance'][instanceid] = instancevalue
+                        before_shared_object_serial['fingerprint'] = make_fingerprint(before_shared_object_serial['instance'])
+                    if recieved_data.get('unchanged', False):
+                        # クライアント側はフィンガープリントが一致したので前回同期時から変更無し
+                        client_shared_object_serial = before_shared_object_serial
+                    else:
+                        client_shared_object_serial = recieved_data['shared_object']
+                        self._preload(client_shared_object_serial)
+                        table_resend = expand_tables(client_shared_object_serial, before_shared_object_serial)
+                        if fetched:
+                            # 取得より前に送られたクライアントの状態では、取得したインスタンスの内容を取得時の状態で補う
+                            client_instance = client_shared_object_serial['instance']
+                            for instanceid in fetched_instance_value:
+                                if instanceid in client_instance and client_instance[instanceid]['__type__'] == 'remote':
+                                    client_instance[instanceid] = before_shared_object_serial['instance'][instanceid]
+                            client_shared_object_serial['fingerprint'] = make_fingerprint(client_instance)
+                    current_shared_object_serial = dumps(current_shared_object, snippet_share_only=False, restore_id_map=idmap_shared_object, fingerprint=True, log_since=log_since)
+                    # ホストで適用する差分はstrの差分にしない(適用先が作成元と異なっても全体の値で解決する)
+                    host_update = diff(before_shared_object_serial, current_shared_object_serial, text_delta_threshold=-1)
+                    client_update = diff(before_shared_object_serial, client_shared_object_serial, text_delta_threshold=-1)
                     if conflict == ConflictSolvePolicy.CLIENT_PRIORITIZED:
                         diff_update = marge(client_update, host_update)
                     else:
                         diff_update = marge(host_update, client_update)
-                    apply_unsirial(current_shared_object, diff_update, idmap_target_object=idmap_shared_object)
-                    current_shared_object_serial = dumps(current_shared_object, snippet_share_only=False, restore_id_map=idmap_shared_object)
+                    diff_update = rebase(diff_update, host_update, current_shared_object_serial, client_shared_object_serial)
+                    apply_unsirial(current_shared_object, diff_update, idmap_target_object=idmap_shared_object, function_hook=sender_hook)
+                    known_instance_cache = None
+                    current_shared_object_serial = dumps(current_shared_object, snippet_share_only=False, restore_id_map=idmap_shared_object, fingerprint=True, log_since=log_since)
                     before_shared_object_serial = copy.deepcopy(current_shared_object_serial)
                     client_update = diff(client_shared_object_serial, current_shared_object_serial)
+                    if float_deadband is not None:
+                        # 抑制したメンバーはクライアントが保持している値を同期済みの状態とする
+                        client_update, synced_member = deadband(client_update, client_shared_object_serial, float_deadband)
+                        update_serial(before_shared_object_serial, synced_member)
                     client_update_json = client_update.serialize()
-                    responce_data = {'cmd':'update', 'data':client_update_json}
+                    # 同期後のSharedLogのシーケンス番号以降のエントリのみを次回以降にやり取りする
+                    log_since = log_sequences(current_shared_object_serial)
+                    responce_data = {'cmd':'update', 'data':client_update_json, 'log_since':log_since}
+                    if len(table_resend) > 0:
+                        # 変更範囲を戻せなかったSharedTableは次回の同期で全体を送ってもらう
+                        responce_data['table_resend'] = table_resend
+                        table_resend = []
+                    final_sync = False
                 elif recieved_data['cmd'] == 'updated':
+                    if len(recieved_data.get('resend', [])) > 0:
+                        # クライアントで適用できなかったstrの差分は、同期済みの値を無効にして次回の同期で全体を送る
+                        update_serial(before_shared_object_serial, [SyncInstanceMember(int(instanceid), member_name, {'type':'native', 'value':None})
+                                                                    for instanceid, member_name in recieved_data['resend']])
                     responce_data = None
                 elif recieved_data['cmd'] == 'echo':
                     responce_data = recieved_data
@@ -229,9 +527,14 @@ class Communicator:
                     time.sleep((start_time + unit_time) - current_time)
         
                 responce_data = {'cmd':'sync'}
+                before_root_fingerprint = root_fingerprint(before_shared_object_serial)
+                if before_root_fingerprint is not None:
+                    responce_data['fingerprint'] = before_root_fingerprint
 
             try:
                 with send_recv_pair:
+                    if responce_data['cmd'] == 'sync':
+                        _attach_queued_calls(responce_data)
                     self._send(responce_data)
                     recieved_data = self._recv()
             except:
@@ -251,9 +554,87 @@ class Communicator:
             pass
        
     
-    def client(self, shared_object, configure_object, conflict:ConflictSolvePolicy, snippet_share_only:bool=True, dump_object_depth:int=-1):
+    def client(self, shared_object, configure_object, conflict:ConflictSolvePolicy, snippet_share_only:bool=True, dump_object_depth:int=-1, float_deadband:Optional[FloatDeadband]=None,
+               remote_reference_depth:Optional[int]=None, remote_reference_size:Optional[int]=None, remote_prefetch_depth:int=1,
+               contents:Optional[Dict[str,str]]=None, legacy_configure_object=None):
+        """
+        Note:
+            remote_reference_depthより深い、またはremote_reference_sizeより要素数が多いインスタンスは初期化時に内容を送らず、
+            ホストが最初にアクセスした時にremote_prefetch_depthの深さまでまとめて送る
+            contents({content_hash(内容): 内容})は開始時にキーのみ送り、ホストが持っていない内容のみアップロードする
+            ホストがcontentsに対応していなければ(古いホスト)、configure_objectの代わりに内容を含めたlegacy_configure_objectを送る
+        """
         exception_message = None
         exception_class = CommunicateException
+        log_since = None
+        # SharedTableはホストと合意した状態からの変更範囲のみ送る
+        table_since = {}
+        # ホストに内容を送っていないインスタンスとホストが持っているインスタンス
+        remote_objects, host_instance_ids = {}, set()
+        # ホストと同期済みのインスタンスの部分木のハッシュ
+        synced_fingerprint = {}
+
+        def _init_remote(instanceid, obj, depth):
+            if remote_reference_depth is not None and depth > remote_reference_depth:
+                return True
+            if remote_reference_size is not None:
+                size = len(obj) if hasattr(type(obj), '__len__') else len(vars(obj))
+                return size > remote_reference_size
+            return False
+
+        def _sync_remote(instanceid, obj, depth):
+            return instanceid in remote_objects and remote_objects[instanceid] is obj
+
+        def _fetch_remote(instanceid, obj, depth):
+            if instanceid in remote_objects and remote_objects[instanceid] is obj:
+                return depth > remote_prefetch_depth
+            return instanceid in host_instance_ids
+
+        def _update_remote(shared_data, caller):
+            for instanceid, instancevalue in shared_data['instance'].items():
+                if instancevalue['__type__'] == 'remote':
+                    if instanceid not in host_instance_ids:
+                        remote_objects[instanceid] = caller.out_instance[instanceid].obj
+                else:
+                    remote_objects.pop(instanceid, None)
+                    host_instance_ids.add(instanceid)
+
+        def _synced(return_data, known_instance):
+            # ホストと同期した後に変更していないインスタンスはインスタンスIDのみ送る
+            if len(synced_fingerprint) == 0:
+                return None
+            current_fingerprint = dumps(return_data, snippet_share_only=False, fingerprint=True)['fingerprint']
+            def _unchanged(instanceid, obj, depth):
+                return instanceid in known_instance and known_instance[instanceid] is obj and instanceid in synced_fingerprint and \
+                       instanceid in current_fingerprint and current_fingerprint[instanceid][1] == synced_fingerprint[instanceid][1]
+            return _unchanged
+
+        def _drop_updated(update_data):
+            # ホストからの変更を反映したインスタンスとその参照元は、同期した時のハッシュと比べられない
+            updated = set(m.instance_id for m in update_data.updated_member + update_data.created_member + update_data.deleted_member + update_data.patched_member)
+            updated.update(m.instance_id for m in update_data.deleted_instance)
+            if len(updated) == 0:
+                return
+            parents = {}
+            for instanceid, instancevalue in sirial_shared_data.get('instance', {}).items():
+                for child in pointers(instancevalue):
+                    parents.setdefault(child, []).append(instanceid)
+            dropped = set()
+            while len(updated) > 0:
+                instanceid = updated.pop()
+                if instanceid not in dropped:
+                    dropped.add(instanceid)
+                    synced_fingerprint.pop(instanceid, None)
+                    updated.update(parents.get(instanceid, []))
+
+        def _call_queued(recieved_data):
+            # ホストで溜めた戻り値を待たない呼び出しを、メッセージの処理の前に呼び出し順に実行する
+            known_instance = {instanceid:instance.obj for instanceid, instance in shared_caller.out_instance.items()}
+            for call_data_serial in recieved_data['calls']:
+                self._preload(call_data_serial)
+                shared_caller.function_call(**loads(call_data_serial, known_instance=known_instance))
+
+        use_remote = remote_reference_depth is not None or remote_reference_size is not None
 
         try:
             session = str(uuid.uuid4())
@@ -282,7 +663,11 @@ class Communicator:
             if not(recieved_data['cmd']  == 'echo' and recieved_data['start_time']  == int(start_time)):
                 raise CommunicateInitialError('echo check error')
 
-            sirial_shared_data, shared_caller = dumps(shared_object, return_caller=True, snippet_share_only=snippet_share_only, dump_object_depth=dump_object_depth)
+            sirial_shared_data, shared_caller = dumps(shared_object, return_caller=True, snippet_share_only=snippet_share_only, dump_object_depth=dump_object_depth, fingerprint=True,
+                                                      table_since=table_since, remote_reference=_init_remote if use_remote else None)
+            if use_remote:
+                _update_remote(sirial_shared_data, shared_caller)
+            synced_fingerprint.update(sirial_shared_data.get('fingerprint', {}))
             responce_data = {'cmd':'init', 'shared_object':sirial_shared_data}
             self._send(responce_data)
             recieved_data = self._recv()
@@ -294,9 +679,21 @@ class Communicator:
                 raise CommunicateInitialError(f'exception in shared_object initial')
             if not(recieved_data['cmd']  == 'init' and recieved_data['data']  == 'success'):
                 raise CommunicateInitialError('shared_object initial error')
-
-            configure_object_serial = dumps(configure_object, snippet_share_only=False)
+            host_capabilities = set(recieved_data.get('capabilities', []))
+
+            use_contents = contents is not None and len(contents) > 0
+            start_configure_object = configure_object
+            if use_contents and 'contents' not in host_capabilities:
+                if legacy_configure_object is None:
+                    raise CommunicateError('host does not support contents')
+                start_configure_object = legacy_configure_object
+                use_contents = False
+            configure_object_serial = dumps(start_configure_object, snippet_share_only=False)
             responce_data = {'cmd':'start', 'conflict':int(conflict.value), 'configure':configure_object_serial}
+            if float_deadband is not None:
+                responce_data['deadband'] = float_deadband.serialize()
+            if use_contents:
+                responce_data['contents'] = list(contents.keys())
             self._send(responce_data)
         except Exception as e:
             raise CommunicateCannotStartError(str(e))
@@ -314,21 +711,70 @@ class Communicator:
                 try:
                     if type(recieved_data) is not dict and 'cmd' not in recieved_data:
                         raise CommunicateError(f'message format error')
+                    if 'calls' in recieved_data:
+                        _call_queued(recieved_data)
                     if recieved_data['cmd'] == 'responce':
                         recieved_data_data_serial = recieved_data['data']
                         self._preload(recieved_data_data_serial)
-                        function_data = loads(recieved_data_data_serial)
+                        # 同期済みのインスタンスはインスタンスIDで受け渡す
+                        known_instance = {instanceid:instance.obj for instanceid, instance in shared_caller.out_instance.items()}
+                        function_data = loads(recieved_data_data_serial, known_instance=known_instance)
                         return_data = shared_caller.function_call(**function_data)
-                        serialized_return_data = dumps(return_data, snippet_share_only=False)
+                        serialized_return_data = dumps([return_data], snippet_share_only=False, remote_reference=_synced([return_data], known_instance))
                         responce_data = {'cmd':'return', 'data':serialized_return_data}
+                    elif recieved_data['cmd'] == 'call':
+                        responce_data = {'cmd':'called'}
+                    elif recieved_data['cmd'] == 'upload':
+                        responce_data = {'cmd':'upload', 'contents':{key:contents[key] for key in recieved_data['contents']}}
+                    elif recieved_data['cmd'] == 'fetch':
+                        fetched_data = []
+                        for instanceid in recieved_data['instances']:
+                            if int(instanceid) in remote_objects:
+                                fetch_object = remote_objects[int(instanceid)]
+                            elif int(instanceid) in shared_caller.out_instance:
+                                fetch_object = shared_caller.out_instance[int(instanceid)].obj
+                            else:
+                                continue
+                            serialized_fetch_data, fetch_caller = dumps(fetch_object, return_caller=True, snippet_share_only=snippet_share_only, remote_reference=_fetch_remote)
+                            _update_remote(serialized_fetch_data, fetch_caller)
+                            shared_caller.out_instance.update({i:instance for i, instance in fetch_caller.out_instance.items() if i not in shared_caller.out_instance or
+                                                               serialized_fetch_data['instance'][i]['__type__'] != 'remote'})
+                            fetched_data.append(serialized_fetch_data)
+                        responce_data = {'cmd':'fetched', 'data':fetched_data}
                     elif recieved_data['cmd'] == 'sync':
-                        sirial_shared_data, shared_caller = dumps(shared_object, return_caller=True, snippet_share_only=snippet_share_only, dump_object_depth=dump_object_depth)
-                        responce_data = {'cmd':'sync', 'shared_object':sirial_shared_data}
+                        sirial_shared_data, shared_caller = dumps(shared_object, return_caller=True, snippet_share_only=snippet_share_only, dump_object_depth=dump_object_depth, fingerprint=True, log_since=log_since,
+                                                                  table_since=table_since, remote_reference=_sync_remote if use_remote else None)
+                        if use_remote:
+                            remote_objects.clear()
+                            host_instance_ids.clear()
+                            _update_remote(sirial_shared_data, shared_caller)
+                        synced_fingerprint.clear()
+                        synced_fingerprint.update(sirial_shared_data.get('fingerprint', {}))
+                        if 'fingerprint' in recieved_data and recieved_data['fingerprint'] == root_fingerprint(sirial_shared_data):
+                            responce_data = {'cmd':'sync', 'unchanged':True}
+                        else:
+                            responce_data = {'cmd':'sync', 'shared_object':sirial_shared_data}
                     elif recieved_data['cmd'] == 'update':
                         diff_data_json = recieved_data['data']
                         diff_data = SyncSharedObject.unserialized(diff_data_json)
-                        apply_unsirial(shared_object, diff_data)
+                        unapplied = []
+                        apply_unsirial(shared_object, diff_data, unapplied=unapplied)
+                        _drop_updated(diff_data)
+                        for patch in diff_data.patched_member:
+                            # 合意した状態はホストに送った状態にホストからの変更を反映したもの
+                            if patch.patch_type == 'table' and patch.instance_id in table_since:
+                                table_since[patch.instance_id][2] = None # ハッシュは次回のdumpsで作り直す
+                                table_since[patch.instance_id][1]._receive(patch.value.get('length'),
+                                                                           {name:[[int(start), base64.b64decode(data)] for start, _, data in ranges]
+                                                                            for name, ranges in patch.value['columns'].items()},
+                                                                           schema=patch.value.get('schema'))
+                        if 'log_since' in recieved_data:
+                            log_since = {int(k):v for k,v in recieved_data['log_since'].items()}
+                        for instanceid in recieved_data.get('table_resend', []):
+                            table_since.pop(int(instanceid), None)
                         responce_data = {'cmd':'updated'}
+                        if len(unapplied) > 0:
+                            responce_data['resend'] = unapplied
                     elif recieved_data['cmd'] == 'end':
                         responce_data = None
                         break
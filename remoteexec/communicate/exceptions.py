@@ -36,3 +36,6 @@ class CommunicateSendError(CommunicateError):
 
 class CommunicateRecvError(CommunicateError):
     "通信エラー"
+
+class RemoteReferenceError(CommunicateError):
+    "RemoteReferenceの参照先をクライアントから取得できない"
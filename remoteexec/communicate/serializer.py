@@ -2,13 +2,25 @@ from typing import List, Dict, Tuple, Union, Callable, Optional
 from enum import Enum
 from collections import defaultdict
 import inspect
+import textwrap
+import ast
+import hashlib
+import struct
 import types
 import json
 import zipfile
 import base64
 import io
+import threading
+import weakref
 
 from .exceptions import *
+from .shared import SharedLog, SharedTable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __snippet_share__ = set()
 
@@ -16,18 +28,386 @@ def snippet_share(obj):
     __snippet_share__.add(obj)
     return obj
 
+def snippet_oneway(func):
+    """
+    戻り値を待たずに送る(戻り値は常にNone)@snippet_shareのメソッド
+
+    Examples:
+
+        >>> @snippet_share
+        >>> class Logger:
+        >>>     @snippet_oneway
+        >>>     def log(self, message):
+        >>>         print(message)
+
+    Note:
+        呼び出しはホスト側で溜めて、次の同期や戻り値を待つ呼び出しの時に呼び出し順のまままとめて送る
+        クライアント側で発生した例外は次の同期で通知され、実行を終了する
+    """
+    func.__snippet_oneway__ = True
+    return func
+
+def snippet_pure(func):
+    """
+    引数とインスタンスの状態が同じなら同じ値を返す@snippet_shareのメソッド(ホスト側で戻り値をキャッシュする)
+
+    Examples:
+
+        >>> @snippet_share
+        >>> class Config:
+        >>>     @snippet_pure
+        >>>     def lookup(self, key):
+        >>>         return self.values[key]
+
+    Note:
+        キャッシュはインスタンス(と参照渡しした引数)から辿れるインスタンスが同期で変わった時に無効になる
+    """
+    func.__snippet_cache__ = {'ttl':None}
+    return func
+
+def snippet_cacheable(ttl:float):
+    """
+    戻り値をttl秒間ホスト側でキャッシュする@snippet_shareのメソッド
+
+    Examples:
+
+        >>> @snippet_share
+        >>> class Sensor:
+        >>>     @snippet_cacheable(ttl=0.5)
+        >>>     def temperature(self):
+        >>>         return read_temperature()
+
+    Note:
+        @snippet_pureと同じく、インスタンスが同期で変わった時にもキャッシュは無効になる
+    """
+    def _decorator(func):
+        func.__snippet_cache__ = {'ttl':float(ttl)}
+        return func
+    return _decorator
+
+def snippet_serverside(func):
+    """
+    サーバー側で実行する@snippet_shareのメソッド(ソースコードを送り、同期しているインスタンスに対して実行する)
+
+    Examples:
+
+        >>> @snippet_share
+        >>> class Rect:
+        >>>     def __init__(self):
+        >>>         self.w, self.h = 2, 3
+        >>>     @snippet_serverside
+        >>>     def area(self):
+        >>>         return self.w * self.h
+
+    Note:
+        メソッドはスニペットと同じ制限(__で始まる名前の禁止、importの除去、使える組み込み関数)でコンパイルされ、
+        引数とインスタンスのメンバー以外(モジュールのグローバル変数やクロージャ)は参照できない
+        ソースコードを取得できない、または制限に違反するメソッドは通常通りクライアント側で実行する
+    """
+    try:
+        root = ast.parse(textwrap.dedent(inspect.getsource(func)))
+    except (OSError, TypeError, SyntaxError):
+        return func
+    if len(root.body) == 1 and type(root.body[0]) is ast.FunctionDef:
+        root.body[0].decorator_list = []
+        func.__snippet_source__ = ast.unparse(root)
+    return func
+
+__snippet_batch__ = threading.local()
+
+class batch:
+    """batch
+
+    withブロック内の@snippet_shareのメソッド呼び出しを戻り値を待たずに溜めて、ブロックを抜ける時に1回の通信でまとめて送る
+    (ブロック内の呼び出しの戻り値は常にNone)
+
+    Examples:
+
+        >>> with batch():
+        >>>     for i in range(100):
+        >>>         robot.move(i)
+
+    Note:
+        スニペットのグローバル変数batchとして使える
+        ブロック内で例外が発生した場合は溜めた呼び出しを次の同期で送る
+    """
+    def __enter__(self):
+        __snippet_batch__.depth = getattr(__snippet_batch__, 'depth', 0) + 1
+        if __snippet_batch__.depth == 1:
+            __snippet_batch__.hooks = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        __snippet_batch__.depth -= 1
+        if __snippet_batch__.depth == 0:
+            hooks, __snippet_batch__.hooks = __snippet_batch__.hooks, []
+            if exc_type is None:
+                for hook in hooks:
+                    hook.flush()
+        return False
+
+def _call_function_hook(function_hook, obj:object, instanceid:int, name:str, args:tuple, kwargs:dict, member:Dict[str,object]):
+    if member.get('source', None) is not None:
+        func = function_hook.function_compile(instanceid, name, member['source'])
+        if func is not None:
+            return func(obj, *args, **kwargs)
+    if getattr(__snippet_batch__, 'depth', 0) > 0:
+        if not any(hook is function_hook for hook in __snippet_batch__.hooks):
+            __snippet_batch__.hooks.append(function_hook)
+        function_hook.function_send(instanceid, name, args, kwargs)
+        return None
+    if member.get('oneway', False):
+        function_hook.function_send(instanceid, name, args, kwargs)
+        return None
+    if member.get('cache', False):
+        return function_hook.function_cached(instanceid, name, args, kwargs, member.get('ttl', None))
+    return function_hook.function_call(instanceid, name, args, kwargs)
+
+STRUCT_TYPECODES = {int:'q', float:'d', bool:'?'}
+
+def snippet_struct(obj):
+    """
+    型注釈がint/float/boolのメンバーを固定レイアウトのバイナリで同期する@snippet_share
+
+    Examples:
+
+        >>> @snippet_struct
+        >>> class RobotState:
+        >>>     x: float = 0.
+        >>>     y: float = 0.
+        >>>     mode: int = 0
+
+    Note:
+        それ以外のメンバーは@snippet_shareと同じく個別に同期する
+        型注釈と型が違う値(floatのメンバーのintやNoneなど)と、64bitの範囲外のintはパックせずに、
+        そのメンバーのみ個別に同期する(レイアウトの位置には0を入れる)
+    """
+    typenames = {t.__name__:t for t in STRUCT_TYPECODES.keys()}
+    names, typecodes = [], []
+    for clz in reversed(obj.__mro__):
+        for name, annotation in clz.__dict__.get('__annotations__', {}).items():
+            annotation = typenames.get(annotation, annotation) if type(annotation) is str else annotation
+            if annotation in STRUCT_TYPECODES and not name.startswith('__') and name not in names:
+                names.append(name)
+                typecodes.append(STRUCT_TYPECODES[annotation])
+    obj.__snippet_struct__ = (tuple(names), '<' + ''.join(typecodes))
+    return snippet_share(obj)
+
+def struct_packable(typecode:str, value:object) -> bool:
+    "valueをstructの型コードtypecodeでパックして、同じ型と値に戻せるか"
+    if typecode == 'q':
+        return type(value) is int and -(1 << 63) <= value < (1 << 63)
+    elif typecode == 'd':
+        return type(value) is float
+    elif typecode == '?':
+        return type(value) is bool
+    return False
+
+def pack_struct(format:str, values:List[object]) -> str:
+    "structのレイアウトformatでvaluesをパックしてbase64にする"
+    try:
+        return base64.b64encode(struct.pack(format, *values)).decode('utf-8')
+    except struct.error as e:
+        raise SirializeError(str(e))
+
+def unpack_struct(format:str, data:str) -> Tuple[object]:
+    "pack_structの逆変換"
+    try:
+        return struct.unpack(format, base64.b64decode(data))
+    except (struct.error, ValueError) as e:
+        raise UnsirializeError(str(e))
+
+def is_buffer(obj:object) -> bool:
+    "bytes/bytearray/memoryview/numpy.ndarrayか"
+    return isinstance(obj, (bytes, bytearray, memoryview)) or (numpy is not None and isinstance(obj, numpy.ndarray))
+
+BUFFER_BLOCK_SIZE = 65535 # base64で区切れるように3の倍数
+
+__buffer_dirty__ = {} # id(バッファ): バッファの弱参照と追跡中のブロック
+
+def _tracked_buffer(obj:object) -> Optional[Dict[str,object]]:
+    "mark_dirtyで追跡中のバッファの情報"
+    tracked = __buffer_dirty__.get(id(obj))
+    if tracked is None:
+        return None
+    return tracked if tracked['ref']() is obj else None
+
+def mark_dirty(obj:object, start:int=0, stop:Optional[int]=None):
+    """
+    バッファのstartからstop(バイト単位)を変更したことを通知する
+
+    Examples:
+
+        >>> image = numpy.zeros((4096, 4096), dtype=numpy.uint8)
+        >>> image[10:20] = 255
+        >>> mark_dirty(image, 10*4096, 20*4096)
+
+    Note:
+        一度mark_dirtyしたバッファは、以降のdumpsで通知された範囲を含むブロックのみを再エンコードする
+        (通知していない変更は同期されない)
+        追跡をやめる場合はunmark_dirtyする
+        追跡はバッファを弱参照で保持し、バッファが解放されると追跡もやめる
+        弱参照できないbytes/bytearrayは追跡できないので(TypeError)、memoryview(bytearray(...))を共有する
+    """
+    tracked = _tracked_buffer(obj)
+    if tracked is None:
+        key = id(obj)
+        def _release(ref):
+            if key in __buffer_dirty__ and __buffer_dirty__[key]['ref'] is ref:
+                del __buffer_dirty__[key]
+        try:
+            ref = weakref.ref(obj, _release)
+        except TypeError:
+            raise TypeError(f'mark_dirty requires a weak-referenceable buffer (memoryview or numpy.ndarray), not {type(obj).__name__}')
+        tracked = {'ref':ref, 'block_size':None, 'blocks':None, 'dirty':[]}
+        __buffer_dirty__[key] = tracked
+    tracked['dirty'].append((int(start), stop))
+
+def unmark_dirty(obj:object):
+    "mark_dirtyによる変更範囲の追跡をやめる"
+    if _tracked_buffer(obj) is not None:
+        del __buffer_dirty__[id(obj)]
+
+def received_blocks(obj:object, block_size:Optional[int]=None, changed:Optional[List[list]]=None):
+    """
+    同期で書き込まれたバッファのブロックを、mark_dirtyの追跡中のブロックに反映する
+
+    Args:
+        block_size (int): ブロックのバイト数
+        changed (list): 書き込んだ[ブロックの番号, base64]のリスト(Noneならバッファ全体を書き込んだ)
+    """
+    tracked = _tracked_buffer(obj)
+    if tracked is None or tracked['blocks'] is None:
+        return
+    if changed is None or tracked['block_size'] != block_size:
+        tracked['blocks'] = None
+        return
+    blocks = list(tracked['blocks'])
+    for index, block in changed:
+        if int(index) >= len(blocks):
+            tracked['blocks'] = None
+            return
+        blocks[int(index)] = block
+    tracked['blocks'] = blocks
+
+def _encode_blocks(obj:object, data:memoryview, block_size:int) -> List[str]:
+    "ブロック毎のbase64(mark_dirtyで追跡中のバッファは変更範囲を含むブロックのみエンコードし直す)"
+    nblocks = (len(data) + block_size - 1) // block_size
+    tracked = _tracked_buffer(obj)
+    if tracked is None:
+        return [base64.b64encode(data[index*block_size:(index+1)*block_size]).decode('utf-8') for index in range(nblocks)]
+    dirty, tracked['dirty'] = tracked['dirty'], []
+    blocks = tracked['blocks']
+    if blocks is None or tracked['block_size'] != block_size or len(blocks) != nblocks:
+        blocks = [None] * nblocks
+    else:
+        blocks = list(blocks)
+        for start, stop in dirty:
+            stop = len(data) if stop is None else min(int(stop), len(data))
+            for index in range(max(start, 0) // block_size, (stop + block_size - 1) // block_size):
+                blocks[index] = None
+    for index in range(nblocks):
+        if blocks[index] is None:
+            blocks[index] = base64.b64encode(data[index*block_size:(index+1)*block_size]).decode('utf-8')
+    tracked['block_size'], tracked['blocks'] = block_size, blocks
+    return blocks
+
+def dump_buffer(obj:object, block_size:int=BUFFER_BLOCK_SIZE) -> Dict[str,object]:
+    """
+    バッファをdtype/shapeとバイト列(base64)にする
+
+    Note:
+        C連続のバッファはコピーせずにmemoryviewからbase64にする
+        block_sizeより大きいバッファはblock_sizeバイト毎のブロックに分けて'blocks'に入れ、
+        diffはブロック単位で比較する
+    """
+    if isinstance(obj, (bytes, bytearray)):
+        kind, dtype, shape, data = type(obj).__name__, 'B', [len(obj)], memoryview(obj)
+    elif isinstance(obj, memoryview):
+        kind, dtype, shape = 'memoryview', obj.format, list(obj.shape)
+        data = obj.cast('B') if obj.c_contiguous else memoryview(obj.tobytes())
+    elif numpy is not None and isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            raise SirializeError('numpy.ndarray of object cannot serialize')
+        array = numpy.ascontiguousarray(obj)
+        kind, dtype, shape = 'ndarray', array.dtype.str, list(array.shape)
+        data = memoryview(array.reshape(-1)).cast('B')
+    else:
+        raise SirializeError()
+    value = {'__type__':'buffer', 'kind':kind, 'dtype':dtype, 'shape':shape}
+    if block_size is not None and block_size > 0 and len(data) > block_size:
+        value['block_size'] = int(block_size)
+        value['blocks'] = _encode_blocks(obj, data, int(block_size))
+    else:
+        value['data'] = base64.b64encode(data).decode('utf-8')
+    return value
+
+def buffer_bytes(value:Dict[str,object]) -> bytes:
+    "dump_bufferのバイト列"
+    try:
+        if 'blocks' in value:
+            return b''.join(base64.b64decode(block) for block in value['blocks'])
+        return base64.b64decode(value['data'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise UnsirializeError(str(e))
+
+def make_buffer(kind:str, dtype:str, shape:List[int], data:bytes) -> object:
+    "型kindのバッファをバイト列dataから作る"
+    try:
+        if kind == 'bytes':
+            return bytes(data)
+        elif kind == 'bytearray':
+            return bytearray(data)
+        elif kind == 'memoryview':
+            return memoryview(bytearray(data)).cast(dtype, shape)
+        elif kind == 'ndarray':
+            if numpy is None:
+                raise UnsirializeError('numpy is not installed')
+            return numpy.frombuffer(bytearray(data), dtype=numpy.dtype(dtype)).reshape(shape)
+    except (TypeError, ValueError) as e:
+        raise UnsirializeError(str(e))
+    raise UnsirializeError(f'unknown buffer kind {kind}')
+
+def load_buffer(value:Dict[str,object]) -> object:
+    "dump_bufferの逆変換"
+    if 'kind' not in value or 'dtype' not in value or 'shape' not in value:
+        raise UnsirializeError()
+    return make_buffer(value['kind'], value['dtype'], value['shape'], buffer_bytes(value))
+
 class SiriarizeInstance:
-    def __init__(self, obj:object, objdict:Dict[str,object], names:Tuple[str], funcs:Optional[Tuple[str]]=None):
+    def __init__(self, obj:object, objdict:Dict[str,object], names:Tuple[str], funcs:Optional[Tuple[str]]=None, layout:Optional[Tuple[Tuple[str],str,Tuple[str]]]=None):
         self.obj = obj
         self.objdict = objdict
         self.names = names
         self.funcs = funcs if funcs else tuple()
+        self.layout = layout
 
 class SiriarizeDictInstance:
     def __init__(self, obj:object, objdict:Dict[object,object]):
         self.obj = obj
         self.objdict = objdict
 
+class SiriarizeLogInstance:
+    def __init__(self, obj:SharedLog, base:int, entries:List[object]):
+        self.obj = obj
+        self.base = base
+        self.entries = entries
+
+class SiriarizeTableInstance:
+    def __init__(self, obj:SharedTable, snapshot:SharedTable, base:Optional[SharedTable]=None, digest:Optional[str]=None):
+        self.obj = obj
+        self.snapshot = snapshot
+        self.base = base
+        self.digest = digest
+
+class SiriarizeBufferInstance:
+    def __init__(self, obj:object):
+        self.obj = obj
+
+class SiriarizeRemoteInstance:
+    def __init__(self, obj:object):
+        self.obj = obj
+
 
 class SirializeFunctionCaller:
     def __init__(self, out_instance):
@@ -50,23 +430,69 @@ def dumps(share_object:object,
           return_caller:bool=False,
           snippet_share_only:bool=True,
           dump_object_depth:int=-1,
-          restore_id_map:Optional[dict]=None) -> Union[Dict[str,object],Tuple[Dict[str,object], SirializeFunctionCaller]]:
+          restore_id_map:Optional[dict]=None,
+          fingerprint:bool=False,
+          log_since:Optional[Dict[int,int]]=None,
+          table_since:Optional[Dict[int,list]]=None,
+          buffer_block_size:int=BUFFER_BLOCK_SIZE,
+          remote_reference:Optional[Callable[[int,object,int],bool]]=None) -> Union[Dict[str,object],Tuple[Dict[str,object], SirializeFunctionCaller]]:
 
     out_instance = {}
     type_typename = {int:'int',float:'float',str:'str',bool:'bool',list:'list',set:'set',tuple:'tuple',dict:'dict'}
 
     def _id(obj):
-        if obj.__class__.__name__.startswith('__serial_id_'):
+        if type(obj) is RemoteReference:
+            return obj.__remote_id__
+        elif obj.__class__.__name__.startswith('__serial_id_'):
             return int(obj.__class__.__name__[len('__serial_id_'):])
         elif restore_id_map is not None and id(obj) in restore_id_map:
             return int(restore_id_map[id(obj)])
         return id(obj)
 
-    def _list(obj, depth):
-        d, e, f = None, None, None
+    def _remote(obj, depth):
+        "remote_reference(インスタンスID, オブジェクト, 深さ)がTrueなら内容を送らずに{'__type__':'remote'}にする"
+        if depth == 0 or remote_reference is None:
+            return False
+        if not (isinstance(obj, (SharedTable, SharedLog, list, tuple, set, dict)) or is_buffer(obj) or
+                (hasattr(obj, '__dict__') and (snippet_share_only==False or type(obj) in __snippet_share__))):
+            return False
+        return remote_reference(_id(obj), obj, depth)
+
+    def _list(obj, depth, remote=True):
+        d, e, f, g, h = None, None, None, None, None
+        if type(obj) is RemoteReference:
+            if obj.__remote_target__ is None:
+                if _id(obj) not in out_instance and (dump_object_depth < 0 or dump_object_depth > depth):
+                    out_instance[_id(obj)] = SiriarizeRemoteInstance(obj)
+                return
+            obj = obj.__remote_target__ # 取得済みのRemoteReferenceは参照先を同じインスタンスIDでシリアライズする
         if _id(obj) not in out_instance:
             if obj is None or type(obj) is int or type(obj) is float or type(obj) is str is float or type(obj) is bool:
                 pass
+            elif remote and _remote(obj, depth):
+                if dump_object_depth < 0 or dump_object_depth > depth:
+                    out_instance[_id(obj)] = SiriarizeRemoteInstance(obj)
+            elif isinstance(obj, SharedTable):
+                if dump_object_depth < 0 or dump_object_depth > depth:
+                    # 前回の同期で合意した状態(table_since: {インスタンスID: [SharedTable, 状態の複製, ハッシュ]})があれば変更範囲のみ
+                    base = None
+                    if table_since is not None and _id(obj) in table_since:
+                        since_obj, since_snapshot, since_digest = table_since[_id(obj)]
+                        if since_obj is obj and since_snapshot.columns == obj.columns:
+                            base = since_snapshot
+                    if base is not None and len(obj) == len(base) and len(obj._changed_ranges(base)) == 0:
+                        # 前回の同期から変更が無ければ、複製とハッシュを使い回す
+                        out_instance[_id(obj)] = SiriarizeTableInstance(obj, base, base, since_digest)
+                    else:
+                        out_instance[_id(obj)] = SiriarizeTableInstance(obj, obj._snapshot(), base)
+            elif is_buffer(obj):
+                if dump_object_depth < 0 or dump_object_depth > depth:
+                    out_instance[_id(obj)] = SiriarizeBufferInstance(obj)
+            elif isinstance(obj, SharedLog):
+                # 同期済みのシーケンス番号以降のエントリのみ
+                g = obj.first_sequence
+                if log_since is not None and _id(obj) in log_since:
+                    g = max(g, min(int(log_since[_id(obj)]), obj.sequence))
             elif isinstance(obj, list) or isinstance(obj, tuple) or isinstance(obj, set):
                 d = {str(key):value for key,value in enumerate(obj)}
             elif isinstance(obj, dict):
@@ -87,22 +513,64 @@ def dumps(share_object:object,
                     f = tuple(key for key,value in inspect.getmembers(obj) 
                             if not key.startswith('__')
                             and (inspect.ismethod(value) or inspect.isfunction(value)))
+                    h = getattr(type(obj), '__snippet_struct__', None)
+                    if h is not None:
+                        # パックできない値のメンバーは個別に同期する
+                        skip = tuple(name for name, typecode in zip(h[0], h[1][1:]) if name in d and not struct_packable(typecode, d[name]))
+                        d = {key:value for key,value in d.items() if key not in h[0] or key in skip}
+                        h = (h[0], h[1], skip)
             if dump_object_depth < 0 or dump_object_depth > depth:
                 if d is not None:
-                    out_instance[_id(obj)] = SiriarizeInstance(obj, d, tuple(d.keys()), f)
+                    out_instance[_id(obj)] = SiriarizeInstance(obj, d, tuple(d.keys()), f, h)
                     for value in d.values():
-                        _list(obj=value, depth=depth+1)
+                        _list(obj=value, depth=depth+1, remote=not isinstance(obj, set)) # setの要素はloadsでハッシュを使う
                 elif e is not None:
                     out_instance[_id(obj)] = SiriarizeDictInstance(obj, e)
                     for key,value in e.items():
-                        _list(obj=key, depth=depth+1) # to tuple key
+                        _list(obj=key, depth=depth+1, remote=False) # to tuple key
+                        _list(obj=value, depth=depth+1)
+                elif g is not None:
+                    out_instance[_id(obj)] = SiriarizeLogInstance(obj, g, obj.since(g))
+                    for value in out_instance[_id(obj)].entries:
                         _list(obj=value, depth=depth+1)
 
     _list(obj=share_object, depth=0)
 
+    def _value(v):
+        if v is None or type(v) is int or type(v) is float or type(v) is str or type(v) is bool:
+            return {'type':'native','value':v}
+        elif _id(v) in out_instance:
+            return {'type':'pointer','value':_id(v)}
+        return {'type':'native','value':None}
+
     seriarized_instance = {}
     for objid, instance in out_instance.items():
-        if type(instance) is SiriarizeDictInstance:
+        if type(instance) is SiriarizeRemoteInstance:
+            seriarized_instance[objid] = {'__type__':'remote'}
+        elif type(instance) is SiriarizeBufferInstance:
+            seriarized_instance[objid] = dump_buffer(instance.obj, buffer_block_size)
+        elif type(instance) is SiriarizeTableInstance:
+            table = instance.snapshot
+            seriarized_instance[objid] = {'__type__':'table',
+                                          'columns':[[name, typecode] for name, typecode in table.columns],
+                                          'length':len(table)}
+            if instance.base is None:
+                seriarized_instance[objid]['data'] = {name:base64.b64encode(table._dump_column(name)).decode('utf-8') for name in table.names}
+            else:
+                seriarized_instance[objid]['since'] = len(instance.base)
+                seriarized_instance[objid]['ranges'] = {name:[[start, stop, base64.b64encode(table._dump_column(name, start, stop)).decode('utf-8')] for start, stop in ranges]
+                                                        for name, ranges in (table._changed_ranges(instance.base).items() if table is not instance.base else [])}
+            if fingerprint or table_since is not None:
+                if instance.digest is None:
+                    instance.digest = table_digest(table)
+                seriarized_instance[objid]['digest'] = instance.digest
+        elif type(instance) is SiriarizeLogInstance:
+            seriarized_instance[objid] = {'__type__':'log',
+                                          'maxlen':instance.obj.maxlen,
+                                          'sequence':instance.obj.sequence,
+                                          'base':instance.base,
+                                          'entries':[_value(v) for v in instance.entries]}
+        elif type(instance) is SiriarizeDictInstance:
             seriarized_instance[objid] = {}
             seriarized_instance[objid]['__type__'] = 'dict'
             seriarized_instance[objid]['keys'] = []
@@ -138,6 +606,23 @@ def dumps(share_object:object,
                     seriarized_instance[objid][name] = {'type':'pointer','value':_id(obj)}
             for func in instance.funcs:
                 seriarized_instance[objid][func] = {'type':'function'}
+                method = getattr(instance.obj, func, None)
+                if getattr(method, '__snippet_source__', None) is not None:
+                    seriarized_instance[objid][func]['source'] = method.__snippet_source__
+                if getattr(method, '__snippet_oneway__', False):
+                    seriarized_instance[objid][func]['oneway'] = True
+                elif getattr(method, '__snippet_cache__', None) is not None:
+                    seriarized_instance[objid][func]['cache'] = True
+                    if method.__snippet_cache__['ttl'] is not None:
+                        seriarized_instance[objid][func]['ttl'] = method.__snippet_cache__['ttl']
+            if instance.layout is not None:
+                struct_names, struct_format, struct_skip = instance.layout
+                struct_values = [0 if name in struct_skip else getattr(instance.obj, name, 0) for name in struct_names]
+                seriarized_instance[objid]['__struct__'] = {'names':list(struct_names),
+                                                            'format':struct_format,
+                                                            'data':pack_struct(struct_format, struct_values)}
+                if len(struct_skip) > 0:
+                    seriarized_instance[objid]['__struct__']['skip'] = list(struct_skip)
         
     if share_object is None or type(share_object) is int or type(share_object) is float or type(share_object) is str or type(share_object) is bool:
         data = {'object':0,'value':share_object}
@@ -146,18 +631,231 @@ def dumps(share_object:object,
     else:
         raise SirializeError()
 
+    if fingerprint and 'instance' in data:
+        data['fingerprint'] = make_fingerprint(data['instance'])
+
+    if table_since is not None:
+        # 次回の同期の基準にする、今回送った状態
+        table_since.clear()
+        table_since.update({objid:[instance.obj, instance.snapshot, instance.digest] for objid, instance in out_instance.items() if type(instance) is SiriarizeTableInstance})
+
     if return_caller:
         return data, SirializeFunctionCaller(out_instance)
     else:
         return data
 
 
+def pointers(instancevalue:Dict[str,object]) -> List[int]:
+    "シリアライズ済みインスタンスが参照するインスタンスIDのリスト"
+    if instancevalue.get('__type__') == 'dict':
+        members = instancevalue['keys'] + instancevalue['values']
+    elif instancevalue.get('__type__') == 'log':
+        members = instancevalue['entries']
+    elif instancevalue.get('__type__') in ('table', 'buffer', 'remote'):
+        members = []
+    else:
+        members = [value for name, value in instancevalue.items() if not name.startswith('__')]
+    return [m['value'] for m in members if type(m) is dict and m.get('type') == 'pointer']
+
+
+def table_digest(table:SharedTable) -> str:
+    "SharedTableの全ての列のデータのハッシュ"
+    h = hashlib.blake2b(digest_size=8)
+    for name in table.names:
+        h.update(table._dump_column(name))
+    return h.hexdigest()
+
+
+def log_sequences(shared_object_serial:Dict[str,object]) -> Dict[int,int]:
+    "シリアライズ済みデータに含まれるSharedLogのインスタンスID毎のシーケンス番号"
+    if 'instance' not in shared_object_serial:
+        return {}
+    return {instanceid:instancevalue['sequence'] for instanceid, instancevalue in shared_object_serial['instance'].items()
+            if instancevalue.get('__type__') == 'log'}
+
+
+def make_fingerprint(seriarized_instance:Dict[int,Dict[str,object]]) -> Dict[int,List[str]]:
+    """
+    シリアライズ済みインスタンスのMerkleフィンガープリントを作成する
+
+    Args:
+        seriarized_instance (Dict[int,dict]): dumpsの'instance'
+
+    Returns:
+        Dict[int,List[str]]: インスタンスID毎の[内容のハッシュ, 部分木のハッシュ]
+
+    Note:
+        部分木のハッシュはポインタの参照グラフを強連結成分で縮約して積み上げるので、
+        循環参照があっても部分木のハッシュが等しければ参照先の全てのインスタンスが等しい
+    """
+    def _hash(*values):
+        h = hashlib.blake2b(digest_size=8)
+        for value in values:
+            h.update(value.encode('utf-8'))
+        return h.hexdigest()
+
+    def _content(instancevalue):
+        if instancevalue.get('__type__') == 'table' and 'digest' in instancevalue:
+            # 全体のデータと変更範囲のみのどちらでも同じハッシュ
+            instancevalue = {key:instancevalue[key] for key in ('__type__', 'columns', 'length', 'digest')}
+        return json.dumps(instancevalue, sort_keys=True)
+
+    content = {instanceid:_hash(_content(instancevalue))
+               for instanceid, instancevalue in seriarized_instance.items()}
+    tree = {}
+
+    # Tarjanの強連結成分分解
+    index, lowlink, stack, onstack = {}, {}, [], set()
+    def _strongconnect(instanceid):
+        index[instanceid] = lowlink[instanceid] = len(index)
+        stack.append(instanceid)
+        onstack.add(instanceid)
+        children = [p for p in pointers(seriarized_instance[instanceid]) if p in seriarized_instance]
+        for child in children:
+            if child not in index:
+                _strongconnect(child)
+                lowlink[instanceid] = min(lowlink[instanceid], lowlink[child])
+            elif child in onstack:
+                lowlink[instanceid] = min(lowlink[instanceid], index[child])
+        if lowlink[instanceid] == index[instanceid]:
+            component = []
+            while True:
+                member = stack.pop()
+                onstack.discard(member)
+                component.append(member)
+                if member == instanceid:
+                    break
+            successors = set()
+            for member in component:
+                for child in pointers(seriarized_instance[member]):
+                    if child in tree:
+                        successors.add(tree[child])
+            component_hash = _hash(*sorted(content[m] for m in component), '/', *sorted(successors))
+            for member in component:
+                tree[member] = component_hash
+
+    for instanceid in seriarized_instance.keys():
+        if instanceid not in index:
+            _strongconnect(instanceid)
+
+    return {instanceid:[content[instanceid], tree[instanceid]] for instanceid in seriarized_instance.keys()}
+
+
 class UnsirializeFunctionHook:
     def function_call(self, instanceid:int, name:str, args:tuple, kwargs:dict):
         return None
 
+    def function_send(self, instanceid:int, name:str, args:tuple, kwargs:dict):
+        "戻り値を待たない呼び出し(@snippet_onewayのメソッドとbatchのブロック内の呼び出し)"
+        self.function_call(instanceid, name, args, kwargs)
+
+    def function_cached(self, instanceid:int, name:str, args:tuple, kwargs:dict, ttl:Optional[float]):
+        "戻り値をキャッシュできる呼び出し(@snippet_pure/@snippet_cacheableのメソッド、ttlがNoneなら無期限)"
+        return self.function_call(instanceid, name, args, kwargs)
+
+    def function_compile(self, instanceid:int, name:str, source:str) -> Optional[Callable]:
+        "@snippet_serversideのメソッドのソースコードをコンパイルした関数(Noneならfunction_callで呼び出す)"
+        return None
+
+    def flush(self):
+        "function_sendで溜めている呼び出しを送る"
+        return
+
+    def fetch(self, instanceids:List[int]) -> Dict[int,object]:
+        "RemoteReferenceの参照先のインスタンスを取得する"
+        return {}
 
-def loads(decoded_data:Dict[str,object], function_hook:Optional[UnsirializeFunctionHook]=None, return_id_map:bool=False) -> object:
+
+class RemoteReference:
+    """RemoteReference
+
+    シリアライズ時に内容を送らなかったインスタンスのプロキシ
+    属性や要素に最初にアクセスした時にUnsirializeFunctionHook.fetchで参照先を取得し、以降は取得したオブジェクトに委譲する
+
+    Note:
+        isinstanceやtypeは参照先の型にならないので、必要な場合はresolve_remoteで参照先を取得する
+        複数のRemoteReferenceはprefetch_remoteで1回の通信でまとめて取得できる
+    """
+    __slots__ = ('__remote_id__', '__remote_hook__', '__remote_target__')
+
+    def __init__(self, instanceid:int, function_hook:Optional[UnsirializeFunctionHook]=None):
+        object.__setattr__(self, '__remote_id__', int(instanceid))
+        object.__setattr__(self, '__remote_hook__', function_hook)
+        object.__setattr__(self, '__remote_target__', None)
+
+    def __getattr__(self, name):
+        return getattr(resolve_remote(self), name)
+
+    def __setattr__(self, name, value):
+        setattr(resolve_remote(self), name, value)
+
+    def __delattr__(self, name):
+        delattr(resolve_remote(self), name)
+
+    def __getitem__(self, key):
+        return resolve_remote(self)[key]
+
+    def __setitem__(self, key, value):
+        resolve_remote(self)[key] = value
+
+    def __delitem__(self, key):
+        del resolve_remote(self)[key]
+
+    def __len__(self):
+        return len(resolve_remote(self))
+
+    def __iter__(self):
+        return iter(resolve_remote(self))
+
+    def __contains__(self, item):
+        return item in resolve_remote(self)
+
+    def __bool__(self):
+        return bool(resolve_remote(self))
+
+    def __eq__(self, other):
+        return resolve_remote(self) == resolve_remote(other)
+
+    def __hash__(self):
+        return hash(resolve_remote(self))
+
+    def __call__(self, *args, **kwargs):
+        return resolve_remote(self)(*args, **kwargs)
+
+    def __str__(self):
+        return str(resolve_remote(self))
+
+    def __repr__(self):
+        if self.__remote_target__ is None:
+            return f'RemoteReference({self.__remote_id__})'
+        return repr(self.__remote_target__)
+
+def prefetch_remote(*objs:object):
+    "取得していないRemoteReferenceの参照先を、UnsirializeFunctionHook毎に1回のfetchでまとめて取得する"
+    references = [obj for obj in objs if type(obj) is RemoteReference and obj.__remote_target__ is None]
+    while len(references) > 0:
+        hook = references[0].__remote_hook__
+        batch = [r for r in references if r.__remote_hook__ is hook]
+        references = [r for r in references if r.__remote_hook__ is not hook]
+        fetched = hook.fetch(list(dict.fromkeys(r.__remote_id__ for r in batch))) if hook is not None else {}
+        for reference in batch:
+            if reference.__remote_id__ not in fetched:
+                raise RemoteReferenceError(f'instance {reference.__remote_id__} cannot fetch')
+            object.__setattr__(reference, '__remote_target__', fetched[reference.__remote_id__])
+
+def resolve_remote(obj:object) -> object:
+    "RemoteReferenceなら参照先(取得していなければ取得する)、それ以外はobj"
+    if type(obj) is not RemoteReference:
+        return obj
+    if obj.__remote_target__ is None:
+        prefetch_remote(obj)
+    return obj.__remote_target__
+
+
+def loads(decoded_data:Dict[str,object],
+          function_hook:Optional[UnsirializeFunctionHook]=None,
+          return_id_map:bool=False,
+          known_instance:Optional[Dict[int,object]]=None) -> object:
     class sparselistbase(list):
         def __setitem__(self, indexstr, value):
             index = int(indexstr)
@@ -205,6 +903,7 @@ def loads(decoded_data:Dict[str,object], function_hook:Optional[UnsirializeFunct
         raise UnsirializeError()
     
     unsirialized_instance = {}
+    restored_instance_ids = {}
 
     if rootid not in instance:
         raise UnsirializeError()
@@ -214,13 +913,64 @@ def loads(decoded_data:Dict[str,object], function_hook:Optional[UnsirializeFunct
             raise UnsirializeError()
         if '__type__' not in instancevalue:
             raise UnsirializeError()
-        if instancevalue['__type__'] in typename_type:
+        if instancevalue['__type__'] == 'remote':
+            # 内容を送らなかったインスタンスは既知ならそのオブジェクト、それ以外はRemoteReference
+            if known_instance is not None and instanceid in known_instance:
+                unsirialized_instance[instanceid] = known_instance[instanceid]
+            else:
+                unsirialized_instance[instanceid] = RemoteReference(instanceid, function_hook)
+            restored_instance_ids[id(unsirialized_instance[instanceid])] = instanceid
+            continue
+        if instancevalue['__type__'] == 'buffer':
+            unsirialized_instance[instanceid] = load_buffer(instancevalue)
+            restored_instance_ids[id(unsirialized_instance[instanceid])] = instanceid
+            continue
+        if instancevalue['__type__'] == 'log':
+            clz = types.new_class(f'__serial_id_{instanceid}', (SharedLog,))
+        elif instancevalue['__type__'] == 'table':
+            clz = types.new_class(f'__serial_id_{instanceid}', (SharedTable,))
+        elif instancevalue['__type__'] in typename_type:
             clz = types.new_class(f'__serial_id_{instanceid}', (typename_type[instancevalue['__type__']],))
         else:
             clz = types.new_class(f'__serial_id_{instanceid}', (sparseobject,))
+            if '__struct__' in instancevalue:
+                clz.__snippet_struct__ = (tuple(instancevalue['__struct__']['names']), instancevalue['__struct__']['format'])
         unsirialized_instance[instanceid] = clz()
 
+    def _value(value):
+        if type(value) is not dict  or 'type' not in value:
+            raise UnsirializeError()
+        if value['type'] == 'native':
+            if 'value' not in value:
+                raise UnsirializeError()
+            return value['value']
+        elif value['type'] == 'pointer':
+            if 'value' not in value or value['value'] not in unsirialized_instance:
+                raise UnsirializeError()
+            return unsirialized_instance[value['value']]
+        raise UnsirializeError()
+
     for instanceid, instancevalue in instance.items():
+        if instancevalue['__type__'] in ('buffer', 'remote'):
+            continue
+        if instancevalue['__type__'] == 'table':
+            if 'columns' not in instancevalue or 'length' not in instancevalue or 'data' not in instancevalue:
+                raise UnsirializeError()
+            unsirialized_instance[instanceid]._configure(instancevalue['columns'])
+            unsirialized_instance[instanceid]._receive(int(instancevalue['length']),
+                                                       {name:[[0, base64.b64decode(data)]] for name, data in instancevalue['data'].items()})
+            continue
+        if instancevalue['__type__'] == 'log':
+            if 'sequence' not in instancevalue or 'base' not in instancevalue or 'entries' not in instancevalue:
+                raise UnsirializeError()
+            unsirialized_instance[instanceid]._configure(maxlen=instancevalue.get('maxlen'), sequence=int(instancevalue['base']))
+            unsirialized_instance[instanceid]._receive(int(instancevalue['base']), [_value(v) for v in instancevalue['entries']])
+            continue
+        if '__struct__' in instancevalue:
+            struct_value = instancevalue['__struct__']
+            for name, value in zip(struct_value['names'], unpack_struct(struct_value['format'], struct_value['data'])):
+                if name not in struct_value.get('skip', []):
+                    unsirialized_instance[instanceid].__setattr__(name, value)
         if instancevalue['__type__'] in 'dict':
             kvgenerator = zip(instancevalue['keys'], instancevalue['values'])
         else:
@@ -261,12 +1011,21 @@ def loads(decoded_data:Dict[str,object], function_hook:Optional[UnsirializeFunct
                     else:
                         unsirialized_instance[instanceid].__setattr__(name,unsirialized_instance[value['value']])
                 elif value['type'] == 'function':
-                    def _apply_function_hook(_instanceid, _name): # new namespace
+                    def _apply_function_hook(_instanceid, _name, _member): # new namespace
+                        _obj = unsirialized_instance[_instanceid]
                         if function_hook is not None:
-                            unsirialized_instance[_instanceid].__setattr__(_name, lambda *args, **kwargs: function_hook.function_call(_instanceid, _name, args, kwargs))
+                            func = lambda *args, **kwargs: _call_function_hook(function_hook, _obj, _instanceid, _name, args, kwargs, _member)
                         else:
-                            unsirialized_instance[_instanceid].__setattr__(_name, lambda *args, **kwargs: None)
-                    _apply_function_hook(instanceid, name)
+                            func = lambda *args, **kwargs: None
+                        # 再度dumpsした時に同じシリアライズになるように印を引き継ぐ
+                        if _member.get('source', None) is not None:
+                            func.__snippet_source__ = _member['source']
+                        if _member.get('oneway', False):
+                            func.__snippet_oneway__ = True
+                        elif _member.get('cache', False):
+                            func.__snippet_cache__ = {'ttl':_member.get('ttl', None)}
+                        _obj.__setattr__(_name, func)
+                    _apply_function_hook(instanceid, name, value)
                 else:
                     raise UnsirializeError()
         
@@ -276,7 +1035,19 @@ def loads(decoded_data:Dict[str,object], function_hook:Optional[UnsirializeFunct
     result_id_map = {}
     
     def reverce_types(obj):
-        if isinstance(obj, sparselist):
+        if id(obj) in restored_instance_ids:
+            result_id_map[id(obj)] = restored_instance_ids[id(obj)]
+            return obj
+        elif isinstance(obj, SharedTable):
+            result_id_map[id(obj)] = int(obj.__class__.__name__[len('__serial_id_'):])
+            return obj
+        elif isinstance(obj, SharedLog):
+            if id(obj) not in result_id_map:
+                result_id_map[id(obj)] = int(obj.__class__.__name__[len('__serial_id_'):])
+                for index in range(len(obj)):
+                    obj._entries[index] = reverce_types(obj._entries[index])
+            return obj
+        elif isinstance(obj, sparselist):
             res = [reverce_types(l) for l in obj]
             result_id_map[id(res)] = int(obj.__class__.__name__[len('__serial_id_'):])
             return res
@@ -0,0 +1,308 @@
+from typing import List, Dict, Tuple, Union, Callable, Optional
+from collections import deque
+import array
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SharedLog:
+    """SharedLog
+
+    追記のみの共有ログ(maxlenを指定するとリングバッファ)
+    dumps/diffはログ全体ではなく、前回同期時のシーケンス番号以降に追記されたエントリのみを扱う
+
+    Args:
+        maxlen (int): 保持する最大エントリ数(Noneで無制限)
+        entries (list): 初期エントリ
+
+    Examples:
+
+        >>> log = SharedLog(maxlen=1000)
+        >>> cond = RunningConditions(shared_objects={'log':log})
+        >>> code = '''for i in range(10):
+        >>>     log.append({'step':i})
+        >>> '''
+        >>> runner.exec(code, cond)
+        >>> for entry in log.consume():  # 前回のconsume以降に追記されたエントリ
+        >>>     print(entry)
+
+    Note:
+        シーケンス番号は追記されたエントリの通し番号で、リングから溢れたエントリの番号も欠番にしない
+        ホストとクライアントの双方から同じ同期周期内に追記した場合は、ConflictSolvePolicyの優先側の追記のみ残る
+    """
+    def __init__(self, maxlen:Optional[int]=None, entries:Optional[list]=None):
+        self._configure(maxlen=maxlen, sequence=0)
+        if entries is not None:
+            self.extend(entries)
+
+    def _configure(self, maxlen:Optional[int], sequence:int):
+        self.maxlen = maxlen
+        self._entries = deque(maxlen=maxlen)
+        self._sequence = sequence
+        self._consumed = sequence
+
+    @property
+    def sequence(self) -> int:
+        "次に追記されるエントリのシーケンス番号(これまでに追記されたエントリ数)"
+        return self._sequence
+
+    @property
+    def first_sequence(self) -> int:
+        "保持している最も古いエントリのシーケンス番号"
+        return self._sequence - len(self._entries)
+
+    def append(self, entry:object):
+        self._entries.append(entry)
+        self._sequence += 1
+
+    def extend(self, entries:list):
+        for entry in entries:
+            self.append(entry)
+
+    def since(self, sequence:int) -> List[object]:
+        "シーケンス番号sequence以降のエントリ"
+        skip = max(sequence - self.first_sequence, 0)
+        if skip >= len(self._entries):
+            return []
+        return [self._entries[index] for index in range(skip, len(self._entries))]
+
+    def consume(self) -> List[object]:
+        "前回のconsume以降に追記されたエントリ"
+        entries = self.since(self._consumed)
+        self._consumed = self._sequence
+        return entries
+
+    def _truncate(self, sequence:int):
+        "シーケンス番号sequence以降のエントリを削除する"
+        while self._sequence > sequence and len(self._entries) > 0:
+            self._entries.pop()
+            self._sequence -= 1
+        if len(self._entries) == 0:
+            self._sequence = min(self._sequence, sequence)
+        self._consumed = min(self._consumed, self._sequence)
+
+    def _receive(self, sequence:int, entries:list, truncate:bool=False, known:Optional[int]=None):
+        """
+        シーケンス番号sequenceから始まるエントリを同期する
+
+        Note:
+            knownは差分作成時に把握していたシーケンス番号で、
+            その後にローカルで追記されたエントリは同期したエントリの後ろに追記し直す
+        """
+        local_entries = []
+        if known is not None and self._sequence > known:
+            local_entries = self.since(known)
+            self._truncate(known)
+        if truncate:
+            self._truncate(sequence)
+        for index, entry in enumerate(entries):
+            if sequence + index < self._sequence:
+                continue # 受信済み
+            if sequence + index > self._sequence: # 欠番(リングから溢れた)
+                self._entries.clear()
+                self._sequence = sequence + index
+            self.append(entry)
+        self.extend(local_entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, index):
+        return self._entries[index]
+
+    def __eq__(self, other):
+        if isinstance(other, SharedLog):
+            return self._sequence == other._sequence and list(self._entries) == list(other._entries)
+        return NotImplemented
+
+    def __str__(self):
+        return f'SharedLog(maxlen={self.maxlen},sequence={self._sequence},entries={list(self._entries)})'
+
+
+class SharedTable:
+    """SharedTable
+
+    列ごとにarray.arrayで保持する共有テーブル
+    dumps/diffは列ごとのバイナリで扱い、追記した行と変更したセルの範囲のみを同期する
+
+    Args:
+        columns (list): 列名とarrayの型コードのリスト([('x','d'),('count','q'),...])
+        rows (list): 初期行(dictまたは列順のシーケンス)
+
+    Examples:
+
+        >>> table = SharedTable([('step','q'),('value','d')])
+        >>> cond = RunningConditions(shared_objects={'table':table})
+        >>> code = '''for i in range(10):
+        >>>     table.append({'step':i, 'value':i*0.5})
+        >>> '''
+        >>> runner.exec(code, cond)
+        >>> print(table['value'])  # 列(array.array)
+        >>> print(table[3])  # 行(dict)
+
+    Note:
+        型コードは数値型のみ('b','B','h','H','i','I','l','L','q','Q','f','d')
+        クライアントからホストへの同期は、前回の同期で合意した状態からBLOCK_ROWS行単位で変更した範囲と追記した行のみを送る
+        ホストとクライアントの双方から同じ同期周期内に変更した場合は、ConflictSolvePolicyの優先側の変更と、
+        非優先側の既存の行のセルの変更のうち優先側の変更範囲と重ならないものが残る(行の追記は優先側のみ)
+    """
+    TYPECODES = ('b','B','h','H','i','I','l','L','q','Q','f','d')
+    BLOCK_ROWS = 64
+
+    def __init__(self, columns:Optional[List[Tuple[str,str]]]=None, rows:Optional[list]=None):
+        self._configure(columns if columns is not None else [])
+        if rows is not None:
+            self.extend(rows)
+
+    def _configure(self, columns:List[Tuple[str,str]]):
+        for name, typecode in columns:
+            if typecode not in SharedTable.TYPECODES:
+                raise ValueError(f'unsupported typecode {typecode} of column {name}')
+        self.columns = [(str(name), str(typecode)) for name, typecode in columns]
+        self._columns = {name:array.array(typecode) for name, typecode in self.columns}
+        self._length = 0
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.columns]
+
+    def append(self, row:Union[Dict[str,object],list,tuple]):
+        "1行追記する(dictで省略した列は0)"
+        if isinstance(row, dict):
+            values = [row.get(name, 0) for name in self.names]
+        else:
+            values = list(row)
+            if len(values) != len(self.columns):
+                raise ValueError(f'row must have {len(self.columns)} values')
+        for (name, _), value in zip(self.columns, values):
+            self._columns[name].append(value)
+        self._length += 1
+
+    def extend(self, rows:list):
+        for row in rows:
+            self.append(row)
+
+    def column(self, name:str) -> array.array:
+        "列(セルの変更はそのまま同期される)"
+        return self._columns[name]
+
+    def numpy(self, name:str):
+        "列をnumpy.ndarrayにコピーする(numpyが必要)"
+        if numpy is None:
+            raise ImportError('numpy is not installed')
+        return numpy.array(self._columns[name])
+
+    def row(self, index:int) -> Dict[str,object]:
+        return {name:self._columns[name][index] for name in self.names}
+
+    def _dump_column(self, name:str, start:int=0, stop:Optional[int]=None) -> bytes:
+        "列のstartからstopまでをリトルエンディアンのバイト列にする"
+        values = self._columns[name][start:stop]
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tobytes()
+
+    def _load_column(self, name:str, start:int, data:bytes):
+        "列のstartの位置からリトルエンディアンのバイト列dataで上書き(足りない行は追加)する"
+        column = self._columns[name]
+        values = array.array(column.typecode)
+        values.frombytes(data)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        if start > len(column):
+            column.extend(array.array(column.typecode, [0]) * (start - len(column)))
+        column[start:start+len(values)] = values
+
+    def _snapshot(self) -> 'SharedTable':
+        "列をコピーしたSharedTable"
+        snapshot = SharedTable(self.columns)
+        length = len(self)
+        for name, column in self._columns.items():
+            snapshot._columns[name] = column[:length]
+        snapshot._length = length
+        return snapshot
+
+    def _changed_ranges(self, base:'SharedTable') -> Dict[str,List[Tuple[int,int]]]:
+        "列が同じbaseから変更したBLOCK_ROWS行単位の範囲と追記した行の範囲([先頭の行, 終端の行])"
+        length, base_length = len(self), len(base)
+        common = min(length, base_length)
+        changed = {}
+        for name in self.names:
+            data = memoryview(self._columns[name]).cast('B')
+            base_data = memoryview(base._columns[name]).cast('B')
+            itemsize = self._columns[name].itemsize
+            ranges = []
+            for start in range(0, common, SharedTable.BLOCK_ROWS):
+                stop = min(start + SharedTable.BLOCK_ROWS, common)
+                if data[start*itemsize:stop*itemsize] != base_data[start*itemsize:stop*itemsize]:
+                    if len(ranges) > 0 and ranges[-1][1] == start:
+                        ranges[-1][1] = stop
+                    else:
+                        ranges.append([start, stop])
+            if length > common:
+                if len(ranges) > 0 and ranges[-1][1] == common:
+                    ranges[-1][1] = length
+                else:
+                    ranges.append([common, length])
+            if len(ranges) > 0:
+                changed[name] = [(start, stop) for start, stop in ranges]
+        return changed
+
+    def _resize(self, length:int):
+        for column in self._columns.values():
+            if len(column) > length:
+                del column[length:]
+            elif len(column) < length:
+                column.extend(array.array(column.typecode, [0]) * (length - len(column)))
+        self._length = length
+
+    def _receive(self, length:Optional[int], columns:Dict[str,List[list]], known:Optional[int]=None, schema:Optional[List[Tuple[str,str]]]=None):
+        """
+        同期した行数と列ごとの変更範囲([先頭の行, バイト列])を反映する
+
+        Note:
+            lengthがNoneの場合は行数を変えずに既存の行のセルのみ上書きする
+            knownは差分作成時に把握していた行数で、
+            その後にローカルで追記された行は同期した行の後ろに追記し直す
+        """
+        local_rows = []
+        if known is not None and schema is None and len(self) > known:
+            local_rows = [[self._columns[name][index] for name in self.names] for index in range(known, len(self))]
+        if schema is not None:
+            self._configure(schema)
+        length = len(self) if length is None else int(length)
+        self._resize(length)
+        for name, ranges in columns.items():
+            if name in self._columns:
+                for start, data in ranges:
+                    self._load_column(name, int(start), data)
+        self._resize(length)
+        self.extend(local_rows)
+
+    def __len__(self):
+        if len(self._columns) > 0:
+            return min(len(column) for column in self._columns.values())
+        return self._length
+
+    def __iter__(self):
+        return (self.row(index) for index in range(len(self)))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._columns[key]
+        return self.row(key)
+
+    def __eq__(self, other):
+        if isinstance(other, SharedTable):
+            return self.columns == other.columns and self._columns == other._columns
+        return NotImplemented
+
+    def __str__(self):
+        return f'SharedTable(columns={self.columns},rows={len(self)})'
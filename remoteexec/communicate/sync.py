@@ -1,9 +1,27 @@
 from typing import List, Dict, Tuple, Union, Callable, Optional
 import inspect
+import difflib
+import array
+import base64
+import struct
+import math
 import json
 import types
+import hashlib
+import copy
 
-from .serializer import __snippet_share__, dumps, loads
+from .serializer import __snippet_share__, dumps, loads, pointers, make_fingerprint, pack_struct, unpack_struct, is_buffer, buffer_bytes, make_buffer, received_blocks, RemoteReference, UnsirializeFunctionHook
+from .shared import SharedLog, SharedTable
+from .exceptions import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TEXT_DELTA_THRESHOLD = 4096
+TABLE_BLOCK_ROWS = SharedTable.BLOCK_ROWS
+_UNRESOLVED = object() # 参照先のインスタンスが無い(Noneと区別する)
 
 class SyncInstance:
     def __init__(self,
@@ -27,6 +45,50 @@ class SyncInstanceMember:
     def __str__(self):
         return f'SyncInstanceMember(instance_id={self.instance_id},member_name={self.member_name},value={self.value})'
 
+class SyncInstancePatch:
+    """SyncInstancePatch
+    インスタンス(member_nameがNone)またはメンバーに対する差分操作
+
+    Note:
+        patch_type='sequence'はlistの要素に対する操作列で、以下を先頭から順に適用する
+        ['insert', index, [value,...]]: indexの位置にvalueを挿入
+        ['delete', index, count]: indexの位置からcount個を削除
+        ['update', index, [value,...]]: indexの位置からvalueで上書き
+        ['move', from_index, to_index]: from_indexの要素を取り出してto_indexに挿入
+        patch_type='log'はSharedLogへの追記で、valueは以下のdict
+        {'sequence': 先頭のシーケンス番号, 'entries': [value,...], 'truncate': sequence以降を削除してから追記するか,
+         'known': 差分の作成元のシーケンス番号}
+        patch_type='text'はstrのメンバーに対する差分で、valueは{'length': 差分の作成元の文字数, 'digest': 差分の作成元のハッシュ, 'ops': [...]}
+        ['append', text]: 末尾にtextを追加
+        ['truncate', length]: lengthの長さに切り詰め
+        ['splice', offset, count, text]: offsetの位置からcount文字をtextで置き換え
+        patch_type='struct'は@snippet_structのメンバーに対する差分で、valueは以下のdict
+        {'changed': 変更したメンバーのビットマップ(base64), 'data': 変更したメンバーのみをパックしたデータ(base64)}
+        レイアウトか個別に同期するメンバーが変わった場合は
+        {'names': メンバー名, 'format': レイアウト, 'data': 全メンバーのデータ, 'skip': 個別に同期するメンバー名(省略可)}
+        patch_type='table'はSharedTableへの差分で、valueは以下のdict
+        {'known': 差分の作成元の行数, 'length': 行数, 'columns': {列名: [[先頭の行, 終端の行, リトルエンディアンのデータ(base64)],...]}}
+        列が変わった場合は'schema'に[[列名, 型コード],...]を含み、全ての列のデータを送る
+        'length'が無い場合は既存の行のセルの上書きのみ(冪等)
+        patch_type='buffer'はbytes/bytearray/memoryview/numpy.ndarrayの内容の置き換えで、valueは以下のdict
+        {'kind': 型, 'dtype': 要素の型, 'shape': 形状, 'data': 全体のデータ(base64)}
+        ブロックに分けたバッファは'data'の代わりに{'block_size': ブロックのバイト数, 'blocks': [ブロックのデータ(base64),...]}
+        変更したブロックのみの場合は{'block_size': ..., 'changed': [[ブロックの番号, ブロックのデータ(base64)],...]}(冪等)
+        dtypeとshapeが同じ可変のバッファはその場で上書きし、それ以外は参照元のメンバーを置き換える
+    """
+    def __init__(self,
+                 instance_id: int,
+                 member_name: object,
+                 patch_type: str,
+                 value: object):
+        self.instance_id = int(instance_id)
+        self.member_name = member_name
+        self.patch_type = patch_type
+        self.value = value
+
+    def __str__(self):
+        return f'SyncInstancePatch(instance_id={self.instance_id},member_name={self.member_name},patch_type={self.patch_type},value={self.value})'
+
 class SyncSharedObject:
     def __init__(self,
                  updated_member: List[SyncInstanceMember],
@@ -34,12 +96,14 @@ class SyncSharedObject:
                  deleted_member: List[SyncInstanceMember],
                  created_instance: List[SyncInstance],
                  deleted_instance: List[SyncInstance],
+                 patched_member: Optional[List[SyncInstancePatch]] = None,
                  ):
         self.updated_member = updated_member
         self.created_member = created_member
         self.deleted_member = deleted_member
         self.created_instance = created_instance
         self.deleted_instance = deleted_instance
+        self.patched_member = patched_member if patched_member is not None else []
     
     def unserialized(serialized):
         data = json.loads(serialized)
@@ -48,11 +112,13 @@ class SyncSharedObject:
         deleted_member = [SyncInstanceMember(m["instance_id"], m["member_name"], m["value"]) for m in data["deleted_member"]]
         created_instance = [SyncInstance(m["instance_id"], m["value"]) for m in data["created_instance"]]
         deleted_instance = [SyncInstance(m["instance_id"], m["value"]) for m in data["deleted_instance"]]
+        patched_member = [SyncInstancePatch(m["instance_id"], m["member_name"], m["patch_type"], m["value"]) for m in data.get("patched_member", [])]
         return SyncSharedObject(updated_member = updated_member,
                                 created_member = created_member,
                                 deleted_member = deleted_member,
                                 created_instance = created_instance,
-                                deleted_instance = deleted_instance)
+                                deleted_instance = deleted_instance,
+                                patched_member = patched_member)
     
     def serialize(self):
         # valueがシリアライズ済み文字列のため__type__が含まれるためdictなので、dumpsで二重シリアライズできない
@@ -60,7 +126,8 @@ class SyncSharedObject:
                 "created_member":[{"instance_id":m.instance_id, "member_name":m.member_name, "value":m.value} for m in self.created_member], 
                 "deleted_member":[{"instance_id":m.instance_id, "member_name":m.member_name, "value":m.value} for m in self.deleted_member], 
                 "created_instance":[{"instance_id":m.instance_id, "value":m.value} for m in self.created_instance], 
-                "deleted_instance":[{"instance_id":m.instance_id, "value":m.value} for m in self.deleted_instance]}
+                "deleted_instance":[{"instance_id":m.instance_id, "value":m.value} for m in self.deleted_instance],
+                "patched_member":[{"instance_id":m.instance_id, "member_name":m.member_name, "patch_type":m.patch_type, "value":m.value} for m in self.patched_member]}
         return json.dumps(data)
 
     def __str__(self):
@@ -68,63 +135,544 @@ class SyncSharedObject:
                'SyncSharedObject.created_member - ' + str([str(m) for m in self.created_member]) + '\n' +\
                'SyncSharedObject.deleted_member - ' + str([str(m) for m in self.deleted_member]) + '\n' +\
                'SyncSharedObject.created_instance - ' + str([str(m) for m in self.created_instance]) + '\n' +\
-               'SyncSharedObject.deleted_instance - ' + str([str(m) for m in self.deleted_instance])
+               'SyncSharedObject.deleted_instance - ' + str([str(m) for m in self.deleted_instance]) + '\n' +\
+               'SyncSharedObject.patched_member - ' + str([str(m) for m in self.patched_member])
+
+def _diff_log(before_instance_value:Dict[str,object], updated_instance_value:Dict[str,object]) -> Optional[Dict[str,object]]:
+    """
+    SharedLogインスタンスの差分を追記されたエントリにする
+
+    Note:
+        双方に含まれるシーケンス番号の範囲のエントリだけを比較するので、
+        比較のコストは前回同期時以降に追記されたエントリ数に比例する
+    """
+    before_base, before_sequence = int(before_instance_value['base']), int(before_instance_value['sequence'])
+    updated_base, updated_sequence = int(updated_instance_value['base']), int(updated_instance_value['sequence'])
+    diverge = min(before_sequence, updated_sequence)
+    for sequence in range(max(before_base, updated_base), min(before_sequence, updated_sequence)):
+        if before_instance_value['entries'][sequence-before_base] != updated_instance_value['entries'][sequence-updated_base]:
+            diverge = sequence
+            break
+    diverge = max(diverge, updated_base)
+    if diverge == before_sequence and diverge == updated_sequence:
+        return None
+    return {'sequence':diverge,
+            'entries':updated_instance_value['entries'][diverge-updated_base:],
+            'truncate':diverge < before_sequence,
+            'known':before_sequence}
+
+def _text_digest(text:str) -> str:
+    h = hashlib.blake2b(digest_size=8)
+    h.update(text.encode('utf-8', 'surrogatepass'))
+    return h.hexdigest()
+
+def _diff_text(before_member_value:Dict[str,object], updated_member_value:Dict[str,object], threshold:int) -> Optional[Dict[str,object]]:
+    """
+    長いstrのメンバーの変更を先頭(と末尾)の一致部分を除いた差分にする(差分にならない場合はNone)
+    """
+    if threshold < 0 or before_member_value.get('type') != 'native' or updated_member_value.get('type') != 'native':
+        return None
+    before_text, updated_text = before_member_value.get('value'), updated_member_value.get('value')
+    if type(before_text) is not str or type(updated_text) is not str or len(updated_text) < threshold:
+        return None
+
+    if updated_text.startswith(before_text):
+        ops = [['append', updated_text[len(before_text):]]]
+    elif before_text.startswith(updated_text):
+        ops = [['truncate', len(updated_text)]]
+    else:
+        chunk = 4096
+        length = min(len(before_text), len(updated_text))
+        prefix = 0
+        while prefix + chunk <= length and before_text[prefix:prefix+chunk] == updated_text[prefix:prefix+chunk]:
+            prefix += chunk
+        while prefix < length and before_text[prefix] == updated_text[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix + chunk <= length - prefix and \
+              before_text[len(before_text)-suffix-chunk:len(before_text)-suffix] == updated_text[len(updated_text)-suffix-chunk:len(updated_text)-suffix]:
+            suffix += chunk
+        while suffix < length - prefix and before_text[len(before_text)-suffix-1] == updated_text[len(updated_text)-suffix-1]:
+            suffix += 1
+        ops = [['splice', prefix, len(before_text)-prefix-suffix, updated_text[prefix:len(updated_text)-suffix]]]
+    if sum(len(op[-1]) for op in ops if type(op[-1]) is str) * 2 > len(updated_text):
+        return None # 差分の方が大きい
+    return {'length':len(before_text), 'digest':_text_digest(before_text), 'ops':ops}
+
+def _diff_struct(before_struct_value:Dict[str,object], updated_struct_value:Dict[str,object]) -> Optional[Dict[str,object]]:
+    """
+    @snippet_structのメンバーの変更をビットマップと変更したメンバーのみのデータにする(変更が無ければNone)
+    """
+    if before_struct_value == updated_struct_value:
+        return None
+    if before_struct_value['names'] != updated_struct_value['names'] or before_struct_value['format'] != updated_struct_value['format'] or \
+       before_struct_value.get('skip', []) != updated_struct_value.get('skip', []):
+        struct_patch = {'names':updated_struct_value['names'], 'format':updated_struct_value['format'], 'data':updated_struct_value['data']}
+        if 'skip' in updated_struct_value:
+            struct_patch['skip'] = updated_struct_value['skip']
+        return struct_patch
+    struct_format = updated_struct_value['format']
+    before_data = base64.b64decode(before_struct_value['data'])
+    updated_data = base64.b64decode(updated_struct_value['data'])
+    changed, changed_data = bytearray((len(struct_format) - 1 + 7) // 8), b''
+    offset = 0
+    for index, typecode in enumerate(struct_format[1:]):
+        size = struct.calcsize('<' + typecode)
+        if before_data[offset:offset+size] != updated_data[offset:offset+size]:
+            changed[index // 8] |= 1 << (index % 8)
+            changed_data += updated_data[offset:offset+size]
+        offset += size
+    return {'changed':base64.b64encode(bytes(changed)).decode('utf-8'), 'data':base64.b64encode(changed_data).decode('utf-8')}
+
+def _diff_table(before_instance_value:Dict[str,object], updated_instance_value:Dict[str,object]) -> Optional[Dict[str,object]]:
+    """
+    SharedTableの変更を列ごとの変更範囲(TABLE_BLOCK_ROWS行単位)と追記した行にする(変更が無ければNone)
+    """
+    if before_instance_value == updated_instance_value:
+        return None
+    value = {'known':before_instance_value['length'], 'length':updated_instance_value['length'], 'columns':{}}
+    if before_instance_value['columns'] != updated_instance_value['columns']:
+        value['schema'] = updated_instance_value['columns']
+        value['columns'] = {name:[[0, updated_instance_value['length'], data]] for name, data in updated_instance_value['data'].items()}
+        return value
+    for name, typecode in updated_instance_value['columns']:
+        if before_instance_value['data'][name] == updated_instance_value['data'][name]:
+            continue
+        itemsize = array.array(typecode).itemsize
+        before_data = base64.b64decode(before_instance_value['data'][name])
+        updated_data = base64.b64decode(updated_instance_value['data'][name])
+        common = min(len(before_data), len(updated_data))
+        block = TABLE_BLOCK_ROWS * itemsize
+        ranges = []
+        for offset in range(0, common, block):
+            stop = min(offset + block, common)
+            if before_data[offset:stop] != updated_data[offset:stop]:
+                if len(ranges) > 0 and ranges[-1][1] == offset:
+                    ranges[-1][1] = stop
+                else:
+                    ranges.append([offset, stop])
+        if len(updated_data) > common:
+            if len(ranges) > 0 and ranges[-1][1] == common:
+                ranges[-1][1] = len(updated_data)
+            else:
+                ranges.append([common, len(updated_data)])
+        if len(ranges) > 0:
+            value['columns'][name] = [[start // itemsize, stop // itemsize, base64.b64encode(updated_data[start:stop]).decode('utf-8')] for start, stop in ranges]
+    return value
+
+def _table_cells(prioritized_patch:SyncInstancePatch, unprioritized_patch:SyncInstancePatch) -> Optional[SyncInstancePatch]:
+    """
+    SharedTableの非優先側の変更のうち、既存の行のセルで優先側の変更範囲と重ならないものを上書きのみのパッチにする
+    """
+    if 'schema' in prioritized_patch.value or 'schema' in unprioritized_patch.value:
+        return None
+    known = unprioritized_patch.value['known']
+    columns = {}
+    for name, ranges in unprioritized_patch.value['columns'].items():
+        prioritized_ranges = prioritized_patch.value['columns'].get(name, [])
+        cells = [[start, stop, data] for start, stop, data in ranges
+                 if stop <= known and not any(start < p_stop and p_start < stop for p_start, p_stop, _ in prioritized_ranges)]
+        if len(cells) > 0:
+            columns[name] = cells
+    if len(columns) == 0:
+        return None
+    return SyncInstancePatch(unprioritized_patch.instance_id, None, 'table', {'columns':columns})
+
+def _buffer_blocks(prioritized_patch:SyncInstancePatch, unprioritized_patch:SyncInstancePatch) -> Optional[SyncInstancePatch]:
+    """
+    バッファの非優先側の変更したブロックのうち、優先側の変更したブロックと重ならないものを上書きのみのパッチにする
+    """
+    if 'changed' not in prioritized_patch.value or 'changed' not in unprioritized_patch.value or \
+       any(prioritized_patch.value.get(key) != unprioritized_patch.value.get(key) for key in ('kind', 'dtype', 'shape', 'block_size')):
+        return None
+    prioritized_blocks = {index for index, _ in prioritized_patch.value['changed']}
+    changed = [[index, block] for index, block in unprioritized_patch.value['changed'] if index not in prioritized_blocks]
+    if len(changed) == 0:
+        return None
+    return SyncInstancePatch(unprioritized_patch.instance_id, None, 'buffer', dict(unprioritized_patch.value, changed=changed))
+
+def _diff_buffer(before_instance_value:Dict[str,object], updated_instance_value:Dict[str,object]) -> Optional[Dict[str,object]]:
+    "ブロックに分けたバッファは変更したブロックのみ、それ以外は全体"
+    if before_instance_value == updated_instance_value:
+        return None
+    value = {key:v for key, v in updated_instance_value.items() if key != '__type__'}
+    if 'blocks' not in before_instance_value or 'blocks' not in updated_instance_value or \
+       any(before_instance_value.get(key) != updated_instance_value.get(key) for key in ('kind', 'dtype', 'shape', 'block_size')) or \
+       len(before_instance_value['blocks']) != len(updated_instance_value['blocks']):
+        return value
+    value['changed'] = [[index, updated_block] for index, (before_block, updated_block)
+                        in enumerate(zip(before_instance_value['blocks'], updated_instance_value['blocks'])) if before_block != updated_block]
+    del value['blocks']
+    return value
+
+def _diff_sequence(before_instance_value:Dict[str,object], updated_instance_value:Dict[str,object]) -> List[list]:
+    """
+    listインスタンスの要素の差分をinsert/delete/update/moveの操作列にする
+    """
+    absent = {'type':'native','value':None}
+    def _values(instance_value):
+        indexes = [int(name) for name in instance_value.keys() if not name.startswith('__')]
+        length = max(indexes) + 1 if len(indexes) > 0 else 0
+        return [instance_value.get(str(index), absent) for index in range(length)]
+    before_values = _values(before_instance_value)
+    updated_values = _values(updated_instance_value)
+    a = [json.dumps(value, sort_keys=True) for value in before_values]
+    b = [json.dumps(value, sort_keys=True) for value in updated_values]
+
+    # 先頭と末尾の一致部分はSequenceMatcherに渡さない(キューやバッファの典型的な変更はここで終わる)
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(a)-prefix and suffix < len(b)-prefix and a[len(a)-1-suffix] == b[len(b)-1-suffix]:
+        suffix += 1
+
+    ops, deleted = [], []
+    matcher = difflib.SequenceMatcher(None, a[prefix:len(a)-suffix], b[prefix:len(b)-suffix], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        i1, i2, j1, j2 = i1+prefix, i2+prefix, j1+prefix, j2+prefix
+        if tag == 'equal':
+            continue
+        if tag == 'replace' and i2-i1 == j2-j1:
+            ops.append(['update', j1, updated_values[j1:j2]])
+            deleted.append(None)
+            continue
+        if tag == 'delete' or tag == 'replace':
+            ops.append(['delete', j1, i2-i1])
+            deleted.append(a[i1:i2])
+        if tag == 'insert' or tag == 'replace':
+            ops.append(['insert', j1, updated_values[j1:j2]])
+            deleted.append(None)
+
+    # 1要素の削除と同じ値の挿入が続く場合は移動にまとめる
+    merged_ops = []
+    index = 0
+    while index < len(ops):
+        if index+1 < len(ops) and \
+           ops[index][0] == 'delete' and ops[index][2] == 1 and \
+           ops[index+1][0] == 'insert' and len(ops[index+1][2]) == 1 and \
+           deleted[index][0] == json.dumps(ops[index+1][2][0], sort_keys=True):
+            merged_ops.append(['move', ops[index][1], ops[index+1][1]])
+            index += 2
+        else:
+            merged_ops.append(ops[index])
+            index += 1
+    return merged_ops
     
-def diff(before_shared_object_serial:object, updated_shared_object_serial:object) -> SyncSharedObject:
+def diff(before_shared_object_serial:object, updated_shared_object_serial:object, text_delta_threshold:int=TEXT_DELTA_THRESHOLD) -> SyncSharedObject:
     before_instance = before_shared_object_serial['instance']
     updated_instance = updated_shared_object_serial['instance']
+    before_fingerprint = before_shared_object_serial.get('fingerprint')
+    updated_fingerprint = updated_shared_object_serial.get('fingerprint')
 
     updated_member = []
     created_member = []
     deleted_member = []
     created_instance = []
     deleted_instance = []
+    patched_member = []
 
-    for cur_instance_id, cur_instance_value in before_instance.items():
-        if cur_instance_id not in updated_instance:
-            deleted_instance.append(SyncInstance(cur_instance_id, cur_instance_value))
-        elif cur_instance_value != updated_instance[cur_instance_id]:
-            if cur_instance_value['__type__'] == 'dict':
-                for cur_member_name, cur_member_value in zip(cur_instance_value['keys'], cur_instance_value['values']):
-                    if cur_member_name not in updated_instance[cur_instance_id]['keys']:
-                        deleted_member.append(SyncInstanceMember(cur_instance_id, cur_member_name, cur_member_value))
-                    else:
-                        cur_member_value_index = -1
-                        for index in range(len(updated_instance[cur_instance_id]['values'])):
-                            if updated_instance[cur_instance_id]['keys'][index] == cur_member_name:
-                                cur_member_value_index = index
-                                break
-                        if cur_member_value_index >= 0:
-                            if cur_member_value != updated_instance[cur_instance_id]['values'][cur_member_value_index]:
-                                updated_member.append(SyncInstanceMember(cur_instance_id, cur_member_name, updated_instance[cur_instance_id]['values'][cur_member_value_index]))
-                for upd_member_name, upd_member_value in zip(updated_instance[cur_instance_id]['keys'], updated_instance[cur_instance_id]['values']):
-                    if upd_member_name not in cur_instance_value['keys']:
-                        created_member.append(SyncInstanceMember(cur_instance_id, upd_member_name, upd_member_value))
-            else:
-                for cur_member_name, cur_member_value in cur_instance_value.items():
-                    if cur_member_name not in updated_instance[cur_instance_id]:
-                        deleted_member.append(SyncInstanceMember(cur_instance_id, cur_member_name, cur_member_value))
-                    elif cur_member_value != updated_instance[cur_instance_id][cur_member_name]:
-                        updated_member.append(SyncInstanceMember(cur_instance_id, cur_member_name, updated_instance[cur_instance_id][cur_member_name]))
-                for upd_member_name, upd_member_value in updated_instance[cur_instance_id].items():
-                    if upd_member_name not in cur_instance_value:
-                        created_member.append(SyncInstanceMember(cur_instance_id, upd_member_name, upd_member_value))
-    for upd_instance_id, upd_instance_value in updated_instance.items():
-        if upd_instance_id not in before_instance:
-            created_instance.append(SyncInstance(upd_instance_id, upd_instance_value))
+    def _diff_member(cur_instance_id, cur_member_name, cur_member_value, upd_member_value):
+        text_patch = _diff_text(cur_member_value, upd_member_value, text_delta_threshold)
+        if text_patch is not None:
+            patched_member.append(SyncInstancePatch(cur_instance_id, cur_member_name, 'text', text_patch))
+        else:
+            updated_member.append(SyncInstanceMember(cur_instance_id, cur_member_name, upd_member_value))
+
+    def _diff_instance(cur_instance_id, cur_instance_value, upd_instance_value):
+        if cur_instance_value['__type__'] == 'remote' or upd_instance_value['__type__'] == 'remote':
+            pass # 内容を送っていないインスタンスは比較しない(空のインスタンスとして扱うと全てのメンバーが削除になる)
+        elif cur_instance_value['__type__'] == 'buffer' and upd_instance_value['__type__'] == 'buffer':
+            buffer_patch = _diff_buffer(cur_instance_value, upd_instance_value)
+            if buffer_patch is not None:
+                patched_member.append(SyncInstancePatch(cur_instance_id, None, 'buffer', buffer_patch))
+        elif cur_instance_value['__type__'] == 'table' and upd_instance_value['__type__'] == 'table':
+            table_patch = _diff_table(cur_instance_value, upd_instance_value)
+            if table_patch is not None:
+                patched_member.append(SyncInstancePatch(cur_instance_id, None, 'table', table_patch))
+        elif cur_instance_value['__type__'] == 'log' and upd_instance_value['__type__'] == 'log':
+            log_patch = _diff_log(cur_instance_value, upd_instance_value)
+            if log_patch is not None:
+                patched_member.append(SyncInstancePatch(cur_instance_id, None, 'log', log_patch))
+        elif cur_instance_value['__type__'] == 'list' and upd_instance_value['__type__'] == 'list':
+            sequence_ops = _diff_sequence(cur_instance_value, upd_instance_value)
+            if len(sequence_ops) > 0:
+                patched_member.append(SyncInstancePatch(cur_instance_id, None, 'sequence', sequence_ops))
+        elif cur_instance_value['__type__'] == 'dict':
+            for cur_member_name, cur_member_value in zip(cur_instance_value['keys'], cur_instance_value['values']):
+                if cur_member_name not in upd_instance_value['keys']:
+                    deleted_member.append(SyncInstanceMember(cur_instance_id, cur_member_name, cur_member_value))
+                else:
+                    cur_member_value_index = -1
+                    for index in range(len(upd_instance_value['values'])):
+                        if upd_instance_value['keys'][index] == cur_member_name:
+                            cur_member_value_index = index
+                            break
+                    if cur_member_value_index >= 0:
+                        if cur_member_value != upd_instance_value['values'][cur_member_value_index]:
+                            _diff_member(cur_instance_id, cur_member_name, cur_member_value, upd_instance_value['values'][cur_member_value_index])
+            for upd_member_name, upd_member_value in zip(upd_instance_value['keys'], upd_instance_value['values']):
+                if upd_member_name not in cur_instance_value['keys']:
+                    created_member.append(SyncInstanceMember(cur_instance_id, upd_member_name, upd_member_value))
+        else:
+            if '__struct__' in cur_instance_value and '__struct__' in upd_instance_value:
+                struct_patch = _diff_struct(cur_instance_value['__struct__'], upd_instance_value['__struct__'])
+                if struct_patch is not None:
+                    patched_member.append(SyncInstancePatch(cur_instance_id, '__struct__', 'struct', struct_patch))
+            for cur_member_name, cur_member_value in cur_instance_value.items():
+                if cur_member_name == '__struct__':
+                    continue
+                if cur_member_name not in upd_instance_value:
+                    deleted_member.append(SyncInstanceMember(cur_instance_id, cur_member_name, cur_member_value))
+                elif cur_member_value != upd_instance_value[cur_member_name]:
+                    _diff_member(cur_instance_id, cur_member_name, cur_member_value, upd_instance_value[cur_member_name])
+            for upd_member_name, upd_member_value in upd_instance_value.items():
+                if upd_member_name not in cur_instance_value and upd_member_name != '__struct__':
+                    created_member.append(SyncInstanceMember(cur_instance_id, upd_member_name, upd_member_value))
+
+    if unchanged(before_shared_object_serial, updated_shared_object_serial):
+        pass
+    elif before_fingerprint is not None and updated_fingerprint is not None:
+        # 部分木のハッシュが一致するインスタンスは参照先も含めて比較しない
+        rootid = updated_shared_object_serial['object']
+        changed_instance_ids = []
+        visited = set()
+        tovisit = [rootid]
+        while len(tovisit) > 0:
+            upd_instance_id = tovisit.pop()
+            if upd_instance_id in visited or upd_instance_id not in updated_instance:
+                continue
+            visited.add(upd_instance_id)
+            if upd_instance_id in before_fingerprint and \
+               upd_instance_id in updated_fingerprint and \
+               before_fingerprint[upd_instance_id][1] == updated_fingerprint[upd_instance_id][1]:
+                continue
+            changed_instance_ids.append(upd_instance_id)
+            tovisit.extend(pointers(updated_instance[upd_instance_id])[::-1])
+
+        for cur_instance_id, cur_instance_value in before_instance.items():
+            if cur_instance_id not in updated_instance:
+                deleted_instance.append(SyncInstance(cur_instance_id, cur_instance_value))
+        for upd_instance_id in changed_instance_ids:
+            if upd_instance_id in before_instance:
+                if upd_instance_id in before_fingerprint and \
+                   upd_instance_id in updated_fingerprint and \
+                   before_fingerprint[upd_instance_id][0] == updated_fingerprint[upd_instance_id][0]:
+                    continue
+                _diff_instance(upd_instance_id, before_instance[upd_instance_id], updated_instance[upd_instance_id])
+        for upd_instance_id, upd_instance_value in updated_instance.items():
+            if upd_instance_id not in before_instance:
+                created_instance.append(SyncInstance(upd_instance_id, upd_instance_value))
+    else:
+        for cur_instance_id, cur_instance_value in before_instance.items():
+            if cur_instance_id not in updated_instance:
+                deleted_instance.append(SyncInstance(cur_instance_id, cur_instance_value))
+            elif cur_instance_value != updated_instance[cur_instance_id]:
+                _diff_instance(cur_instance_id, cur_instance_value, updated_instance[cur_instance_id])
+        for upd_instance_id, upd_instance_value in updated_instance.items():
+            if upd_instance_id not in before_instance:
+                created_instance.append(SyncInstance(upd_instance_id, upd_instance_value))
 
     return SyncSharedObject(updated_member = updated_member,
                             created_member = created_member,
                             deleted_member = deleted_member,
                             created_instance = created_instance,
-                            deleted_instance = deleted_instance)
+                            deleted_instance = deleted_instance,
+                            patched_member = patched_member)
+
+def root_fingerprint(shared_object_serial:object) -> Optional[List[object]]:
+    """
+    ルートのインスタンスIDと部分木のハッシュを返す(フィンガープリントが無ければNone)
+    """
+    fingerprint = shared_object_serial.get('fingerprint')
+    rootid = shared_object_serial.get('object')
+    if fingerprint is None or rootid not in fingerprint:
+        return None
+    return [rootid, fingerprint[rootid][1]]
+
+def expand_tables(shared_object_serial:object, base_shared_object_serial:object) -> List[int]:
+    """
+    dumpsのtable_sinceで変更範囲のみにしたSharedTableを、合意した状態base_shared_object_serialから全体のデータに戻す
+
+    Returns:
+        List[int]: 合意した状態と基準が異なり、全体のデータを送り直してもらうSharedTableのインスタンスID
+
+    Note:
+        変更範囲のみのSharedTableは'data'の代わりに、合意した状態の行数'since'と
+        列毎の変更範囲'ranges'({列名: [[先頭の行, 終端の行, リトルエンディアンのデータ(base64)],...]})を持つ
+        基準が異なるSharedTableは合意した状態(無ければ内容を送っていないインスタンス)に置き換え、今回の変更は全体を受け取った時に反映する
+    """
+    base_instance = base_shared_object_serial.get('instance', {})
+    resend = []
+    for instanceid, instancevalue in shared_object_serial.get('instance', {}).items():
+        if instancevalue.get('__type__') != 'table' or 'ranges' not in instancevalue:
+            continue
+        base_value = base_instance.get(instanceid)
+        if base_value is None or base_value.get('__type__') != 'table' or 'data' not in base_value:
+            shared_object_serial['instance'][instanceid] = {'__type__':'remote'}
+            resend.append(instanceid)
+            continue
+        if base_value['columns'] != instancevalue['columns'] or int(base_value['length']) != int(instancevalue['since']):
+            shared_object_serial['instance'][instanceid] = copy.deepcopy(base_value)
+            resend.append(instanceid)
+            continue
+        table = SharedTable(instancevalue['columns'])
+        table._receive(int(base_value['length']), {name:[[0, base64.b64decode(data)]] for name, data in base_value['data'].items()})
+        table._receive(int(instancevalue['length']), {name:[[int(start), base64.b64decode(data)] for start, _, data in ranges]
+                                                      for name, ranges in instancevalue['ranges'].items()})
+        del instancevalue['since'], instancevalue['ranges']
+        instancevalue['data'] = {name:base64.b64encode(table._dump_column(name)).decode('utf-8') for name in table.names}
+    if len(resend) > 0 and 'fingerprint' in shared_object_serial:
+        shared_object_serial['fingerprint'] = make_fingerprint(shared_object_serial['instance'])
+    return resend
+
+def unchanged(before_shared_object_serial:object, updated_shared_object_serial:object) -> bool:
+    """
+    フィンガープリントのルートの部分木ハッシュのみで変更が無いかを判定する
+
+    Note:
+        フィンガープリントが無い場合はFalse(変更有りとみなす)
+    """
+    before_root = root_fingerprint(before_shared_object_serial)
+    return before_root is not None and before_root == root_fingerprint(updated_shared_object_serial)
+
+class FloatDeadband:
+    """FloatDeadband
+    floatのメンバーの微小な変化をホストからクライアントへの同期で抑制する設定
+
+    Args:
+        deadband (float): 前回同期した値からの変化がこの値未満なら同期しない(0で無効)
+        quantize (float): 同期する値をこの幅に丸める(0で無効)
+        paths (dict): メンバーのパスごとの(deadband, quantize)
+
+    Note:
+        パスはルートからのメンバー名(dictはキー)を'.'で連結したもので、
+        最も長く一致するパスの設定を、そのメンバーと配下のメンバーに適用する
+        抑制した変化は前回同期した値からの変化が閾値を超えた時、または最後の同期でまとめて同期する
+        listの要素とSharedLogのエントリは対象外
+    """
+    def __init__(self,
+                 deadband: float = 0.,
+                 quantize: float = 0.,
+                 paths: Optional[Dict[str,Tuple[float,float]]] = None):
+        self.deadband = float(deadband)
+        self.quantize = float(quantize)
+        self.paths = {k:(float(v[0]), float(v[1])) for k,v in paths.items()} if paths is not None else {}
+
+    @staticmethod
+    def unserialized(serialized):
+        return FloatDeadband(deadband=serialized['deadband'], quantize=serialized['quantize'], paths=serialized['paths'])
+
+    def serialize(self):
+        return {'deadband':self.deadband, 'quantize':self.quantize, 'paths':{k:list(v) for k,v in self.paths.items()}}
+
+    def setting(self, path:Optional[str]) -> Tuple[float,float]:
+        if path is not None:
+            names = path.split('.')
+            for length in range(len(names), 0, -1):
+                prefix = '.'.join(names[:length])
+                if prefix in self.paths:
+                    return self.paths[prefix]
+        return self.deadband, self.quantize
+
+    def __str__(self):
+        return f'FloatDeadband(deadband={self.deadband},quantize={self.quantize},paths={self.paths})'
+
+def _instance_paths(shared_object_serial:object) -> Dict[int,str]:
+    "ルートから辿ったインスタンスのパス"
+    rootid = shared_object_serial['object']
+    instances = shared_object_serial['instance']
+    paths, stack = {rootid:''}, [rootid]
+    while len(stack) > 0:
+        instance_id = stack.pop()
+        instance_value = instances.get(instance_id)
+        if type(instance_value) is not dict:
+            continue
+        if 'keys' in instance_value:
+            members = [(k.get('value'), v) for k,v in zip(instance_value['keys'], instance_value['values'])]
+        else:
+            members = [(k, v) for k,v in instance_value.items() if k != '__type__' and type(v) is dict]
+        for member_name, member_value in members:
+            if member_value.get('type') == 'pointer' and member_value['value'] not in paths:
+                paths[member_value['value']] = f'{paths[instance_id]}.{member_name}' if paths[instance_id] != '' else f'{member_name}'
+                stack.append(member_value['value'])
+    return paths
+
+def _member_value(instance_value:Dict[str,object], member_name:object) -> Optional[Dict[str,object]]:
+    if 'keys' in instance_value:
+        if member_name in instance_value['keys']:
+            return instance_value['values'][instance_value['keys'].index(member_name)]
+        return None
+    return instance_value.get(member_name)
+
+def deadband(sync_object:SyncSharedObject, base_shared_object_serial:object, float_deadband:FloatDeadband) -> Tuple[SyncSharedObject,List[SyncInstanceMember]]:
+    """
+    base_shared_object_serialからの変更のうち、floatのメンバーの不感帯未満の変化を除き、量子化する
+
+    Args:
+        sync_object (SyncSharedObject): base_shared_object_serialからの変更
+        base_shared_object_serial (object): 変更を適用する側のシリアライズデータ
+        float_deadband (FloatDeadband): 不感帯と量子化の設定
+
+    Returns:
+        (抑制後の変更, 変更後のシリアライズデータとは異なる値で同期したメンバー)
+
+    Note:
+        2つ目の戻り値は、同期済みの状態として保持するシリアライズデータにupdate_serialで反映する
+    """
+    paths = _instance_paths(base_shared_object_serial) if len(float_deadband.paths) > 0 else {}
+    updated_member, synced_member = [], []
+    for member in sync_object.updated_member:
+        base_instance = base_shared_object_serial['instance'].get(member.instance_id)
+        base_value = _member_value(base_instance, member.member_name) if type(base_instance) is dict else None
+        if type(base_value) is not dict or base_value.get('type') != 'native' or member.value.get('type') != 'native' or\
+           type(member.value.get('value')) is not float or type(base_value.get('value')) not in (float, int):
+            updated_member.append(member)
+            continue
+        path = None
+        if member.instance_id in paths:
+            name = member.member_name.get('value') if type(member.member_name) is dict else member.member_name
+            path = f'{paths[member.instance_id]}.{name}' if paths[member.instance_id] != '' else f'{name}'
+        band, quantum = float_deadband.setting(path)
+        value = member.value['value']
+        if quantum > 0 and math.isfinite(value):
+            value = round(value / quantum) * quantum
+        if value == base_value['value'] or abs(value - base_value['value']) < band:
+            synced_member.append(SyncInstanceMember(member.instance_id, member.member_name, base_value))
+            continue
+        synced_value = {'type':'native', 'value':value}
+        updated_member.append(SyncInstanceMember(member.instance_id, member.member_name, synced_value))
+        if value != member.value['value']:
+            synced_member.append(SyncInstanceMember(member.instance_id, member.member_name, synced_value))
+    return SyncSharedObject(updated_member = updated_member,
+                            created_member = sync_object.created_member,
+                            deleted_member = sync_object.deleted_member,
+                            created_instance = sync_object.created_instance,
+                            deleted_instance = sync_object.deleted_instance,
+                            patched_member = sync_object.patched_member), synced_member
+
+def update_serial(shared_object_serial:object, members:List[SyncInstanceMember]):
+    """
+    シリアライズデータのメンバーの値を書き換え、フィンガープリントを作り直す
+    """
+    if len(members) == 0:
+        return
+    for member in members:
+        instance_value = shared_object_serial['instance'][member.instance_id]
+        if 'keys' in instance_value:
+            instance_value['values'][instance_value['keys'].index(member.member_name)] = member.value
+        else:
+            instance_value[member.member_name] = member.value
+    if 'fingerprint' in shared_object_serial:
+        shared_object_serial['fingerprint'] = make_fingerprint(shared_object_serial['instance'])
 
 def marge(prioritized_object:SyncSharedObject, unprioritized_object:SyncSharedObject) -> SyncSharedObject:
     dest = SyncSharedObject(updated_member = [c for c in prioritized_object.updated_member],
                             created_member = [c for c in prioritized_object.created_member],
                             deleted_member = [c for c in prioritized_object.deleted_member],
                             created_instance = [c for c in prioritized_object.created_instance],
-                            deleted_instance = [c for c in prioritized_object.deleted_instance])
+                            deleted_instance = [c for c in prioritized_object.deleted_instance],
+                            patched_member = [c for c in prioritized_object.patched_member])
     toadd_updated_member, toadd_created_member = [], []
     for upd_member in unprioritized_object.updated_member:
         has_same = False
@@ -201,19 +749,104 @@ def marge(prioritized_object:SyncSharedObject, unprioritized_object:SyncSharedOb
                 break
         if not has_same:
             dest.deleted_instance.append(upd_instance)
+
+    # パッチは適用順序に依存するので、同じインスタンス・メンバーへの変更があれば優先側のみ残す
+    def _overlap(instance_id_a, member_name_a, instance_id_b, member_name_b):
+        return instance_id_a == instance_id_b and (member_name_a is None or member_name_b is None or member_name_a == member_name_b)
+    prioritized_changes = [(m.instance_id, m.member_name) for m in prioritized_object.updated_member + prioritized_object.created_member + prioritized_object.deleted_member] +\
+                          [(m.instance_id, m.member_name) for m in prioritized_object.patched_member] +\
+                          [(m.instance_id, None) for m in prioritized_object.deleted_instance]
+    for upd_patch in unprioritized_object.patched_member:
+        has_same = False
+        for instance_id, member_name in prioritized_changes:
+            if _overlap(instance_id, member_name, upd_patch.instance_id, upd_patch.member_name):
+                has_same = True
+                break
+        if not has_same:
+            dest.patched_member.append(upd_patch)
+        elif upd_patch.patch_type == 'table':
+            # SharedTableは優先側と重ならないセルの変更を残す
+            for p in prioritized_object.patched_member:
+                if p.patch_type == 'table' and p.instance_id == upd_patch.instance_id:
+                    cells = _table_cells(p, upd_patch)
+                    if cells is not None:
+                        dest.patched_member.append(cells)
+                    break
+        elif upd_patch.patch_type == 'buffer':
+            # ブロックに分けたバッファは優先側と重ならないブロックの変更を残す
+            for p in prioritized_object.patched_member:
+                if p.patch_type == 'buffer' and p.instance_id == upd_patch.instance_id:
+                    blocks = _buffer_blocks(p, upd_patch)
+                    if blocks is not None:
+                        dest.patched_member.append(blocks)
+                    break
+    if len(prioritized_object.patched_member) > 0:
+        prioritized_members = {id(m) for m in prioritized_object.updated_member + prioritized_object.created_member + prioritized_object.deleted_member}
+        for instance in [dest.updated_member, dest.created_member, dest.deleted_member]:
+            instance[:] = [m for m in instance if id(m) in prioritized_members or
+                           not any(_overlap(p.instance_id, p.member_name, m.instance_id, m.member_name) for p in prioritized_object.patched_member)]
     
     return dest
 
+def rebase(sync_object:SyncSharedObject, applied_object:SyncSharedObject, current_shared_object_serial:object, target_shared_object_serial:object) -> SyncSharedObject:
+    """
+    適用済みの変更(applied_object)を含むsync_objectから、現在の状態に適用する変更を作る
+
+    Args:
+        sync_object (SyncSharedObject): margeした変更
+        applied_object (SyncSharedObject): 既に現在の状態に反映されている変更
+        current_shared_object_serial (object): 現在の状態のシリアライズデータ
+        target_shared_object_serial (object): sync_objectのパッチの変更後のシリアライズデータ
+
+    Note:
+        パッチは冪等ではないので、適用済みのパッチは除き、
+        適用済みの変更と同じ対象のパッチは現在の状態からの差分に作り直す
+    """
+    applied_patches = {id(p) for p in applied_object.patched_member}
+    applied_keys = [(p.instance_id, p.member_name) for p in applied_object.patched_member] +\
+                   [(m.instance_id, m.member_name) for m in applied_object.updated_member]
+    patched_member, updated_member = [], []
+    for patch in sync_object.patched_member:
+        if id(patch) in applied_patches:
+            continue
+        if (patch.instance_id, patch.member_name) not in applied_keys or\
+           (patch.patch_type == 'table' and 'length' not in patch.value) or\
+           (patch.patch_type == 'buffer' and 'changed' in patch.value):
+            patched_member.append(patch)
+            continue
+        current_instance = current_shared_object_serial['instance'].get(patch.instance_id)
+        target_instance = target_shared_object_serial['instance'].get(patch.instance_id)
+        if current_instance is None or target_instance is None:
+            continue
+        rebased = diff({'object':patch.instance_id, 'instance':{patch.instance_id:current_instance}},
+                       {'object':patch.instance_id, 'instance':{patch.instance_id:target_instance}})
+        patched_member.extend([p for p in rebased.patched_member if p.member_name == patch.member_name])
+        updated_member.extend([m for m in rebased.updated_member if m.member_name == patch.member_name])
+    return SyncSharedObject(updated_member = sync_object.updated_member + updated_member,
+                            created_member = sync_object.created_member,
+                            deleted_member = sync_object.deleted_member,
+                            created_instance = sync_object.created_instance,
+                            deleted_instance = sync_object.deleted_instance,
+                            patched_member = patched_member)
+
 class ApplyInstance:
     def __init__(self, obj:object, parent:object, nameofparent:str):
         self.obj = obj
         self.parent = parent
         self.nameofparent = nameofparent
 
-def apply_unsirial(target_object:object, sync_object:object, idmap_target_object:Optional[dict[int,int]]=None):
+def apply_unsirial(target_object:object, sync_object:object, idmap_target_object:Optional[dict[int,int]]=None, function_hook:Optional[UnsirializeFunctionHook]=None,
+                   unapplied:Optional[list]=None):
+    """
+    Note:
+        strの差分(patch_type='text')の作成元が適用先の値と異なる場合は、unappliedに[インスタンスID, メンバー名]を追加する
+        (unappliedがNoneならAttributeCannotUpdateError)
+    """
 
     def _id(obj):
-        if idmap_target_object is not None and id(obj) in idmap_target_object:
+        if type(obj) is RemoteReference:
+            return obj.__remote_id__
+        elif idmap_target_object is not None and id(obj) in idmap_target_object:
             return int(idmap_target_object[id(obj)])
         return id(obj)
 
@@ -221,9 +854,17 @@ def apply_unsirial(target_object:object, sync_object:object, idmap_target_object
         _out_instance = {}
         def _list(obj, parent, nameofparent, depth):
             d, e, f = None, None, None
+            if type(obj) is RemoteReference:
+                if obj.__remote_target__ is None:
+                    return # 取得していないインスタンスへの変更は無い
+                obj = obj.__remote_target__
             if _id(obj) not in _out_instance:
                 if obj is None or isinstance(obj, int) or isinstance(obj, float) or isinstance(obj, str):
                     pass
+                elif isinstance(obj, SharedTable) or is_buffer(obj):
+                    d = {}
+                elif isinstance(obj, SharedLog):
+                    d = {str(obj.first_sequence+key):value for key,value in enumerate(obj)}
                 elif isinstance(obj, list) or isinstance(obj, tuple) or isinstance(obj, set):
                     d = {str(key):value for key,value in enumerate(obj)}
                 elif isinstance(obj, dict):
@@ -296,7 +937,7 @@ def apply_unsirial(target_object:object, sync_object:object, idmap_target_object
             new_instance_serial_instance[old_instance_id] = {'__type__':'object'}
     for created_instance in sync_object.created_instance:
         new_instance_serial = {'object':created_instance.instance_id, 'instance':new_instance_serial_instance}
-        new_instance_unserial = loads(new_instance_serial)
+        new_instance_unserial = loads(new_instance_serial, function_hook=function_hook)
         new_instance[created_instance.instance_id] = ApplyInstance(new_instance_unserial, None, None)
         new_out_instance = _listup_instance(new_instance_unserial)
         for new_out_id in new_out_instance.keys():
@@ -305,25 +946,193 @@ def apply_unsirial(target_object:object, sync_object:object, idmap_target_object
                     if new_out.parent is not None:
                         new_out.parent.__setattr__(new_out.nameofparent, out_instance[new_out_id][0].obj)
 
+    def _update_instances(instance_id):
+        if instance_id in out_instance:
+            return out_instance[instance_id]
+        elif instance_id in new_instance:
+            return [new_instance[instance_id]]
+        return []
+
+    def _update_value(value, unresolved=None):
+        if value['type'] == 'pointer':
+            if value['value'] in out_instance:
+                return out_instance[value['value']][0].obj
+            elif value['value'] in new_instance:
+                return new_instance[value['value']].obj
+        elif value['type'] == 'native':
+            return value['value']
+        return unresolved
+
+    def _apply_sequence(obj, ops):
+        for op in ops:
+            position = min(max(int(op[1]), 0), len(obj))
+            if op[0] == 'insert':
+                obj[position:position] = [_update_value(v) for v in op[2]]
+            elif op[0] == 'delete':
+                del obj[position:position+int(op[2])]
+            elif op[0] == 'update':
+                for index, v in enumerate(op[2]):
+                    update_value = _update_value(v, unresolved=_UNRESOLVED)
+                    if update_value is not _UNRESOLVED and position+index < len(obj):
+                        obj[position+index] = update_value
+            elif op[0] == 'move':
+                if position < len(obj):
+                    moved = obj.pop(position)
+                    obj.insert(min(max(int(op[2]), 0), len(obj)), moved)
+            else:
+                raise AttributeCannotUpdateError()
+
+    def _apply_text(text, value):
+        if type(text) is not str or len(text) != int(value['length']) or ('digest' in value and _text_digest(text) != value['digest']):
+            return None # 差分の作成元と異なる
+        for op in value['ops']:
+            if op[0] == 'append':
+                text = text + op[1]
+            elif op[0] == 'truncate':
+                text = text[:int(op[1])]
+            elif op[0] == 'splice':
+                text = text[:int(op[1])] + op[3] + text[int(op[1])+int(op[2]):]
+            else:
+                raise AttributeCannotUpdateError()
+        return text
+
+    def _unapplied(patched_member):
+        if unapplied is None:
+            raise AttributeCannotUpdateError()
+        unapplied.append([patched_member.instance_id, patched_member.member_name])
+
+    def _apply_struct(obj, value):
+        if 'changed' not in value:
+            names, values = value['names'], unpack_struct(value['format'], value['data'])
+            skip = value.get('skip', [])
+            names, values = [n for n in names if n not in skip], [v for n, v in zip(names, values) if n not in skip]
+        else:
+            layout = getattr(type(obj), '__snippet_struct__', None)
+            if layout is None:
+                raise AttributeCannotUpdateError()
+            changed = base64.b64decode(value['changed'])
+            indexes = [index for index in range(len(layout[0])) if index // 8 < len(changed) and changed[index // 8] & (1 << (index % 8))]
+            names = [layout[0][index] for index in indexes]
+            values = unpack_struct('<' + ''.join(layout[1][1+index] for index in indexes), value['data'])
+        for name, v in zip(names, values):
+            try:
+                obj.__setattr__(name, v)
+            except Exception:
+                raise AttributeCannotUpdateError()
+
+    def _apply_buffer(update_instance, value):
+        obj = update_instance.obj
+        # その場で上書きできるバッファのバイト列
+        target = None
+        if isinstance(obj, bytearray) and value['kind'] == 'bytearray':
+            target = memoryview(obj)
+        elif isinstance(obj, memoryview) and value['kind'] == 'memoryview' and not obj.readonly and obj.c_contiguous and \
+             obj.format == value['dtype'] and list(obj.shape) == list(value['shape']):
+            target = obj.cast('B')
+        elif numpy is not None and isinstance(obj, numpy.ndarray) and value['kind'] == 'ndarray' and obj.flags.writeable and \
+             obj.flags.c_contiguous and obj.dtype.str == value['dtype'] and list(obj.shape) == list(value['shape']):
+            target = memoryview(obj.reshape(-1)).cast('B')
+        if 'changed' in value:
+            if target is None:
+                if not is_buffer(obj):
+                    raise AttributeCannotUpdateError()
+                data = bytearray(obj if isinstance(obj, (bytes, bytearray)) else obj.tobytes())
+            else:
+                data = target
+            block_size = int(value['block_size'])
+            for index, block in value['changed']:
+                block = base64.b64decode(block)
+                offset = int(index) * block_size
+                if offset + len(block) > len(data):
+                    raise AttributeCannotUpdateError()
+                data[offset:offset+len(block)] = block
+            if target is not None:
+                received_blocks(obj, block_size, value['changed'])
+                return
+        else:
+            data = buffer_bytes(value)
+            if isinstance(obj, bytearray) and value['kind'] == 'bytearray':
+                target.release()
+                obj[:] = data
+                received_blocks(obj)
+                return
+            elif target is not None and len(data) == target.nbytes:
+                target[:] = data
+                received_blocks(obj)
+                return
+        # 不変またはdtype/shapeが変わったバッファは参照元のメンバーを置き換える
+        replaced, parent, name = make_buffer(value['kind'], value['dtype'], value['shape'], data), update_instance.parent, update_instance.nameofparent
+        if parent is None or isinstance(parent, (tuple, set)):
+            raise AttributeCannotUpdateError()
+        elif isinstance(parent, list):
+            parent[int(name)] = replaced
+        elif isinstance(parent, dict):
+            parent[name] = replaced
+        else:
+            try:
+                parent.__setattr__(name, replaced)
+            except Exception:
+                raise AttributeCannotUpdateError()
+        update_instance.obj = replaced
+
+    for patched_member in sync_object.patched_member:
+        for update_instance in _update_instances(patched_member.instance_id):
+            if patched_member.patch_type == 'buffer':
+                _apply_buffer(update_instance, patched_member.value)
+            elif patched_member.patch_type == 'table':
+                if isinstance(update_instance.obj, SharedTable):
+                    update_instance.obj._receive(patched_member.value.get('length'),
+                                                 {name:[[int(start), base64.b64decode(data)] for start, _, data in ranges]
+                                                  for name, ranges in patched_member.value['columns'].items()},
+                                                 known=patched_member.value.get('known'),
+                                                 schema=patched_member.value.get('schema'))
+                else:
+                    raise AttributeCannotUpdateError()
+            elif patched_member.patch_type == 'struct':
+                _apply_struct(update_instance.obj, patched_member.value)
+            elif patched_member.patch_type == 'text':
+                if isinstance(update_instance.obj, dict):
+                    if type(patched_member.member_name) is dict and patched_member.member_name.get('type') == 'native':
+                        key = patched_member.member_name['value']
+                        text = _apply_text(update_instance.obj.get(key), patched_member.value)
+                        if text is not None:
+                            update_instance.obj[key] = text
+                        else:
+                            _unapplied(patched_member)
+                elif not isinstance(update_instance.obj, (list, set, tuple)):
+                    text = _apply_text(getattr(update_instance.obj, patched_member.member_name, None), patched_member.value)
+                    if text is not None:
+                        try:
+                            update_instance.obj.__setattr__(patched_member.member_name, text)
+                        except Exception:
+                            raise AttributeCannotUpdateError()
+                    else:
+                        _unapplied(patched_member)
+                else:
+                    raise AttributeCannotUpdateError()
+            elif patched_member.patch_type == 'log':
+                if isinstance(update_instance.obj, SharedLog):
+                    update_instance.obj._receive(int(patched_member.value['sequence']),
+                                                 [_update_value(v) for v in patched_member.value['entries']],
+                                                 truncate=bool(patched_member.value.get('truncate', False)),
+                                                 known=patched_member.value.get('known'))
+                else:
+                    raise AttributeCannotUpdateError()
+            elif patched_member.patch_type == 'sequence':
+                if isinstance(update_instance.obj, list):
+                    _apply_sequence(update_instance.obj, patched_member.value)
+                else:
+                    raise AttributeCannotUpdateError()
+            else:
+                raise AttributeCannotUpdateError()
+
     for created_member in sync_object.created_member + sync_object.updated_member:
-        update_instances = []
-        if created_member.instance_id in out_instance:
-            update_instances = out_instance[created_member.instance_id]
-        elif created_member.instance_id in new_instance:
-            update_instances = [new_instance[created_member.instance_id]]
-
-        update_value = None
-        if created_member.value['type'] == 'pointer':
-            if created_member.value['value'] in out_instance:
-                update_value = out_instance[created_member.value['value']][0].obj
-            elif created_member.value['value'] in new_instance:
-                update_value = new_instance[created_member.value['value']].obj
-        elif created_member.value['type'] == 'native':
-            update_value = created_member.value['value']
+        update_instances = _update_instances(created_member.instance_id)
+        update_value = _update_value(created_member.value)
 
         for update_instance in update_instances:
-            if update_instance is None or update_value is None:
-                pass
+            if update_instance is None or (update_value is None and created_member.value.get('type') != 'native'):
+                pass # 参照先のインスタンスが無い
             elif isinstance(update_instance.obj, list):
                 position = int(created_member.member_name)
                 if position >= len(update_instance.obj):
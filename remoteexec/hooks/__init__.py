@@ -1,15 +1,20 @@
 __all__ = ['HookTarget',
            'HookBase',
+           'HookSignal',
            'LoopHookType',
            'LoopHook',
            'CounterLoopHook',
            'TimeoutLoopHook',
            'FrequencyLoopHook',
+           'FrequencyStats',
            'StepErrorApproach',
+           'StepBackend',
            'StepHook',
            'StepErrorHook',
            'StepTargetHook',
-           'StepEvalHook' ]
+           'StepEvalHook',
+           'HookSampling' ]
 from .hookbase import *
 from .loophook import *
 from .stephook import *
+from .sampling import *
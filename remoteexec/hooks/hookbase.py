@@ -1,7 +1,16 @@
+from enum import Enum
 from typing import List
 
 from ..exceptions import *
 
+class HookSignal(Enum):
+    """HookSignal
+    フック関数の戻り値で実行環境に送る信号
+    DETACH: このフック関数をこの実行の間はもう呼び出さない(全て外れたHookの呼び出しは止める)
+    """
+    DETACH = 1
+
+
 class HookTarget:
     """HookTarget
     フック関数を定義するターゲットのコード
@@ -13,6 +22,7 @@ class HookTarget:
 class HookBase:
     """HookBase
     実行コードに対して定義されるフック関数
+    StepHookとLoopHookのhookはHookSignal.DETACHを返すと、以後呼び出されない
     """
     def __init__(self, targets:List[HookTarget]):
         pass
@@ -1,5 +1,6 @@
 from enum import Enum
-from typing import List
+from typing import List, Dict, Optional
+import bisect
 import time
 
 from ..exceptions import *
@@ -68,42 +69,91 @@ class TimeoutLoopHook(LoopHook):
             self.last_time[id] = 0
 
 
+class FrequencyStats:
+    """FrequencyStats
+    FrequencyLoopHookの1つのループの周期の統計
+
+    Args:
+        bins (list): ジッタのヒストグラムの区切り(秒)
+
+    Note:
+        ジッタは周期の期限から実際にループが再開するまでの遅れ(秒)
+        histogram[i]はbins[i-1]<=ジッタ<bins[i]の回数で、histogram[-1]はbins[-1]以上の回数
+        overrunsはループの処理が周期に間に合わなかった回数
+    """
+    BINS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01)
+
+    def __init__(self, bins:Optional[List[float]]=None):
+        self.bins = list(bins if bins is not None else FrequencyStats.BINS)
+        self.histogram = [0] * (len(self.bins) + 1)
+        self.count = 0
+        self.overruns = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+
+    def record(self, jitter:float, overrun:bool):
+        self.count += 1
+        if overrun:
+            self.overruns += 1
+        self.total_jitter += jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        self.histogram[bisect.bisect_right(self.bins, jitter)] += 1
+
+    @property
+    def mean_jitter(self) -> float:
+        return self.total_jitter / self.count if self.count > 0 else 0.0
+
+    def __str__(self):
+        return f'FrequencyStats(count={self.count},overruns={self.overruns},mean_jitter={self.mean_jitter},max_jitter={self.max_jitter})'
+
+
 class FrequencyLoopHook(LoopHook):
     """FrequencyLoopHook
     ループ実行周波数でループを制御するフック関数
+
+    Args:
+        loops (list): 周波数を制御するループ
+        frequency (float): ループの実行周波数
+        spin_threshold (float): 周期の期限の前にsleepせずにビジーウェイトする時間(秒)
+        bins (list): ジッタのヒストグラムの区切り(秒)
+
+    Note:
+        time.monotonic_nsで周期の期限を絶対時刻で決めるので、sleepの誤差が蓄積しない
+        期限までの時間の内spin_thresholdまではsleepし、残りはビジーウェイトする(0なら全てsleep)
+        1周期以上遅れた場合は、遅れを取り戻すために連続で実行せず、その時点から周期を数え直す
+        ループ毎の周期の統計はstats(ループのid毎のFrequencyStats)で参照できる
     """
-    def __init__(self, loops:List[HookTarget], frequency:float=0.0):
+    def __init__(self, loops:List[HookTarget], frequency:float=0.0, spin_threshold:float=0.001, bins:Optional[List[float]]=None):
         super().__init__(loops=loops)
         self.counter = {l.id:0 for l in loops}
-        self.avgruntime = {l.id:[0,0] for l in loops}
-        self.befruntime = {l.id:0 for l in loops}
-        self.unittime = 1.0 / frequency
+        self.deadline = {l.id:0 for l in loops}
+        self.stats = {l.id:FrequencyStats(bins) for l in loops}
+        self.unittime_ns = int(1_000_000_000 / frequency) if frequency > 0 else 0
+        self.spin_threshold_ns = int(spin_threshold * 1_000_000_000)
         self.all_loops = loops
 
     def hook(self, id:int, lineno:int):
         def _hook():
-            if self.befruntime[id] > 0:
-                delta = time.time() - self.befruntime[id]
-                if delta < 0:
-                    raise SnippetLoopTimeout()
-                self.avgruntime[id][0] = self.avgruntime[id][0] * 0.99 + delta
-                self.avgruntime[id][1] = self.avgruntime[id][1] * 0.99 + 1.0
-                average = self.avgruntime[id][0] / self.avgruntime[id][1]
-                if self.counter[id] > 100:
-                    sleeptime = self.unittime - average
-                else:
-                    sleeptime = self.unittime - delta
-                if sleeptime > 0:
-                    time.sleep(sleeptime)
+            now = time.monotonic_ns()
+            deadline = self.deadline[id]
+            if deadline > 0 and self.unittime_ns > 0:
+                overrun = now > deadline
+                if not overrun:
+                    sleeptime = deadline - now - self.spin_threshold_ns
+                    if sleeptime > 0:
+                        time.sleep(sleeptime / 1_000_000_000)
+                    now = time.monotonic_ns()
+                    while now < deadline:
+                        now = time.monotonic_ns()
+                self.stats[id].record((now - deadline) / 1_000_000_000, overrun)
+                if now - deadline < self.unittime_ns:
+                    now = deadline
             self.counter[id] += 1
-            self.befruntime[id] = time.time()
-        return _hook() if id in self.avgruntime else super().hook(id=id, lineno=lineno)
+            self.deadline[id] = now + self.unittime_ns
+        return _hook() if id in self.deadline else super().hook(id=id, lineno=lineno)
     
     def clear_loop(self, id:int):
         if id in self.counter:
             self.counter[id] = 0
-        if id in self.avgruntime:
-            self.avgruntime[id][0] = 0
-            self.avgruntime[id][1] = 0
-        if id in self.befruntime:
-            self.befruntime[id] = 0
+        if id in self.deadline:
+            self.deadline[id] = 0
@@ -0,0 +1,75 @@
+from typing import Callable, Optional
+import random
+import math
+import sys
+import time
+
+
+class HookSampling:
+    """HookSampling
+    Hookを呼び出すイベントを間引くサンプリング方針
+
+    Args:
+        every (int): every回のイベント毎に1回呼び出す
+        interval (float): 前回呼び出してからinterval秒以上経ったイベントのみ呼び出す
+        probability (float): probabilityの確率で呼び出す
+        seed (int): probabilityの乱数のシード
+
+    Examples:
+
+        >>> sampling = HookSampling(every=100)  # 1, 101, 201...回目のイベントのみ
+        >>> feature = RunningWithSteppingCheck(prefix_hook_class=MyPrefixHook, sampling=sampling)
+        >>> sampling = HookSampling(interval=0.5)  # 0.5秒に1回まで
+        >>> sampling = HookSampling(probability=0.01)  # 1%のイベント
+
+    Note:
+        複数指定した場合は全ての条件を満たすイベントのみ呼び出す
+        everyとprobabilityは次に呼び出すまでのイベント数を予め決めるので、間引いたイベントはカウンターのチェックのみ
+        (intervalを指定すると呼び出す候補のイベントで時刻をチェックする)
+    """
+    def __init__(self,
+                 every:int=1,
+                 interval:float=0.,
+                 probability:float=1.,
+                 seed:Optional[int]=None):
+        assert every >= 1, "every must be 1 or more"
+        assert 0 <= probability <= 1, "probability must be between 0 and 1"
+        self.every = every
+        self.interval = interval
+        self.probability = probability
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        return {'every':self.every, 'interval':self.interval, 'probability':self.probability, 'seed':self.seed}
+
+    def sampler(self) -> Callable[[], bool]:
+        """
+        イベント毎に呼び出してHookを呼び出すかを返す判定関数(実行毎に新しく作る)
+        """
+        every, interval, probability = self.every, self.interval, self.probability
+        random_state = random.Random(self.seed)
+
+        def next_count() -> int:
+            if probability >= 1:
+                return every
+            if probability <= 0:
+                return sys.maxsize
+            # 次に当たるまでの外れの回数(幾何分布)
+            failures = int(math.log(1.0 - random_state.random()) / math.log(1.0 - probability))
+            return every * (failures + 1)
+
+        countdown = 1 if probability >= 1 else next_count()
+        next_time = 0.
+        def sample() -> bool:
+            nonlocal countdown, next_time
+            countdown -= 1
+            if countdown > 0:
+                return False
+            countdown = next_count()
+            if interval > 0:
+                now = time.monotonic()
+                if now < next_time:
+                    return False
+                next_time = now + interval
+            return True
+        return sample
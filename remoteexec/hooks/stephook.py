@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List, Callable, Optional
+from typing import List, Dict, Callable, Optional
 import time
 
 from ..exceptions import *
@@ -15,6 +15,16 @@ class StepErrorApproach(Enum):
     IGNORE_AND_BREAK = 4
 
 
+class StepBackend(Enum):
+    """StepBackend
+    1ステップ毎のHookの実装方法
+    AST: 各文をHookの呼び出しとtry/exceptで囲むようにASTを変形する
+    MONITORING: sys.monitoring(Python 3.12以降)のLINEとRAISEのイベントでHookを呼び出す
+    """
+    AST = 1
+    MONITORING = 2
+
+
 class StepHook(HookBase):
     """StepHook
     一行毎の実行フック関数の基底クラス
@@ -58,3 +68,8 @@ class StepEvalHook(StepHook):
     def hook(self, id:int, lineno:int, name:str, value:Optional[object]):
         pass
 
+    def hook_values(self, id:int, lineno:int, values:Dict[str,Optional[object]]):
+        "1ステップでチェックした変数の値をまとめて受け取る(上書きしなければ変数毎にhookを呼び出す)"
+        for name, value in values.items():
+            self.hook(id=id, lineno=lineno, name=name, value=value)
+
@@ -75,19 +75,36 @@ class SocketReciever(CommunicationInterface):
         self.sync_hook = sync_hook
         self.runner = None
         self.running_thread = None
+        self.contents = {}
 
     def init_share_object(self, share_object):
         self.shared_object = share_object['shared']
         self.feature_hooks = share_object['hooks']
 
+    def has_content(self, key:str) -> bool:
+        content = SnippetRunnerLocal.code_cache.get_source(key)
+        if content is not None:
+            self.contents[key] = content
+        return content is not None
+
+    def init_contents(self, contents:Dict[str,str]):
+        for key, content in contents.items():
+            SnippetRunnerLocal.code_cache.put_source(content)
+            self.contents[key] = content
+
     def init_configure_object(self, configure_object):
-        self.sourcecodestr = configure_object['cond']['sourcecodestr']
+        self.sourcecodestr = configure_object['cond'].get('sourcecodestr', None)
+        if self.sourcecodestr is None:
+            # アップロード済みまたはキャッシュ済みのコード
+            self.sourcecodestr = self.contents[configure_object['cond']['sourcecodehash']]
         self.total_timeout_sec = configure_object['cond']['total_timeout_sec']
         self.dynamic_import = configure_object['cond']['dynamic_import']
         self.allow_global_functions = configure_object['cond']['allow_global_functions']
         self.allow_import_modules = configure_object['cond']['allow_import_modules']
 
         features = configure_object['features']
+        # サンプリングで間引いたイベントはクライアントに送らない
+        sampling = HookSampling(**features['hook_sampling']) if features.get('hook_sampling') is not None else None
 
         class MyLoopHook(LoopHook):
             def hook(self, id:int, lineno:int):
@@ -103,12 +120,13 @@ class SocketReciever(CommunicationInterface):
                                                         max_outer_loop_count=features['max_outer_loop_count'],
                                                         max_inner_loop_count=features['max_inner_loop_count'],
                                                         includes_comp_loop=features['includes_comp_loop'],
-                                                        forced_execution_mode=features['forced_execution_mode'])
+                                                        forced_execution_mode=features['forced_execution_mode'],
+                                                        sampling=sampling)
             if self.feature_hooks['loop_hook'] is not None:
                 loophookfeature.extra_hooks.append(MyLoopHook())
             self.running_features.append(loophookfeature)
         elif self.feature_hooks['loop_hook'] is not None:
-            self.running_features.append(RunningWithLoopHook(MyLoopHook))
+            self.running_features.append(RunningWithLoopHook(MyLoopHook, sampling=sampling))
 
         if self.feature_hooks['step_prefix_hook'] is not None or\
            self.feature_hooks['step_postfix_hook'] is not None or\
@@ -124,7 +142,9 @@ class SocketReciever(CommunicationInterface):
                     return StepErrorApproach(self.feature_hooks['error_hook'].hook(id=id, lineno=lineno))
             self.running_features.append(RunningWithSteppingCheck(prefix_hook_class=MyPrefixHook if self.feature_hooks['step_prefix_hook'] is not None else None,
                                                                   postfix_hook_class=MyPostfixHook if self.feature_hooks['step_postfix_hook'] is not None else None,
-                                                                  error_hook_class=MyErrorHook if self.feature_hooks['error_hook'] is not None else None))
+                                                                  error_hook_class=MyErrorHook if self.feature_hooks['error_hook'] is not None else None,
+                                                                  sampling=sampling,
+                                                                  backend=StepBackend(features.get('step_backend', StepBackend.AST.value))))
 
     def start_command(self):
         self.runner = SnippetRunnerLocal()
@@ -161,6 +181,13 @@ class SocketReciever(CommunicationInterface):
             return self.running_thread.is_alive()
         return self.runner is None
 
+    def compile_function(self, source:str) -> Optional[Callable]:
+        cond = RunningConditions(total_timeout_sec=self.total_timeout_sec,
+                                 dynamic_import=self.dynamic_import,
+                                 allow_global_functions=self.allow_global_functions,
+                                 allow_import_modules=self.allow_import_modules)
+        return SnippetRunnerLocal().compile_function(source, cond)
+
     def stop(self):
         pass
 
@@ -1,21 +1,30 @@
 from typing import List, Dict, Tuple, Union, Callable, Optional, Callable
 from enum import Enum
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from logging import getLogger
 from subprocess import PIPE, Popen
 import warnings
+import hashlib
+import marshal
+import pickle
+import json
+import types
+import sys
+import os
 import socket
 import signal
 import threading
 import ctypes
 import time
 import copy
+import heapq
 import ast
 
 from .exceptions import *
 from .hooks import *
 from .runnerfeature import *
 from .communicate import *
+from .communicate.communicator import content_hash
 
 COMMON_BUILTINS = ['abs','all','any','bin','bool','bytearray','bytes','callable',
                    'chr','classmethod','complex','delattr','dict','divmod','enumerate',
@@ -87,7 +96,11 @@ class SnippetRunner:
                  sync_frequency:float = -1,
                  sync_conflict_policy:ConflictSolvePolicy = ConflictSolvePolicy.HOST_PRIORITIZED,
                  sync_snippet_share_only:bool = True,
-                 sync_shared_depth:int = -1):
+                 sync_shared_depth:int = -1,
+                 sync_float_deadband:Optional[FloatDeadband] = None,
+                 sync_remote_reference_depth:Optional[int] = None,
+                 sync_remote_reference_size:Optional[int] = None,
+                 sync_remote_prefetch_depth:int = 1):
         assert sum([local_run,docker_run,tcp_run])==1, 'local_run,docker_run,tcp_run must only one True'
         self.local_run = local_run
         self.docker_run = docker_run
@@ -99,6 +112,10 @@ class SnippetRunner:
         self.sync_conflict_policy = sync_conflict_policy
         self.sync_snippet_share_only = sync_snippet_share_only
         self.sync_shared_depth = sync_shared_depth
+        self.sync_float_deadband = sync_float_deadband
+        self.sync_remote_reference_depth = sync_remote_reference_depth
+        self.sync_remote_reference_size = sync_remote_reference_size
+        self.sync_remote_prefetch_depth = sync_remote_prefetch_depth
     """SnippetRunner
 
     コードの動的実行を行うクラス
@@ -114,6 +131,10 @@ class SnippetRunner:
         sync_conflict_policy (ConflictSolvePolicy): 同期ポリシー
         sync_snippet_share_only (bool): @snippet_shareのみ同期
         sync_shared_depth (bool): 同期オブジェクトの再帰深さ
+        sync_float_deadband (FloatDeadband): floatのメンバーの同期の不感帯と量子化(パスはshared_objectsからのパス)
+        sync_remote_reference_depth (int): shared_objectsの各オブジェクトからこの深さより深いインスタンスは、アクセスするまで送らない
+        sync_remote_reference_size (int): 要素数がこの数より多いインスタンスは、アクセスするまで送らない
+        sync_remote_prefetch_depth (int): アクセスしたインスタンスと一緒に送る深さ
     """
 
     def exec(self,
@@ -129,7 +150,9 @@ class SnippetRunner:
              loop_hook:Optional[SnippetLoopHook]=None,
              step_prefix_hook:Optional[SnippetStepHook]=None,
              step_postfix_hook:Optional[SnippetStepHook]=None,
-             error_hook:Optional[SnippetStepErrorHook]=None):
+             error_hook:Optional[SnippetStepErrorHook]=None,
+             hook_sampling:Optional[HookSampling]=None,
+             step_backend:StepBackend=StepBackend.AST):
         """
         指定されたコードを実行する
 
@@ -147,6 +170,8 @@ class SnippetRunner:
             step_prefix_hook (SnippetStepHook): 1ステップ実行される度に呼び出されるHook
             step_postfix_hook (SnippetStepHook): 1ステップ実行される度に呼び出されるHook
             error_hook (SnippetStepErrorHook): 実行時Exceptionがraiseした時に呼び出されるHook
+            hook_sampling (HookSampling): loop_hook、step_prefix_hook、step_postfix_hookを呼び出すイベントのサンプリング
+            step_backend (StepBackend): step_prefix_hook、step_postfix_hook、error_hookの実装方法
 
         Note:
             error_hookを指定した場合、エラーハンドリングに例外処理を使うので、
@@ -157,13 +182,15 @@ class SnippetRunner:
             StepErrorApproach.RAISE_ERROR: SnippetStepError例外を送出
             StepErrorApproach.IGNORE_AND_CONTINUE: 無視してその場から強引に実行を継続
             StepErrorApproach.IGNORE_AND_BREAK: コードブロックの終わりに移動して実行を継続
+            step_backendがStepBackend.MONITORINGの場合、IGNORE_AND_CONTINUEとIGNORE_AND_BREAKはRAISE_ERRORとして扱う
+            local_runでは、loop_hook、step_prefix_hook、step_postfix_hookはHookSignal.DETACHを返すと以後呼び出されない
         """
         if self.local_run:
             running_features = []
 
             class MyLoopHook(LoopHook):
                 def hook(self, id:int, lineno:int):
-                    loop_hook.hook(id=id, lineno=lineno)
+                    return loop_hook.hook(id=id, lineno=lineno)
                 def clear_loop(self, id:int):
                     loop_hook.clear_loop(id=id)
 
@@ -174,28 +201,31 @@ class SnippetRunner:
                                                             max_outer_loop_count=max_outer_loop_count,
                                                             max_inner_loop_count=max_inner_loop_count,
                                                             includes_comp_loop=includes_comp_loop,
-                                                            forced_execution_mode=forced_execution_mode)
+                                                            forced_execution_mode=forced_execution_mode,
+                                                            sampling=hook_sampling)
                 if loop_hook is not None:
                     loophookfeature.extra_hooks.append(MyLoopHook([loop_hook]))
                 running_features.append(loophookfeature)
             elif loop_hook is not None:
-                running_features.append(RunningWithLoopHook([MyLoopHook]))
+                running_features.append(RunningWithLoopHook([MyLoopHook], sampling=hook_sampling))
 
             if step_prefix_hook is not None or\
             step_postfix_hook is not None or\
             error_hook is not None:
                 class MyPrefixHook(StepHook):
                     def hook(self, id:int, lineno:int):
-                        step_prefix_hook.hook(id=id, lineno=lineno)
+                        return step_prefix_hook.hook(id=id, lineno=lineno)
                 class MyPostfixHook(StepHook):
                     def hook(self, id:int, lineno:int):
-                        step_postfix_hook.hook(id=id, lineno=lineno)
+                        return step_postfix_hook.hook(id=id, lineno=lineno)
                 class MyErrorHook(StepErrorHook):
                     def hook(self, id:int, lineno:int) -> StepErrorApproach:
                         return StepErrorApproach(error_hook.hook(id=id, lineno=lineno))
                 running_features.append(RunningWithSteppingCheck(prefix_hook_class=MyPrefixHook if step_prefix_hook is not None else None,
                                                                 postfix_hook_class=MyPostfixHook if step_postfix_hook is not None else None,
-                                                                error_hook_class=MyErrorHook if error_hook is not None else None))
+                                                                error_hook_class=MyErrorHook if error_hook is not None else None,
+                                                                sampling=hook_sampling,
+                                                                backend=step_backend))
 
             runner = SnippetRunnerLocal()
             runner.exec(code,
@@ -232,7 +262,10 @@ class SnippetRunner:
                     self.task.wait()
             
             connection = DockerCommunicationIO()
-            runner = SnippetRunnerRemote(connection=connection, sync_frequency=self.sync_frequency)
+            runner = SnippetRunnerRemote(connection=connection, sync_frequency=self.sync_frequency, sync_float_deadband=self.sync_float_deadband,
+                                         sync_remote_reference_depth=self.sync_remote_reference_depth,
+                                         sync_remote_reference_size=self.sync_remote_reference_size,
+                                         sync_remote_prefetch_depth=self.sync_remote_prefetch_depth)
             runner.exec(code, cond)
         elif self.run_tcp:
             tcp_hostname, tcp_port = self.tcp_hostname, self.tcp_port
@@ -255,7 +288,10 @@ class SnippetRunner:
                     self.socket.close()
             
             connection = SocketCommunicationIO()
-            runner = SnippetRunnerRemote(connection=connection, sync_frequency=self.sync_frequency)
+            runner = SnippetRunnerRemote(connection=connection, sync_frequency=self.sync_frequency, sync_float_deadband=self.sync_float_deadband,
+                                         sync_remote_reference_depth=self.sync_remote_reference_depth,
+                                         sync_remote_reference_size=self.sync_remote_reference_size,
+                                         sync_remote_prefetch_depth=self.sync_remote_prefetch_depth)
             runner.exec(code, cond)
 
     def run_local():
@@ -264,70 +300,419 @@ class SnippetRunner:
                    sync_frequency:float = 5,
                    sync_conflict_policy:ConflictSolvePolicy = ConflictSolvePolicy.HOST_PRIORITIZED,
                    sync_snippet_share_only:bool = True,
-                   sync_shared_depth:int = -1):
+                   sync_shared_depth:int = -1,
+                   sync_float_deadband:Optional[FloatDeadband] = None,
+                   sync_remote_reference_depth:Optional[int] = None,
+                   sync_remote_reference_size:Optional[int] = None,
+                   sync_remote_prefetch_depth:int = 1):
         return SnippetRunner(docker_run=True,
                              docker_command=['docker', 'run', '-i', 'remoteexec:latest', 'python','-u', 'server.py'],
                              sync_frequency=sync_frequency,
                              sync_conflict_policy=sync_conflict_policy,
                              sync_snippet_share_only=sync_snippet_share_only,
-                             sync_shared_depth=sync_shared_depth)
+                             sync_shared_depth=sync_shared_depth,
+                             sync_float_deadband=sync_float_deadband,
+                             sync_remote_reference_depth=sync_remote_reference_depth,
+                             sync_remote_reference_size=sync_remote_reference_size,
+                             sync_remote_prefetch_depth=sync_remote_prefetch_depth)
     def run_tcp(tcp_hostname:str,
                 tcp_port:int=9165,
                 sync_frequency:float = 5,
                 sync_conflict_policy:ConflictSolvePolicy = ConflictSolvePolicy.HOST_PRIORITIZED,
                 sync_snippet_share_only:bool = True,
-                sync_shared_depth:int = -1):
+                sync_shared_depth:int = -1,
+                sync_float_deadband:Optional[FloatDeadband] = None,
+                sync_remote_reference_depth:Optional[int] = None,
+                sync_remote_reference_size:Optional[int] = None,
+                sync_remote_prefetch_depth:int = 1):
         return SnippetRunner(tcp_run=True,
                              tcp_hostname=tcp_hostname,
                              tcp_port=tcp_port,
                              sync_frequency=sync_frequency,
                              sync_conflict_policy=sync_conflict_policy,
                              sync_snippet_share_only=sync_snippet_share_only,
-                             sync_shared_depth=sync_shared_depth)
+                             sync_shared_depth=sync_shared_depth,
+                             sync_float_deadband=sync_float_deadband,
+                             sync_remote_reference_depth=sync_remote_reference_depth,
+                             sync_remote_reference_size=sync_remote_reference_size,
+                             sync_remote_prefetch_depth=sync_remote_prefetch_depth)
 
 
-class SnippetRunnerLocal:
+class SnippetCodeCache:
+    """SnippetCodeCache
+
+    Featureで変形してコンパイルした実行コードのLRUキャッシュ
+    キーは実行コード、dynamic_import、Featureのクラスとtree_key()のハッシュで、
+    コードオブジェクトと各Featureのtransform_treeのデータを保持する
+
+    Args:
+        maxsize (int): メモリに保持する最大件数(0でキャッシュしない)
+        cache_dir (str): 指定するとディスクにも保存し、サーバーを再起動しても使える
+
+    Note:
+        cache_dirのファイルはmarshal/pickleで読み込むので、信頼できるディレクトリのみ指定する事
+        hits/missesでヒット数とミス数を参照できる
+        put_source/get_sourceでcontent_hashをキーに実行コードも保持し、リモート実行でアップロード済みのコードを再利用する
+    """
+    def __init__(self, maxsize:int=128, cache_dir:Optional[str]=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self,
+            code:str,
+            cond:RunningConditions,
+            features:List[RunningFeatureBase]) -> Optional[str]:
+        """
+        キャッシュのキー(キャッシュできないFeatureを含む場合はNone)
+        """
+        feature_keys = []
+        for feature in features:
+            tree_key = feature.tree_key()
+            if tree_key is None or type(feature).update_tree is not RunningFeatureBase.update_tree:
+                return None
+            feature_keys.append([f'{type(feature).__module__}.{type(feature).__qualname__}', feature.rank, list(tree_key)])
+        return hashlib.sha256(json.dumps([code, bool(cond.dynamic_import), feature_keys]).encode('utf-8')).hexdigest()
+
+    def _path(self, key:str) -> str:
+        # バイトコードはPythonのバージョン毎
+        return os.path.join(self.cache_dir, f'{key}.{sys.implementation.cache_tag}.snippet')
+
+    def get(self, key:str) -> Optional[Tuple[types.CodeType,List[object]]]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        entry = None
+        if self.cache_dir is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    code_data, tree_data = pickle.load(f)
+                entry = (marshal.loads(code_data), tree_data)
+            except Exception:
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._put_memory(key, entry)
+        return entry
+
+    def put(self, key:str, code:types.CodeType, tree_data:List[object]):
+        entry = (code, tree_data)
+        self._put_memory(key, entry)
+        if self.cache_dir is not None:
+            try:
+                temp_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}'
+                with open(temp_path, 'wb') as f:
+                    pickle.dump((marshal.dumps(code), tree_data), f)
+                os.replace(temp_path, self._path(key))
+            except Exception as e:
+                warnings.warn(f'cannot write snippet code cache - {e}')
+
+    def _put_memory(self, key:str, entry:Tuple[types.CodeType,List[object]]):
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def put_source(self, code:str) -> str:
+        """
+        実行コードを保持してcontent_hashのキーを返す
+        """
+        key = content_hash(code)
+        self._put_source_memory(key, code)
+        if self.cache_dir is not None:
+            try:
+                temp_path = f'{self._source_path(key)}.{os.getpid()}.{threading.get_ident()}'
+                with open(temp_path, 'w', encoding='utf-8', newline='') as f:
+                    f.write(code)
+                os.replace(temp_path, self._source_path(key))
+            except Exception as e:
+                warnings.warn(f'cannot write snippet source cache - {e}')
+        return key
+
+    def get_source(self, key:str) -> Optional[str]:
+        with self._lock:
+            if key in self._sources:
+                self._sources.move_to_end(key)
+                return self._sources[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._source_path(key), 'r', encoding='utf-8', newline='') as f:
+                code = f.read()
+        except Exception:
+            return None
+        if content_hash(code) != key:
+            return None
+        self._put_source_memory(key, code)
+        return code
+
+    def _source_path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.py')
+
+    def _put_source_memory(self, key:str, code:str):
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._sources[key] = code
+            self._sources.move_to_end(key)
+            while len(self._sources) > self.maxsize:
+                self._sources.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sources.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SnippetTimeoutService:
+    """SnippetTimeoutService
+
+    プロセス全体で共有する実行タイムアウトの監視
+    1つの監視スレッドが全ての期限をヒープで管理し、期限が来たスレッドにSnippetAbortExceptionを送出する
+
+    Examples:
+
+        >>> service = SnippetTimeoutService()
+        >>> handle = service.start(threading.get_ident(), 0.5)
+        >>> try:
+        >>>     ...  # 0.5秒後にSnippetAbortExceptionが送出される
+        >>> finally:
+        >>>     service.cancel(handle)
+
+    Note:
+        監視スレッドは最初のstartで起動し、期限が無い間は待機するだけでポーリングしない
+        例外はPyThreadState_SetAsyncExcで送出するので、sleepなどのブロッキング中のスレッドは戻るまで中断できない
+        cancelは期限が過ぎて送出済みで、まだ配送されていない例外を取り消す
+        取り消した期限はヒープに残し、ヒープの半分を超えたらまとめて取り除く
+    """
     def __init__(self):
+        self._heap = []
+        self._cancelled = 0
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self, thread_id:int, timeout_sec:float) -> list:
+        """
+        thread_idのスレッドの期限をtimeout_sec秒後に設定する
+
+        Returns:
+            cancelに渡すハンドル
+        """
+        with self._condition:
+            handle = [time.monotonic() + timeout_sec, self._sequence, thread_id, False, False] # 期限、順番、スレッド、取消済み、送出済み
+            self._sequence += 1
+            heapq.heappush(self._heap, handle)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='SnippetTimeoutService', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return handle
+
+    def cancel(self, handle:list):
+        "期限を取り消す"
+        with self._condition:
+            if handle[3]:
+                return
+            handle[3] = True
+            if handle[4]:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(handle[2]), None)
+                return
+            self._cancelled += 1
+            if self._cancelled * 2 > len(self._heap):
+                self._heap = [handle for handle in self._heap if not handle[3]]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap) - self._cancelled
+
+    def _run(self):
+        with self._condition:
+            while True:
+                while len(self._heap) > 0 and self._heap[0][3]:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                if len(self._heap) == 0:
+                    self._condition.wait()
+                    continue
+                wait_time = self._heap[0][0] - time.monotonic()
+                if wait_time > 0:
+                    self._condition.wait(wait_time)
+                    continue
+                handle = heapq.heappop(self._heap)
+                handle[4] = True
+                res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(handle[2]),
+                                                                 ctypes.py_object(SnippetAbortException))
+                if res > 1:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(handle[2]), None)
+
+
+class _ProhibitedNameHandler(TreeHandler):
+    "禁則チェック(__で始まる変数名は使えない)"
+    node_types = (ast.Name,)
+
+    def enter(self, node:ast.AST):
+        if node.id.startswith('__'):
+            raise SnippetProhibitionError
+
+
+class SnippetRunnerLocal:
+    def __init__(self, code_cache:Optional[SnippetCodeCache]=None, timeout_service:Optional[SnippetTimeoutService]=None):
         super().__init__()
+        if code_cache is not None:
+            self.code_cache = code_cache
+        if timeout_service is not None:
+            self.timeout_service = timeout_service
     """SnippetRunnerLocal
     コードの動的実行を行うクラス
+
+    Args:
+        code_cache (SnippetCodeCache): コンパイル済みの実行コードのキャッシュ(省略時はSnippetRunnerLocal.code_cacheを共有)
+        timeout_service (SnippetTimeoutService): メインスレッド以外で実行する時のタイムアウトの監視(省略時はSnippetRunnerLocal.timeout_serviceを共有)
+
+    Note:
+        実行環境のビルトインは許可する関数とモジュールの組み合わせ毎に一度だけ作ってキャッシュし、実行毎に浅いコピーを使う
+        メインスレッドではSIGALRMでタイムアウトし、それ以外のスレッドでは全ての実行でtimeout_serviceの監視スレッドを共有する
     """
+    code_cache = SnippetCodeCache()
+    timeout_service = SnippetTimeoutService()
+    builtins_cache = {}
+    builtins_cache_lock = threading.Lock()
 
-    def _exec(self,
-             code:str,
-             cond:RunningConditions,
-             features:Optional[List[RunningFeatureBase]]=None):
+    @classmethod
+    def warm_up(cls, cond:Optional[RunningConditions]=None):
+        """
+        実行条件のビルトインを予め作り、許可するモジュールをインポートしておく
+
+        Args:
+            cond (RunningConditions): 実行条件データ(省略時は既定の実行条件)
+
+        Examples:
+
+            >>> SnippetRunnerLocal.warm_up()  # サーバーの起動時にCOMMON_MODULESをインポートする
+        """
+        cls._cached_builtins(RunningConditions() if cond is None else cond)
+
+    def _parse(self, code:str) -> ast.AST:
         try:
             root = compile(code, '', 'exec', ast.PyCF_ONLY_AST)
         except SyntaxError as e:
             raise SnippetSyntaxError
+        return root
 
-        for leaf in ast.walk(root): # 禁則チェック
-            if type(leaf) is ast.Name:
-                if leaf.id.startswith('__'):
-                    raise SnippetProhibitionError
-        
-        def make_cleaned_builtins(allow_global_functions:List[str],
-                          allow_import_modules:List[str]) -> object:
-            global_builtins = None
-            if len(allow_global_functions) > 0:
-                module_dict = __builtins__ if type(__builtins__) is dict else __builtins__.__dict__
-                global_builtins = {name:module_dict.get(name, None) for name in allow_global_functions}
-            if len(allow_import_modules) > 0:
-                global_builtins = {} if global_builtins is None else global_builtins
-                module_dict = __builtins__ if type(__builtins__) is dict else __builtins__.__dict__
-                for modname in allow_import_modules:
-                    global_builtins[modname] = __builtins__['__import__'](modname)
-            if cond.dynamic_import:
-                global_builtins['__import__'] = __builtins__['__import__']
+    def _transform_tree(self,
+                        root:ast.AST,
+                        cond:RunningConditions,
+                        features:List[RunningFeatureBase],
+                        ext_objects:Dict[str,object]) -> List[object]:
+        """
+        禁則チェック、import文の除去、各Featureの変形を行い、Feature毎のtransform_treeのデータを返す
+
+        Note:
+            tree_handlerを持つFeatureは、連続する限り禁則チェックとimport文の除去と1回の走査にまとめる
+            update_treeを上書きしたFeatureはその順番でupdate_treeを呼び出す(データはNone)
+        """
+        tree_data = [None] * len(features)
+        handlers = [_ProhibitedNameHandler()]
+        if not cond.dynamic_import:
+            handlers.append(RunningWithoutImport().tree_handler())
+        fused = []
+        def visit_fused():
+            if len(handlers) > 0:
+                TreeTransformer(handlers).visit(root)
+                for index, handler in fused:
+                    tree_data[index] = handler.result()
+                handlers.clear()
+                fused.clear()
+
+        for index, feature in enumerate(features):
+            handler = None
+            if type(feature).transform_tree is RunningFeatureBase.transform_tree and type(feature).update_tree is RunningFeatureBase.update_tree:
+                handler = feature.tree_handler()
+            if handler is not None:
+                handlers.append(handler)
+                fused.append((index, handler))
+                continue
+            visit_fused()
+            if type(feature).update_tree is not RunningFeatureBase.update_tree:
+                feature.update_tree(root=root, ext_objects=ext_objects)
+            else:
+                tree_data[index] = feature.transform_tree(root)
+        visit_fused()
+        return tree_data
+
+    @classmethod
+    def _cached_builtins(cls, cond:RunningConditions) -> object:
+        key = (tuple(cond.allow_global_functions), tuple(cond.allow_import_modules), bool(cond.dynamic_import))
+        global_builtins = cls.builtins_cache.get(key)
+        if global_builtins is not None:
             return global_builtins
+        with cls.builtins_cache_lock:
+            if key not in cls.builtins_cache:
+                module_dict = __builtins__ if type(__builtins__) is dict else __builtins__.__dict__
+                global_builtins = None
+                if len(cond.allow_global_functions) > 0:
+                    global_builtins = {name:module_dict.get(name, None) for name in cond.allow_global_functions}
+                if len(cond.allow_import_modules) > 0:
+                    global_builtins = {} if global_builtins is None else global_builtins
+                    for modname in cond.allow_import_modules:
+                        global_builtins[modname] = module_dict['__import__'](modname)
+                if cond.dynamic_import:
+                    global_builtins['__import__'] = module_dict['__import__']
+                cls.builtins_cache[key] = global_builtins
+            return cls.builtins_cache[key]
+
+    def _make_cleaned_builtins(self, cond:RunningConditions) -> object:
+        global_builtins = self._cached_builtins(cond)
+        return None if global_builtins is None else dict(global_builtins) # 実行毎に浅いコピー
+
+    def compile_function(self,
+                         source:str,
+                         cond:RunningConditions) -> Callable:
+        """
+        関数定義のソースコードを実行コードと同じ制限でコンパイルする
+
+        Args:
+            source (str): 関数定義(def)のみのソースコード
+            cond (RunningConditions): 実行条件データ(shared_objectsは使わない)
+
+        Returns:
+            Callable: コンパイルした関数
+        """
+        root = self._parse(source)
+        if len(root.body) != 1 or type(root.body[0]) is not ast.FunctionDef or len(root.body[0].decorator_list) > 0:
+            raise SnippetProhibitionError
 
         ext_objects = {}
+        self._transform_tree(root, cond, [], ext_objects)
+        ext_objects['__builtins__'] = self._make_cleaned_builtins(cond)
 
-        if not cond.dynamic_import:
-            del_feature = RunningWithoutImport()
-            del_feature.update_tree(root=root, ext_objects=ext_objects)
+        exec(compile(root, '', 'exec'), ext_objects)
+        return ext_objects[root.body[0].name]
 
+    def _exec(self,
+             code:str,
+             cond:RunningConditions,
+             features:Optional[List[RunningFeatureBase]]=None):
         if features is None or len(features)==0:
             features = []
 
@@ -336,11 +721,28 @@ class SnippetRunnerLocal:
         for feature in run_features:
             assert feature.rank not in uniq_rank
             assert isinstance(feature, RunningFeatureBase) and feature.rank > 0
-            feature.update_tree(root=root, ext_objects=ext_objects)
             uniq_rank.add(feature.rank)
+
+        ext_objects = {}
+
+        # キャッシュ済みなら構文解析と変形を省略して、実行毎のHookのみ作り直す
+        cache_key = self.code_cache.key(code, cond, run_features)
+        cache_entry = self.code_cache.get(cache_key) if cache_key is not None else None
+        if cache_entry is None:
+            root = self._parse(code)
+            tree_data = self._transform_tree(root, cond, run_features, ext_objects)
+            compiled_code = compile(root, '', 'exec')
+            if cache_key is not None:
+                self.code_cache.put(cache_key, compiled_code, tree_data)
+        else:
+            compiled_code, tree_data = cache_entry
+        for feature, feature_tree_data in zip(run_features, tree_data):
+            if type(feature).update_tree is RunningFeatureBase.update_tree:
+                feature.bind_tree(feature_tree_data, ext_objects)
         
-        ext_objects['__builtins__'] = make_cleaned_builtins(allow_global_functions=cond.allow_global_functions,
-                                        allow_import_modules=cond.allow_import_modules)
+        bound_objects = ext_objects
+        ext_objects['__builtins__'] = self._make_cleaned_builtins(cond)
+        ext_objects['batch'] = batch # 共有オブジェクトのメソッド呼び出しをまとめて送る
         for k,v in cond.shared_objects.items():
             ext_objects[k] = v
         ext_shared = {}
@@ -353,7 +755,16 @@ class SnippetRunnerLocal:
             ext_shared = cond.force_locals
 
         self.running_feature = run_features
-        exec(compile(root, '', 'exec'), ext_objects, ext_shared)
+        entered_features = []
+        try:
+            for feature in run_features:
+                if type(feature).enter_exec is not RunningFeatureBase.enter_exec:
+                    feature.enter_exec(compiled_code, bound_objects)
+                    entered_features.append(feature)
+            exec(compiled_code, ext_objects, ext_shared)
+        finally:
+            for feature in reversed(entered_features):
+                feature.exit_exec(compiled_code, bound_objects)
 
     def exec(self,
              code:str,
@@ -397,33 +808,15 @@ class SnippetRunnerLocal:
                 return result
             except ValueError:
                 # run in thread enabled
-                the_thread_id = threading.current_thread().ident
-                the_thread_stop = threading.Event()
-                start_time = time.time()
                 result = None
-                def timeout_thread():
-                    while True:
-                        if the_thread_stop.is_set():
-                            return
-                        if start_time + timeout_sec < time.time():
-                            break
-                        time.sleep(0.01)
-                    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(the_thread_id),
-                                                        ctypes.py_object(SnippetAbortException))
-                    if res == 0:
-                        raise ValueError("thread state error")
-                    elif res != 1:
-                        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(the_thread_id), None)
-                        raise SystemError("senf exception error")
+                handle = self.timeout_service.start(threading.get_ident(), timeout_sec)
                 try:
-                    watchthread = threading.Thread(target=timeout_thread)
-                    watchthread.setDaemon(True)
-                    watchthread.start()
-                    result = self._exec(code, cond, features)
+                    try:
+                        result = self._exec(code, cond, features)
+                    finally:
+                        self.timeout_service.cancel(handle)
                 except SnippetAbortException:
                     raise SnippetTotalTimeout()
-                finally:
-                    the_thread_stop.set()
                 return result
         else:
             return self._exec(code, cond, features)
@@ -435,13 +828,21 @@ class SnippetRunnerRemote:
                  sync_frequency:float = 5,
                  sync_conflict_policy:ConflictSolvePolicy = ConflictSolvePolicy.HOST_PRIORITIZED,
                  sync_snippet_share_only:bool = True,
-                 sync_shared_depth:int = -1):
+                 sync_shared_depth:int = -1,
+                 sync_float_deadband:Optional[FloatDeadband] = None,
+                 sync_remote_reference_depth:Optional[int] = None,
+                 sync_remote_reference_size:Optional[int] = None,
+                 sync_remote_prefetch_depth:int = 1):
         super().__init__()
         self.connection = connection
         self.sync_frequency = sync_frequency
         self.sync_conflict_policy = sync_conflict_policy
         self.sync_snippet_share_only = sync_snippet_share_only
         self.sync_shared_depth = sync_shared_depth
+        self.sync_float_deadband = sync_float_deadband
+        self.sync_remote_reference_depth = sync_remote_reference_depth
+        self.sync_remote_reference_size = sync_remote_reference_size
+        self.sync_remote_prefetch_depth = sync_remote_prefetch_depth
         self.debug_mode = False
         self.logger = None
     """SnippetRunnerRemote
@@ -454,6 +855,10 @@ class SnippetRunnerRemote:
         sync_conflict_policy (ConflictSolvePolicy): 同期ポリシー
         sync_snippet_share_only (bool): @snippet_shareのみ同期
         sync_shared_depth (bool): 同期オブジェクトの再帰深さ
+        sync_float_deadband (FloatDeadband): floatのメンバーの同期の不感帯と量子化(パスはshared_objectsからのパス)
+        sync_remote_reference_depth (int): shared_objectsの各オブジェクトからこの深さより深いインスタンスは、アクセスするまで送らない
+        sync_remote_reference_size (int): 要素数がこの数より多いインスタンスは、アクセスするまで送らない
+        sync_remote_prefetch_depth (int): アクセスしたインスタンスと一緒に送る深さ
     """
 
     def exec(self,
@@ -469,7 +874,9 @@ class SnippetRunnerRemote:
              loop_hook:SnippetLoopHook=None,
              step_prefix_hook:SnippetStepHook=None,
              step_postfix_hook:SnippetStepHook=None,
-             error_hook:SnippetStepErrorHook=None):
+             error_hook:SnippetStepErrorHook=None,
+             hook_sampling:Optional[HookSampling]=None,
+             step_backend:StepBackend=StepBackend.AST):
         """
         指定されたコードをリモート実行環境で実行する
 
@@ -487,6 +894,8 @@ class SnippetRunnerRemote:
             step_prefix_hook (SnippetStepHook): 1ステップ実行される度に呼び出されるHook
             step_postfix_hook (SnippetStepHook): 1ステップ実行される度に呼び出されるHook
             error_hook (SnippetStepErrorHook): 実行時Exceptionがraiseした時に呼び出されるHook
+            hook_sampling (HookSampling): loop_hook、step_prefix_hook、step_postfix_hookを呼び出すイベントのサンプリング
+            step_backend (StepBackend): step_prefix_hook、step_postfix_hook、error_hookの実装方法
 
         Note:
             error_hookを指定した場合、エラーハンドリングに例外処理を使うので、
@@ -497,6 +906,7 @@ class SnippetRunnerRemote:
             StepErrorApproach.RAISE_ERROR: SnippetStepError例外を送出
             StepErrorApproach.IGNORE_AND_CONTINUE: 無視してその場から強引に実行を継続
             StepErrorApproach.IGNORE_AND_BREAK: コードブロックの終わりに移動して実行を継続
+            step_backendがStepBackend.MONITORINGの場合、IGNORE_AND_CONTINUEとIGNORE_AND_BREAKはRAISE_ERRORとして扱う
         """
         assert cond.force_globals is None, 'force_globals is unsupported in remote run'
         assert cond.force_locals is None, 'force_locals is unsupported in remote run'
@@ -540,7 +950,10 @@ class SnippetRunnerRemote:
             _error_hook = plain_error_hook()
 
         shared = cond.shared_objects
-        cond = {'sourcecodestr':code,
+        # コードはハッシュのみ送り、サーバーが持っていない時だけアップロードする
+        code_key = content_hash(code)
+        cond = {'sourcecodestr':None,
+                'sourcecodehash':code_key,
                 'total_timeout_sec':cond.total_timeout_sec,
                 'dynamic_import':cond.dynamic_import,
                 'allow_global_functions':cond.allow_global_functions,
@@ -551,7 +964,9 @@ class SnippetRunnerRemote:
                     'max_outer_loop_count':max_outer_loop_count,
                     'max_inner_loop_count':max_inner_loop_count,
                     'includes_comp_loop':includes_comp_loop,
-                    'forced_execution_mode':forced_execution_mode}
+                    'forced_execution_mode':forced_execution_mode,
+                    'hook_sampling':hook_sampling.to_dict() if hook_sampling is not None else None,
+                    'step_backend':step_backend.value}
         hooks = {'loop_hook':_loop_hook,
                  'step_prefix_hook':_step_prefix_hook,
                  'step_postfix_hook':_step_postfix_hook,
@@ -559,6 +974,8 @@ class SnippetRunnerRemote:
         
         shared_object = {'shared':shared, 'hooks':hooks}
         configure_object = {'cond':cond, 'features':features}
+        # contentsに対応していない古いサーバーにはコードを含めて送る
+        legacy_configure_object = {'cond':dict(cond, sourcecodestr=code), 'features':features}
         
         log_hook = None
         if self.debug_mode:
@@ -568,6 +985,18 @@ class SnippetRunnerRemote:
                     logger.debug(f'LOG: {tag} - {command}')
             log_hook = logger if isinstance(logger,CommunicationLog) else MyCommunicationLog()
 
+        float_deadband = None
+        if self.sync_float_deadband is not None:
+            # 同期するルートは{'shared':shared_objects, 'hooks':...}なのでパスにsharedを付ける
+            float_deadband = FloatDeadband(deadband=self.sync_float_deadband.deadband,
+                                           quantize=self.sync_float_deadband.quantize,
+                                           paths={f'shared.{k}':v for k,v in self.sync_float_deadband.paths.items()})
+
+        remote_reference_depth = None
+        if self.sync_remote_reference_depth is not None:
+            # 同期するルートは{'shared':shared_objects, 'hooks':...}なので、shared_objectsの各オブジェクトは深さ2
+            remote_reference_depth = self.sync_remote_reference_depth + 2
+
         client = Communicator(connection=self.connection, 
                               sync_frequency=self.sync_frequency,
                               use_compress=not self.debug_mode,
@@ -577,4 +1006,10 @@ class SnippetRunnerRemote:
                       configure_object=configure_object, 
                       conflict=self.sync_conflict_policy,
                       snippet_share_only=self.sync_snippet_share_only,
-                      dump_object_depth=self.sync_shared_depth)
\ No newline at end of file
+                      dump_object_depth=self.sync_shared_depth,
+                      float_deadband=float_deadband,
+                      remote_reference_depth=remote_reference_depth,
+                      remote_reference_size=self.sync_remote_reference_size,
+                      contents={code_key:code},
+                      legacy_configure_object=legacy_configure_object,
+                      remote_prefetch_depth=self.sync_remote_prefetch_depth)
\ No newline at end of file
@@ -3,25 +3,230 @@ from enum import Enum
 from collections import namedtuple
 import warnings
 import threading
+import sys
+import gc
 import time
 import copy
+import types
+import operator
 import ast
 
 from .exceptions import *
 from .hooks import *
 
+LoopHookTarget = namedtuple('LoopHookTarget', ['id', 'depth', 'loop', 'children'])
+
+_MONITORING = getattr(sys, 'monitoring', None) # Python 3.12以降
+
+
+class AstTemplate:
+    """AstTemplate
+
+    Featureが挿入するノードのテンプレート
+    ソースコードは一度だけ構文解析し、cloneで大文字の変数名(プレースホルダ)を値に置き換えた複製を作る
+
+    Args:
+        source (str): 1文のソースコード
+
+    Examples:
+
+        >>> template = AstTemplate('try:\n  BODY\nexcept Exception as __e:\n  __step_error_hook__(ID,LINENO,__e)')
+        >>> node = template.clone(location=stmt, ID=id(stmt), LINENO=stmt.lineno, BODY=[stmt])
+
+    Note:
+        プレースホルダの値がASTならそのノード、それ以外は定数に置き換える
+        文のリストの中の式文のプレースホルダ(BODYなど)は、値の文のリストに展開する
+        locationを指定すると複製したノードの位置情報をlocationの位置にする
+        テンプレートはノードを直接作る関数にコンパイルしておき、複製毎にASTを辿らない
+    """
+    def __init__(self, source:str):
+        self.node = ast.parse(source).body[0]
+        factory_source = f'lambda values, lineno, col_offset, end_lineno, end_col_offset: {self._factory_source(self.node)}'
+        self._factory = eval(compile(factory_source, '<AstTemplate>', 'eval'), {'ast':ast, '_placeholder':_placeholder, '_contexts':_CONTEXTS})
+
+    def clone(self, location:Optional[ast.AST]=None, **values) -> ast.AST:
+        return self._factory(values,
+                             getattr(location, 'lineno', 1),
+                             getattr(location, 'col_offset', 0),
+                             getattr(location, 'end_lineno', None),
+                             getattr(location, 'end_col_offset', None))
+
+    @staticmethod
+    def _is_placeholder(node:ast.AST) -> bool:
+        return type(node) is ast.Name and node.id.isupper()
+
+    def _factory_source(self, node:object) -> str:
+        if not isinstance(node, ast.AST):
+            return repr(node)
+        if self._is_placeholder(node):
+            return f'_placeholder(values[{node.id!r}], lineno, col_offset, end_lineno, end_col_offset)'
+        if type(node) in _CONTEXTS: # Load/Store/Delは構文解析と同じく共有する
+            return f'_contexts[ast.{type(node).__name__}]'
+        arguments = []
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if type(value) is list:
+                items = []
+                for item in value:
+                    if type(item) is ast.Expr and self._is_placeholder(item.value):
+                        items.append(f'*values[{item.value.id!r}]')
+                    else:
+                        items.append(self._factory_source(item))
+                arguments.append(f'{field}=[{", ".join(items)}]')
+            else:
+                arguments.append(f'{field}={self._factory_source(value)}')
+        for attribute in node._attributes:
+            arguments.append(f'{attribute}={attribute}')
+        return f'ast.{type(node).__name__}({", ".join(arguments)})'
+
+
+_CONTEXTS = {ast.Load:ast.Load(), ast.Store:ast.Store(), ast.Del:ast.Del()}
+
+def _placeholder(value:object, lineno:int, col_offset:int, end_lineno:Optional[int], end_col_offset:Optional[int]) -> ast.AST:
+    if isinstance(value, ast.AST):
+        return value
+    return ast.Constant(value=value, lineno=lineno, col_offset=col_offset, end_lineno=end_lineno, end_col_offset=end_col_offset)
+
+
+class TreeHandler:
+    """TreeHandler
+
+    TreeTransformerの走査中に呼び出されるASTの変形処理のBaseクラス
+
+    Note:
+        enterは子ノードの走査前、leaveは子ノードの走査とbodyの変形の後に、node_typesの型のノードに対して呼び出される
+        bodyは文のリストのbodyを持つ全てのノードに対して、子ノードの走査後に呼び出され、新しいbodyを返す
+        呼び出されるのは元のコードのノードのみで、変形で挿入したノードは走査しない
+    """
+    node_types = ()
+
+    def enter(self, node:ast.AST):
+        return
+
+    def body(self, node:ast.AST, body:List[ast.stmt]) -> List[ast.stmt]:
+        return body
+
+    def leave(self, node:ast.AST):
+        return
+
+    def result(self) -> object:
+        "変形結果のデータ(transform_treeの戻り値)"
+        return None
+
+
+class TreeTransformer(ast.NodeTransformer):
+    """TreeTransformer
+
+    複数のTreeHandlerの変形をASTの1回の走査でまとめて行う
+
+    Args:
+        handlers (List[TreeHandler]): 変形を行うTreeHandler(同じノードではこの順に呼び出す)
+
+    Examples:
+
+        >>> handlers = [feature.tree_handler() for feature in features]
+        >>> TreeTransformer(handlers).visit(root)
+        >>> tree_data = [handler.result() for handler in handlers]
+    """
+    def __init__(self, handlers:List[TreeHandler]):
+        super().__init__()
+        self.handlers = handlers
+        self.node_handlers = {}
+        for handler in handlers:
+            for node_type in handler.node_types:
+                self.node_handlers.setdefault(node_type, []).append(handler)
+        self.body_handlers = [handler for handler in handlers if type(handler).body is not TreeHandler.body]
+
+    def visit(self, node:ast.AST) -> ast.AST:
+        # 大量のノードを作るので、走査中は循環参照のGCを止める(5000行で約2倍速くなる)
+        # 呼び出し元で既に止めている場合は再開しないよう、元の状態を保存して例外時も復元する
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._visit(node)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _visit(self, node:ast.AST) -> ast.AST:
+        node_handlers = self.node_handlers.get(type(node), ())
+        for handler in node_handlers:
+            handler.enter(node)
+        self.generic_visit(node)
+        for handler in node_handlers:
+            handler.leave(node)
+        return node
+
+    def generic_visit(self, node:ast.AST) -> ast.AST:
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if type(value) is list:
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        self._visit(item)
+            elif isinstance(value, ast.AST):
+                self._visit(value)
+        if len(self.body_handlers) > 0:
+            body = getattr(node, 'body', None)
+            if type(body) is list:
+                for handler in self.body_handlers:
+                    body = handler.body(node, body)
+                node.body = body
+        return node
+
 
 class RunningFeatureBase:
     """RunningFeatureBase
     SnippetRunnerの実行時に利用するFeatureを定義するBaseクラス
     
+    Note:
+        update_treeはtransform_tree(ASTの変形)とbind_tree(実行毎のHookの設定)に分かれていて、
+        tree_keyがNoneでないFeatureは変形済みのコードをSnippetCodeCacheでキャッシュし、2回目以降はbind_treeのみ呼び出す
+        update_treeを上書きしたFeatureはキャッシュしない
+        tree_handlerでTreeHandlerを返すFeatureは、SnippetRunnerLocalが他のFeatureの変形と1回の走査にまとめる
+        enter_exec/exit_execはコードの実行の直前と直後に、実行するスレッドで呼び出される
     """
     def __init__(self):
         self.rank = 999
 
+    def tree_key(self) -> Optional[tuple]:
+        "transform_treeの変形を決める設定(JSONにできる値のtuple、Noneならキャッシュしない)"
+        return None
+
+    def tree_handler(self) -> Optional[TreeHandler]:
+        "transform_treeの変形を行うTreeHandler(Noneならtransform_treeを上書きする)"
+        return None
+
+    def transform_tree(self,
+                       root:ast.AST) -> object:
+        "ASTを変形して、bind_treeに渡すデータ(pickleできる値)を返す"
+        handler = self.tree_handler()
+        if handler is None:
+            return None
+        TreeTransformer([handler]).visit(root)
+        return handler.result()
+
+    def bind_tree(self,
+                  tree_data:object,
+                  ext_objects:Optional[Dict[str,object]]):
+        "transform_treeのデータから、実行毎に新しいHookを作ってext_objectsに設定する"
+        return
+
     def update_tree(self,
                     root:ast.AST,
                     ext_objects:Optional[Dict[str,object]]):
+        self.bind_tree(self.transform_tree(root), ext_objects)
+
+    def enter_exec(self,
+                   code:types.CodeType,
+                   ext_objects:Optional[Dict[str,object]]):
+        "コンパイル済みのコードの実行前の処理(ext_objectsはbind_treeで設定したもの)"
+        return
+
+    def exit_exec(self,
+                  code:types.CodeType,
+                  ext_objects:Optional[Dict[str,object]]):
+        "コンパイル済みのコードの実行後の処理(例外で終了した場合も呼び出す)"
         return
 
 
@@ -34,22 +239,22 @@ class RunningWithoutImport(RunningFeatureBase):
         super().__init__()
         self.rank = 0
 
-    def update_tree(self,
-                    root:ast.AST,
-                    ext_objects:Optional[Dict[str,object]]):
-        for leaf in ast.walk(root):
-            try:
-                body = leaf.body
-            except AttributeError:
-                body = None
-            if body is not None and type(body) is list:
-                for index in range(len(body)-1, -1, -1):
-                    if type(body[index]) is ast.Import or type(body[index]) is ast.ImportFrom:
-                        del body[index]
-        for leaf in ast.walk(root):
-            if type(leaf) is ast.Import or type(leaf) is ast.ImportFrom:
+    def tree_handler(self) -> Optional[TreeHandler]:
+        return _ImportRemoveHandler()
+
+
+class _ImportRemoveHandler(TreeHandler):
+    "bodyのimport文を除去し、それ以外(elseやfinally)のimport文は禁止する"
+    node_types = tuple(getattr(ast, name) for name in ('If', 'For', 'AsyncFor', 'While', 'Try', 'TryStar') if hasattr(ast, name))
+
+    def enter(self, node:ast.AST):
+        for stmt in getattr(node, 'orelse', []) + getattr(node, 'finalbody', []):
+            if type(stmt) is ast.Import or type(stmt) is ast.ImportFrom:
                 raise SnippetProhibitionError
 
+    def body(self, node:ast.AST, body:List[ast.stmt]) -> List[ast.stmt]:
+        return [stmt for stmt in body if type(stmt) is not ast.Import and type(stmt) is not ast.ImportFrom]
+
 
 class RunningWithSteppingCheck(RunningFeatureBase):
     """RunningWithSteppingCheck
@@ -61,6 +266,8 @@ class RunningWithSteppingCheck(RunningFeatureBase):
         prefix_hook_class (StepHook): 1ステップ実行前のHook
         postfix_hook_class (StepHook): 1ステップ実行後のHook
         error_hook_class (StepErrorHook): エラー時のHook
+        sampling (HookSampling): 1ステップ実行前後のHookを呼び出すイベントのサンプリング(Noneなら全て)
+        backend (StepBackend): Hookの実装方法(sys.monitoringが無い場合、StepBackend.MONITORINGはStepBackend.ASTになる)
 
     Examples:
 
@@ -92,42 +299,46 @@ class RunningWithSteppingCheck(RunningFeatureBase):
     Note:
         エラーハンドリングに例外処理を使うので、実行コードが例外のraise/catchを行う場合、
         StepErrorApproach.DEFAULT以外を返すと、コードの動作が変わる可能性がある
+        samplingは実行前のHookで判定し、呼び出したステップのみ実行後のHookを呼び出す(エラー時のHookは間引かない)
+        判定は文とフレームの組で覚えるので、再帰呼び出しや例外で抜けた文があっても実行前と実行後のHookは対になる
+        実行前と実行後のHookはHookSignal.DETACHを返すと以後呼び出さず、
+        StepBackend.ASTでは呼び出し箇所のフラグで、StepBackend.MONITORINGではLINEのイベントを止める
+        StepBackend.MONITORINGはコードを変形せず、1行を1ステップとして行の最初の文に対してHookを呼び出す
+        エラー時のHookは例外が発生または伝播したフレーム毎に1回呼び出し、例外を無視できないので
+        StepErrorApproach.IGNORE_AND_CONTINUEとIGNORE_AND_BREAKはRAISE_ERRORとして扱う
     """
     def __init__(self, 
                  prefix_hook_class:object=StepHook,
                  postfix_hook_class:object=StepHook,
-                 error_hook_class:object=StepErrorHook):
+                 error_hook_class:object=StepErrorHook,
+                 sampling:Optional[HookSampling]=None,
+                 backend:StepBackend=StepBackend.AST):
         super().__init__()
         self.rank = 1
         self.prefix_hook_class = prefix_hook_class
         self.postfix_hook_class = postfix_hook_class
         self.error_hook_class = error_hook_class
-
-    def update_tree(self,
-                    root:ast.AST,
-                    ext_objects:Optional[Dict[str,object]]):
-        hooktargets = []
-
-        for leaf in ast.walk(root):
-            try:
-                body = leaf.body
-            except AttributeError:
-                body = None
-            if body is not None and type(body) is list:
-                for index in range(len(body)):
-                    try:
-                        lineno = body[index].lineno
-                    except AttributeError:
-                        lineno = 0
-                    try_prefix = compile(f'__step_prefix_hook__({id(body[index])},{lineno})', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                    try_postfix = compile(f'__step_postfix_hook__({id(body[index])},{lineno})', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                    try_exter = compile(f'try:\n  0\nexcept Exception as __e:\n  __step_error_hook__({id(body[index])},{lineno},__e)', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                    try_exter.body = [try_prefix,body[index],try_postfix]
-                    body[index] = try_exter
-                    hooktargets.append(HookTarget(id(body[index])))
-                try_inter = compile(f'try:\n  0\nexcept SnippetStepBreak:\n  pass', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                try_inter.body = body
-                leaf.body = [try_inter]
+        self.sampling = sampling
+        if backend == StepBackend.MONITORING and _MONITORING is None:
+            warnings.warn('sys.monitoring is not available, StepBackend.AST is used', RuntimeWarning)
+            backend = StepBackend.AST
+        self.backend = backend
+
+    def tree_key(self) -> Optional[tuple]:
+        return (self.backend.value,)
+
+    def tree_handler(self) -> Optional[TreeHandler]:
+        if self.backend == StepBackend.MONITORING:
+            return _StepTableHandler()
+        return _SteppingHandler()
+
+    def bind_tree(self,
+                  tree_data:list,
+                  ext_objects:Optional[Dict[str,object]]):
+        if self.backend == StepBackend.MONITORING:
+            hooktargets = [HookTarget(statement[2]) for statement in tree_data]
+        else:
+            hooktargets = [HookTarget(target_id) for target_id in tree_data]
 
         prefix_hook, postfix_hook, error_hook = None, None, None
         if self.prefix_hook_class is not None:
@@ -136,25 +347,73 @@ class RunningWithSteppingCheck(RunningFeatureBase):
             postfix_hook = self.postfix_hook_class(hooktargets)
         if self.error_hook_class is not None:
             error_hook = self.error_hook_class(hooktargets)
+        prefix_hook = prefix_hook if isinstance(prefix_hook, StepHook) else None
+        postfix_hook = postfix_hook if isinstance(postfix_hook, StepHook) else None
+
+        sample = self.sampling.sampler() if self.sampling is not None else None
+        sampled_ids = set() # 実行前のHookを呼び出した(文, フレーム)
+        frame_id = id # Hookの引数のidで隠れる
+        monitor = None
+
+        def update_attached():
+            # 外れたHookは呼び出し箇所のフラグで止める(samplingがあれば実行後のHookのために実行前で判定する)
+            ext_objects["__step_prefix_on__"] = prefix_hook is not None or (sample is not None and postfix_hook is not None)
+            ext_objects["__step_postfix_on__"] = postfix_hook is not None
+            if monitor is not None and prefix_hook is None and postfix_hook is None:
+                monitor.detach()
+
+        def __step_prefix_hook__(id:int, lineno:int, frame:Optional[types.FrameType]=None):
+            nonlocal prefix_hook
+            if sample is not None:
+                # 同じフレームで前回の実行が例外などで抜けていたら、前回の判定は捨てる
+                key = (id, frame_id(frame if frame is not None else sys._getframe(1)))
+                if not sample():
+                    sampled_ids.discard(key)
+                    return
+                sampled_ids.add(key)
+            if prefix_hook is not None and prefix_hook.hook(id=id, lineno=lineno) is HookSignal.DETACH:
+                prefix_hook = None
+                update_attached()
+        def __step_postfix_hook__(id:int, lineno:int, frame:Optional[types.FrameType]=None):
+            nonlocal postfix_hook
+            if sample is not None:
+                key = (id, frame_id(frame if frame is not None else sys._getframe(1)))
+                if key not in sampled_ids:
+                    return
+                sampled_ids.discard(key)
+            if postfix_hook is not None and postfix_hook.hook(id=id, lineno=lineno) is HookSignal.DETACH:
+                postfix_hook = None
+                update_attached()
+        def error_approach(id:int, lineno:int, e:Exception) -> Optional[StepErrorApproach]:
+            if isinstance(e, SnippetException) and not isinstance(e, SnippetError):
+                return StepErrorApproach.DEFAULT
+            if error_hook is not None and isinstance(error_hook, StepErrorHook):
+                return error_hook.hook(id=id, lineno=lineno)
+            return None
+
+        if self.backend == StepBackend.MONITORING:
+            stepping = prefix_hook is not None or postfix_hook is not None
+            assert "__step_monitor__" not in ext_objects
+            monitor = _StepMonitor(tree_data,
+                                   __step_prefix_hook__ if stepping else None,
+                                   __step_postfix_hook__ if stepping else None,
+                                   error_approach if error_hook is not None else None)
+            ext_objects["__step_monitor__"] = monitor
+            return
 
-        def __step_prefix_hook__(id:int, lineno:int):
-            if prefix_hook is not None and isinstance(prefix_hook, StepHook):
-                prefix_hook.hook(id=id, lineno=lineno)
-        def __step_postfix_hook__(id:int, lineno:int):
-            if postfix_hook is not None and isinstance(postfix_hook, StepHook):
-                postfix_hook.hook(id=id, lineno=lineno)
         def __step_error_hook__(id:int, lineno:int, e:Exception):
-            if isinstance(e, SnippetException) and not isinstance(e, SnippetError):
+            if sample is not None:
+                sampled_ids.discard((id, frame_id(sys._getframe(1))))
+            result = error_approach(id, lineno, e)
+            if result == StepErrorApproach.DEFAULT:
                 raise e
-            if error_hook is not None and isinstance(error_hook, StepErrorHook):
-                result = error_hook.hook(id=id, lineno=lineno)
-                if result == StepErrorApproach.DEFAULT:
-                    raise e
-                elif result == StepErrorApproach.RAISE_ERROR:
-                    raise SnippetStepError(e)
-                elif result == StepErrorApproach.IGNORE_AND_BREAK:
-                    raise SnippetStepBreak(e)
+            elif result == StepErrorApproach.RAISE_ERROR:
+                raise SnippetStepError(e)
+            elif result == StepErrorApproach.IGNORE_AND_BREAK:
+                raise SnippetStepBreak(e)
 
+        assert "__step_prefix_on__" not in ext_objects and "__step_postfix_on__" not in ext_objects
+        update_attached()
         assert "__step_prefix_hook__" not in ext_objects
         ext_objects["__step_prefix_hook__"] = __step_prefix_hook__
         assert "__step_postfix_hook__" not in ext_objects
@@ -164,6 +423,18 @@ class RunningWithSteppingCheck(RunningFeatureBase):
         ext_objects["SnippetStepBreak"] = SnippetStepBreak
         ext_objects["Exception"] = Exception
 
+    def enter_exec(self,
+                   code:types.CodeType,
+                   ext_objects:Optional[Dict[str,object]]):
+        if self.backend == StepBackend.MONITORING:
+            ext_objects["__step_monitor__"].start(code)
+
+    def exit_exec(self,
+                  code:types.CodeType,
+                  ext_objects:Optional[Dict[str,object]]):
+        if self.backend == StepBackend.MONITORING:
+            ext_objects["__step_monitor__"].stop()
+
 
 class RunningWithIgnoreError(RunningWithSteppingCheck):
     """RunningWithIgnoreError
@@ -218,6 +489,7 @@ class RunningWithEvalCheck(RunningFeatureBase):
     Pythonコードの1ステップ毎に変数をチェックするデバッグ用Feature
     target_hook_classのHookの戻り値でチェックする変数を指定できる
     チェックする変数はその後に呼び出されるeval_hook_classに渡される
+    変数名は'obj.attr.value'のように属性をたどる事ができる
 
     Args:
         target_hook_class (StepHook): 1ステップ実行前のHook
@@ -248,8 +520,10 @@ class RunningWithEvalCheck(RunningFeatureBase):
         StepEvalHook -- lineno=4 name=target value=fghij
 
     Note:
-        変数チェックにevalを使用するので、allow_global_functionsにevalを追加する必要がある
-        その事によりセキュリティリスクが発生するので、このFeatureはデバッグのためにのみ使う事
+        変数はevalを使わず、ステップ実行後のローカル変数(locals())、グローバル変数、builtinsの順に探し、
+        変数名毎に作ったアクセサで属性をたどる(見つからない場合と属性の取得でエラーになった場合はNone)
+        値は1ステップ毎にまとめてStepEvalHook.hook_valuesに渡す(上書きしなければ変数毎にhookを呼び出す)
+        target_hook_classのHookがHookSignal.DETACHを返すと、以後は変数をチェックしない
     """
     def __init__(self, 
                  target_hook_class:object=StepTargetHook,
@@ -259,53 +533,82 @@ class RunningWithEvalCheck(RunningFeatureBase):
         self.target_hook_class = target_hook_class
         self.eval_hook_class = eval_hook_class
 
-    def update_tree(self,
-                    root:ast.AST,
-                    ext_objects:Optional[Dict[str,object]]):
-        hooktargets = []
+    def tree_key(self) -> Optional[tuple]:
+        return ()
 
-        for leaf in ast.walk(root):
-            try:
-                body = leaf.body
-            except AttributeError:
-                body = None
-            if body is not None and type(body) is list:
-                newbody = []
-                for index in range(len(body)):
-                    try:
-                        lineno = body[index].lineno
-                    except AttributeError:
-                        lineno = 0
-                    eval_check = compile(f'for __n in __step_target_hook__({id(body[index])},{lineno}):\n  __step_eval_hook__({id(body[index])},{lineno},__n,eval(__n))', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                    newbody.append(body[index])
-                    newbody.append(eval_check)
-                    hooktargets.append(HookTarget(id(body[index])))
-                leaf.body = newbody
+    def tree_handler(self) -> Optional[TreeHandler]:
+        return _EvalCheckHandler()
+
+    def bind_tree(self,
+                  tree_data:List[int],
+                  ext_objects:Optional[Dict[str,object]]):
+        hooktargets = [HookTarget(target_id) for target_id in tree_data]
 
         target_hook, eval_hook = None, None
         if self.target_hook_class is not None:
             target_hook = self.target_hook_class(hooktargets)
         if self.eval_hook_class is not None:
             eval_hook = self.eval_hook_class(hooktargets)
+        target_hook = target_hook if isinstance(target_hook, StepTargetHook) else None
+        eval_hook = eval_hook if isinstance(eval_hook, StepEvalHook) else None
+
+        accessors = {}
+        evalnames = []
+
+        def make_accessor(name:str) -> Callable[[dict,dict],Optional[object]]:
+            root, _, path = name.partition('.')
+            getter = operator.attrgetter(path) if len(path) > 0 else None
+            def accessor(scope:dict, builtins:dict) -> Optional[object]:
+                if root in scope:
+                    value = scope[root]
+                elif root in ext_objects:
+                    value = ext_objects[root]
+                elif root in builtins:
+                    value = builtins[root]
+                else:
+                    return None
+                if getter is None:
+                    return value
+                try:
+                    return getter(value)
+                except Exception:
+                    return None
+            return accessor
+
+        def __step_target_hook__(id:int, lineno:int) -> bool:
+            nonlocal target_hook
+            names = target_hook.hook(id=id, lineno=lineno)
+            if names is HookSignal.DETACH:
+                target_hook = None
+                ext_objects["__step_eval_on__"] = False
+                return False
+            if names is None or type(names) is not list or len(names) == 0:
+                return False
+            for name in names:
+                if type(name) is not str:
+                    return False
+            evalnames[:] = names
+            return True
+
+        def __step_eval_hook__(id:int, lineno:int, scope:dict):
+            builtins = ext_objects.get('__builtins__', {})
+            if type(builtins) is not dict:
+                builtins = vars(builtins)
+            values = {}
+            for name in evalnames:
+                accessor = accessors.get(name)
+                if accessor is None:
+                    accessor = accessors[name] = make_accessor(name)
+                values[name] = accessor(scope, builtins)
+            if eval_hook is not None:
+                eval_hook.hook_values(id=id, lineno=lineno, values=values)
 
-        def __step_target_hook__(id:int, lineno:int):
-            if target_hook is not None and isinstance(target_hook, StepTargetHook):
-                evalnames = target_hook.hook(id=id, lineno=lineno)
-                if evalnames is not None and type(evalnames) is list:
-                    for name in evalnames:
-                        if type(name) is not str:
-                            return []
-                    return evalnames
-            return []
-
-        def __step_eval_hook__(id:int, lineno:int, name:str, value:object):
-            if eval_hook is not None and isinstance(eval_hook, StepEvalHook):
-                eval_hook.hook(id=id, lineno=lineno, name=name, value=value)
-                
         assert "__step_target_hook__" not in ext_objects
         ext_objects["__step_target_hook__"] = __step_target_hook__
         assert "__step_eval_hook__" not in ext_objects
         ext_objects["__step_eval_hook__"] = __step_eval_hook__
+        ext_objects["__step_eval_on__"] = target_hook is not None
+        ext_objects["__step_locals__"] = locals
 
 
 class RunningWithLoopHook(RunningFeatureBase):
@@ -317,6 +620,7 @@ class RunningWithLoopHook(RunningFeatureBase):
         hook_classes (List[LoopHook]): list of LoopHook
         includes_comp_loop (bool): 内包表記([_ for...]など)をループに数える
         forced_execution_mode (bool): ループを強制執行モードで実行
+        sampling (HookSampling): Hookを呼び出すループの実行のサンプリング(Noneなら全て)
 
     Examples:
 
@@ -341,68 +645,32 @@ class RunningWithLoopHook(RunningFeatureBase):
 
     Note:
         forced_execution_modeがTrueのとき、FOR、WHILEなら強引に処理を続ける
+        samplingで間引いたループの実行でも、内側ループのclear_loopは呼び出す
+        HookSignal.DETACHを返したHookは以後呼び出さず、全て外れたらループの先頭のフラグでHookの呼び出しを止める
     """
     def __init__(self,
                  hook_classes:List[object]=[LoopHook],
                  includes_comp_loop:bool=True,
-                 forced_execution_mode:bool=False):
+                 forced_execution_mode:bool=False,
+                 sampling:Optional[HookSampling]=None):
         super().__init__()
         self.rank = 5
         self.hook_classes = hook_classes
         self.includes_comp_loop = includes_comp_loop
         self.forced_execution_mode = forced_execution_mode
+        self.sampling = sampling
 
-    def _get_tree(self, root:ast.AST) -> List[object]:        
-        LoopHookTarget = namedtuple('LoopHookTarget', ['id', 'depth', 'loop', 'children'])
-
-        def update_loop_node(node):
-            if self.forced_execution_mode:
-                loop_exter = compile(f'try:\n  0\nexcept SnippetOvertime:\n  break', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                loop_exter.body = node.body
-                node.body = [loop_exter]
-                
-        def find_loop_children(tree, depth, hooks):
-            newhooks = None
-            for node in ast.iter_child_nodes(tree):
-                if type(node) is ast.While: # while文なら
-                    loop_inter = compile(f'__loop_inter_hook__(id={id(node)})', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                    node.body.insert(0, loop_inter)
-                    update_loop_node(node)
-                    newhooks = []
-                    hooks.append(LoopHookTarget(id(node), depth, LoopHookType.WHILE, newhooks))
-                elif type(node) is ast.AsyncFor or type(node) is ast.For: # for文なら
-                    loop_inter = compile(f'__loop_inter_hook__(id={id(node)})', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                    node.body.insert(0, loop_inter)
-                    update_loop_node(node)
-                    newhooks = []
-                    hooks.append(LoopHookTarget(id(node), depth, LoopHookType.FOR, newhooks))
-                elif type(node) is ast.ListComp or type(node) is ast.SetComp or type(node) is ast.GeneratorExp or type(node) is ast.DictComp: # [_ for ...]文なら
-                    if self.includes_comp_loop:
-                        elt = node.value if type(node) is ast.DictComp else node.elt
-                        loop_inter = compile(f'__loop_inter_hook__(id={id(node)},obj=obj)', '', 'exec', ast.PyCF_ONLY_AST).body[0]
-                        for kw in loop_inter.value.keywords:
-                            if str(kw.arg) == 'obj':
-                                kw.value = elt
-                        if type(node) is ast.DictComp:
-                            node.value = loop_inter.value
-                        else:
-                            node.elt = loop_inter.value
-                        newhooks = []
-                        hooks.append(LoopHookTarget(id(node), depth, LoopHookType.COMP, []))
-                if newhooks is None:
-                    find_loop_children(node, depth, hooks)
-                else:
-                    find_loop_children(node, depth+1, newhooks)
-                
-        hook_nodes = []
-        find_loop_children(root, 0, hook_nodes)
+    def tree_key(self) -> Optional[tuple]:
+        return (self.includes_comp_loop, self.forced_execution_mode)
 
-        return hook_nodes
+    def tree_handler(self) -> Optional[TreeHandler]:
+        return _LoopHookHandler(includes_comp_loop=self.includes_comp_loop,
+                                forced_execution_mode=self.forced_execution_mode)
 
-    def update_tree(self,
-                    root:ast.AST,
-                    ext_objects:Optional[Dict[str,object]]):
-        hook_nodes = self._get_tree(root)
+    def bind_tree(self,
+                  tree_data:List[LoopHookTarget],
+                  ext_objects:Optional[Dict[str,object]]):
+        hook_nodes = tree_data
         all_hook_targets = []
         id_hook_nodes = {}
         def add_hook_node(nodes):
@@ -415,29 +683,41 @@ class RunningWithLoopHook(RunningFeatureBase):
         add_hook_node(hook_nodes)
 
         hooks = [clz(all_hook_targets) for clz in self.hook_classes]
+        hooks = [hook for hook in hooks if hook is not None and isinstance(hook, HookBase)]
+        clear_hooks = [hook for hook in hooks if isinstance(hook, LoopHook)]
+
+        def detach_hooks(detached:list):
+            nonlocal hooks, clear_hooks
+            hooks = [hook for hook in hooks if hook not in detached]
+            clear_hooks = [hook for hook in clear_hooks if hook not in detached]
+            ext_objects["__loop_hook_on__"] = len(hooks) > 0
 
         def clear_hook_node(nodes):
             for node in nodes:
-                for hook in hooks:
-                    if isinstance(hook, LoopHook):
-                        hook.clear_loop(id=node.id)                
+                for hook in clear_hooks:
+                    hook.clear_loop(id=node.id)
                 if node.children is not None:
                     clear_hook_node(node.children)
 
+        sample = self.sampling.sampler() if self.sampling is not None else None
+
         def __loop_inter_hook__(id:int, obj:Optional[object]=None):
+            if id_hook_nodes[id].children:
+                clear_hook_node(id_hook_nodes[id].children)
+            if sample is not None and not sample():
+                return obj
             try:
                 lineno = id_hook_nodes[id].lineno
             except AttributeError:
                 lineno = 0
-            if id_hook_nodes[id].children is not None:
-                clear_hook_node(id_hook_nodes[id].children)
-            for hook in hooks:
-                if hook is not None and isinstance(hook, HookBase):
-                    hook.hook(id=id, lineno=lineno)
+            detached = [hook for hook in hooks if hook.hook(id=id, lineno=lineno) is HookSignal.DETACH]
+            if len(detached) > 0:
+                detach_hooks(detached)
             return obj
 
         assert "__loop_inter_hook__" not in ext_objects
         ext_objects["__loop_inter_hook__"] = __loop_inter_hook__
+        ext_objects["__loop_hook_on__"] = len(hooks) > 0
         ext_objects["SnippetOvertime"] = SnippetOvertime
 
 
@@ -456,6 +736,8 @@ class RunningWithOuterFrequency(RunningWithLoopHook):
         max_inner_loop_count (int): 内側ループの最大実行回数
         includes_comp_loop (bool): 内包表記([_ for...]など)をループに数える
         forced_execution_mode (bool): ループを例外発生時に無視して強制実行
+        sampling (HookSampling): extra_hooksを呼び出すループの実行のサンプリング(Noneなら全て)
+        spin_threshold (float): 周期の期限の前にsleepせずにビジーウェイトする時間(秒)
 
     Examples:
 
@@ -477,12 +759,24 @@ class RunningWithOuterFrequency(RunningWithLoopHook):
         >>> print(round(time.time() - start_time))
         10
 
+        周期に間に合わなかった回数とジッタはfrequency_statsで参照できる
+
+        >>> for id, stats in feature.frequency_stats.items():
+        >>>     print(id, stats.overruns, stats.mean_jitter, stats.histogram)
+
     Note:
         frequency<=0なら周波数制御は行わない(スロットリング最大)
         frequencyとthrottling_modeのどちらかは指定する必要がある
         max_outer_loop_count、max_inner_loop_count<0は無限ループを許可
         forced_execution_modeがTrueのとき、FOR、WHILEなら、実行回数オーバー、
         タイムアウト時に例外を送出せず、ループを強制中断して強引に処理を続ける
+        FOR、WHILEの実行回数と内側ループのタイムアウトのチェックはループの先頭に直接コンパイルし、
+        周波数制御かextra_hooksがあるループと内包表記のみ__loop_inter_hook__を呼び出す
+        samplingで間引くのはextra_hooksの呼び出しのみで、周波数制御と回数、タイムアウトのチェックは間引かない
+        extra_hooksが全てHookSignal.DETACHを返したら、周波数制御のないループは直接コンパイルしたチェックに切り替える
+        周波数制御は周期の期限を絶対時刻で決め、期限の直前spin_thresholdの間はビジーウェイトする(FrequencyLoopHook)
+        ビジーウェイトはCPUを使うので、既定の0.001秒では500Hzで最大1コアの半分を使う(0ならsleepのみ)
+        frequency_statsは最後に実行したコードの最も外側のループのid毎のFrequencyStats
     """
     def __init__(self,
                  frequency:float=-1.,
@@ -491,79 +785,491 @@ class RunningWithOuterFrequency(RunningWithLoopHook):
                  max_outer_loop_count:int=-1,
                  max_inner_loop_count:int=-1,
                  includes_comp_loop:bool=True,
-                 forced_execution_mode:bool=False):
-        super().__init__(includes_comp_loop=includes_comp_loop, forced_execution_mode=forced_execution_mode)
+                 forced_execution_mode:bool=False,
+                 sampling:Optional[HookSampling]=None,
+                 spin_threshold:float=0.001):
+        super().__init__(includes_comp_loop=includes_comp_loop, forced_execution_mode=forced_execution_mode, sampling=sampling)
         assert not(frequency<=0 and throttling_mode==True), "frequency<=0 and throttling mode cannot be used at the same time"
         self.frequency = frequency
         self.throttling_mode = throttling_mode
+        self.spin_threshold = spin_threshold
+        self.frequency_stats = {}
         self.max_loop_timeout = max_loop_timeout
         self.max_outer_loop_count = max_outer_loop_count
         self.max_inner_loop_count = max_inner_loop_count
         self.extra_hooks = []
-    
-    def update_tree(self,
-                    root:ast.AST,
-                    ext_objects:Optional[Dict[str,object]]):
-        hook_nodes = self._get_tree(root)
-        all_hook_targets = []
-        id_hook_nodes = {}
+
+    def tree_key(self) -> Optional[tuple]:
+        return (self.includes_comp_loop, self.forced_execution_mode, self.throttling_mode,
+                self.max_loop_timeout, self.max_outer_loop_count, self.max_inner_loop_count, len(self.extra_hooks) > 0)
+
+    def tree_handler(self) -> Optional[TreeHandler]:
+        return _LoopGuardHandler(includes_comp_loop=self.includes_comp_loop,
+                                 forced_execution_mode=self.forced_execution_mode,
+                                 throttling_mode=self.throttling_mode,
+                                 max_loop_timeout=self.max_loop_timeout,
+                                 max_outer_loop_count=self.max_outer_loop_count,
+                                 max_inner_loop_count=self.max_inner_loop_count,
+                                 uses_extra_hooks=len(self.extra_hooks) > 0)
+
+    def bind_tree(self,
+                  tree_data:List[LoopHookTarget],
+                  ext_objects:Optional[Dict[str,object]]):
+        # ループは行きがけ順の番号で、子孫のループの番号は連続する
+        all_targets = []
+        descendants = []
         def add_hook_node(nodes):
-            nonlocal all_hook_targets, id_hook_nodes
             for node in nodes:
-                all_hook_targets.append(HookTarget(node.id))
-                id_hook_nodes[node.id] = node
-                if node.children is not None:
-                    add_hook_node(node.children)
-        add_hook_node(hook_nodes)
-
-        hooks = []
-
-        frequency_hook_targets = []
-        outer_hook_targets = []
-        inner_hook_targets = []
-        for target in id_hook_nodes.values():
-            if target.depth > 0:
-                inner_hook_targets.append(HookTarget(target.id))
-            elif target.depth == 0:
-                outer_hook_targets.append(HookTarget(target.id))
-            if target.depth == 0 and ( \
-                    target.loop == LoopHookType.FOR or \
-                    target.loop == LoopHookType.WHILE):
-                frequency_hook_targets.append(HookTarget(target.id))
-
+                index = len(all_targets)
+                all_targets.append(node)
+                descendants.append(None)
+                add_hook_node(node.children)
+                descendants[index] = [target.id for target in all_targets[index+1:]]
+        add_hook_node(tree_data)
+        indices = {target.id:index for index, target in enumerate(all_targets)}
+
+        frequency_hook = None
         if self.throttling_mode:
-            hooks.append(FrequencyLoopHook(frequency_hook_targets, self.frequency))
-
-        if self.max_loop_timeout > 0:
-            hooks.append(TimeoutLoopHook(inner_hook_targets, self.max_loop_timeout))
-
-        if self.max_outer_loop_count >= 0:
-            hooks.append(CounterLoopHook(outer_hook_targets, self.max_outer_loop_count))
-
-        if self.max_inner_loop_count >= 0:
-            hooks.append(CounterLoopHook(inner_hook_targets, self.max_inner_loop_count))
-
-        def clear_hook_node(nodes):
-            for node in nodes:
-                for hook in hooks + self.extra_hooks:
-                    if isinstance(hook, LoopHook):
-                        hook.clear_loop(id=node.id)                
-                if node.children is not None:
-                    clear_hook_node(node.children)
+            frequency_hook_targets = [HookTarget(target.id) for target in all_targets if target.depth == 0 and \
+                                      (target.loop == LoopHookType.FOR or target.loop == LoopHookType.WHILE)]
+            frequency_hook = FrequencyLoopHook(frequency_hook_targets, self.frequency, spin_threshold=self.spin_threshold)
+            self.frequency_stats = frequency_hook.stats
+
+        extra_hooks = [hook for hook in self.extra_hooks if hook is not None and isinstance(hook, HookBase)]
+        clear_hooks = [hook for hook in extra_hooks if isinstance(hook, LoopHook)]
+
+        def detach_hooks(detached:list):
+            nonlocal extra_hooks, clear_hooks
+            extra_hooks = [hook for hook in extra_hooks if hook not in detached]
+            clear_hooks = [hook for hook in clear_hooks if hook not in detached]
+            ext_objects["__loop_hook_on__"] = len(extra_hooks) > 0
+
+        counts = [0] * len(all_targets)
+        deadlines = [0] * len(all_targets)
+        max_loop_timeout = self.max_loop_timeout
+        max_outer_loop_count = self.max_outer_loop_count
+        max_inner_loop_count = self.max_inner_loop_count
+        sample = self.sampling.sampler() if self.sampling is not None else None
 
         def __loop_inter_hook__(id:int, obj:Optional[object]=None):
-            try:
-                lineno = id_hook_nodes[id].lineno
-            except AttributeError:
-                lineno = 0
-            if id_hook_nodes[id].children is not None:
-                clear_hook_node(id_hook_nodes[id].children)
-            for hook in hooks + self.extra_hooks:
-                if hook is not None and isinstance(hook, HookBase):
-                    hook.hook(id=id, lineno=lineno)
+            index = indices[id]
+            target = all_targets[index]
+            size = len(descendants[index])
+            sampled = len(extra_hooks) > 0 and (sample is None or sample())
+            if size > 0:
+                counts[index+1:index+1+size] = deadlines[index+1:index+1+size] = [0] * size
+                for hook in clear_hooks:
+                    for child_id in descendants[index]:
+                        hook.clear_loop(id=child_id)
+            if frequency_hook is not None and target.depth == 0:
+                frequency_hook.hook(id=id, lineno=0)
+            if target.depth > 0 and max_loop_timeout > 0:
+                now = time.monotonic()
+                if 0 < deadlines[index] < now:
+                    raise SnippetLoopTimeout
+                deadlines[index] = now + max_loop_timeout
+            maxcount = max_outer_loop_count if target.depth == 0 else max_inner_loop_count
+            if maxcount >= 0:
+                counts[index] += 1
+                if counts[index] > maxcount:
+                    raise SnippetLoopOvertime()
+            if sampled:
+                detached = [hook for hook in extra_hooks if hook.hook(id=id, lineno=0) is HookSignal.DETACH]
+                if len(detached) > 0:
+                    detach_hooks(detached)
             return obj
 
         assert "__loop_inter_hook__" not in ext_objects
         ext_objects["__loop_inter_hook__"] = __loop_inter_hook__
+        ext_objects["__loop_hook_on__"] = len(extra_hooks) > 0
+        ext_objects["__loop_counts__"] = counts
+        ext_objects["__loop_deadlines__"] = deadlines
+        ext_objects["__loop_clock__"] = time.monotonic
+        ext_objects["__loop_overtime__"] = SnippetLoopOvertime
+        ext_objects["__loop_timeout__"] = SnippetLoopTimeout
         ext_objects["SnippetOvertime"] = SnippetOvertime
 
+
+class _SteppingHandler(TreeHandler):
+    "bodyの各文を1ステップ毎のHookとエラー処理で囲む"
+    PREFIX = AstTemplate('if __step_prefix_on__:\n  __step_prefix_hook__(ID,LINENO)')
+    POSTFIX = AstTemplate('if __step_postfix_on__:\n  __step_postfix_hook__(ID,LINENO)')
+    EXTER = AstTemplate('try:\n  BODY\nexcept Exception as __e:\n  __step_error_hook__(ID,LINENO,__e)')
+    INTER = AstTemplate('try:\n  BODY\nexcept SnippetStepBreak:\n  pass')
+
+    def __init__(self):
+        self.hooktargets = []
+
+    def body(self, node:ast.AST, body:List[ast.stmt]) -> List[ast.stmt]:
+        newbody = []
+        for stmt in body:
+            lineno = getattr(stmt, 'lineno', 0)
+            try_prefix = self.PREFIX.clone(stmt, ID=id(stmt), LINENO=lineno)
+            try_postfix = self.POSTFIX.clone(stmt, ID=id(stmt), LINENO=lineno)
+            newbody.append(self.EXTER.clone(stmt, ID=id(stmt), LINENO=lineno, BODY=[try_prefix,stmt,try_postfix]))
+            self.hooktargets.append(id(stmt))
+        return [self.INTER.clone(body[0] if len(body) > 0 else None, BODY=newbody)]
+
+    def result(self) -> List[int]:
+        return self.hooktargets
+
+
+class _StepTableHandler(TreeHandler):
+    "bodyの各文の行の範囲と種類(return文、break/continue文、ループ)の表を作る(コードは変形しない)"
+    KINDS = {ast.Return:'return', ast.Break:'jump', ast.Continue:'jump', ast.For:'loop', ast.AsyncFor:'loop', ast.While:'loop'}
+
+    def __init__(self):
+        self.statements = []
+
+    def body(self, node:ast.AST, body:List[ast.stmt]) -> List[ast.stmt]:
+        for stmt in body:
+            lineno = getattr(stmt, 'lineno', 0)
+            self.statements.append((lineno, getattr(stmt, 'end_lineno', None) or lineno, id(stmt), self.KINDS.get(type(stmt))))
+        return body
+
+    def result(self) -> List[Tuple[int,int,int,Optional[str]]]:
+        # 外側の文が先になる順番
+        return sorted(self.statements, key=lambda statement:(statement[0], -statement[1]))
+
+
+class _StepMonitor:
+    """sys.monitoringのイベントで、スニペットのコードオブジェクトの実行中に1ステップ毎のHookを呼び出す
+
+    Note:
+        文の始まりの行のLINEで実行前のHookを呼び出し、フレーム毎の実行中の文のスタックから、
+        行が範囲外になった文の実行後のHookを呼び出す(文の始まりでない行のLINEはDISABLEで止める)
+        例外やreturn文、break/continue文で抜けた文は、ASTの変形と同じく実行後のHookを呼び出さない
+        LINEとPY_RETURNは1ステップ毎のHookがある時にスニペットのコードオブジェクトのみ、
+        RAISEとPY_UNWINDは実行中のみ全体で有効にして、イベントは実行中のスレッドの_StepMonitorに振り分ける
+    """
+    TOOL_NAME = 'remoteexec'
+    tool_id = None
+    lock = threading.Lock()
+    running = threading.local()
+    code_counts = {}
+    monitor_count = 0
+
+    def __init__(self,
+                 statements:List[Tuple[int,int,int,Optional[str]]],
+                 prefix_hook:Optional[Callable[[int,int,types.FrameType],None]],
+                 postfix_hook:Optional[Callable[[int,int,types.FrameType],None]],
+                 error_approach:Optional[Callable[[int,int,Exception],Optional[StepErrorApproach]]]):
+        self.statements = statements
+        self.starts = {}
+        for statement in statements:
+            self.starts.setdefault(statement[0], statement)
+        self.lines = {}
+        self.prefix_hook = prefix_hook
+        self.postfix_hook = postfix_hook
+        self.error_approach = error_approach
+        self.stepping = prefix_hook is not None
+        self.frames = {}
+        self.raised = set()
+        self.codes = []
+        self.code_ids = set() # コードオブジェクトのハッシュは遅いのでidで判定する
+        self.previous = None
+
+    @classmethod
+    def _tool(cls) -> int:
+        if cls.tool_id is None:
+            # 0,1,2,5はデバッガ、カバレッジ、プロファイラ、オプティマイザ用
+            for tool_id in (3, 4):
+                if _MONITORING.get_tool(tool_id) is None:
+                    _MONITORING.use_tool_id(tool_id, cls.TOOL_NAME)
+                    break
+            else:
+                raise RuntimeError('no sys.monitoring tool id is available')
+            events = _MONITORING.events
+            _MONITORING.register_callback(tool_id, events.LINE, cls._on_line)
+            _MONITORING.register_callback(tool_id, events.PY_RETURN, cls._on_return)
+            _MONITORING.register_callback(tool_id, events.RAISE, cls._on_raise)
+            _MONITORING.register_callback(tool_id, events.PY_UNWIND, cls._on_unwind)
+            cls.tool_id = tool_id
+        return cls.tool_id
+
+    @staticmethod
+    def _code_objects(code:types.CodeType):
+        yield code
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                yield from _StepMonitor._code_objects(const)
+
+    def start(self, code:types.CodeType):
+        "実行するスレッドでcodeとその中の関数などのコードオブジェクトのイベントを有効にする"
+        cls = _StepMonitor
+        with cls.lock:
+            tool_id = cls._tool()
+            events = _MONITORING.events
+            self.codes = list(cls._code_objects(code))
+            self.code_ids = set(id(code_object) for code_object in self.codes)
+            if self.stepping:
+                for code_object in self.codes:
+                    count = cls.code_counts.get(id(code_object), 0)
+                    if count == 0:
+                        _MONITORING.set_local_events(tool_id, code_object, events.LINE | events.PY_RETURN)
+                    cls.code_counts[id(code_object)] = count + 1
+            if cls.monitor_count == 0:
+                _MONITORING.set_events(tool_id, events.RAISE | events.PY_UNWIND)
+            cls.monitor_count += 1
+        self.previous = getattr(cls.running, 'monitor', None)
+        cls.running.monitor = self
+
+    def _release_codes(self):
+        "他の実行が使っていないコードオブジェクトのLINEとPY_RETURNを止める(lockを取って呼ぶ)"
+        cls = _StepMonitor
+        for code_object in self.codes:
+            cls.code_counts[id(code_object)] -= 1
+            if cls.code_counts[id(code_object)] == 0:
+                del cls.code_counts[id(code_object)]
+                _MONITORING.set_local_events(cls.tool_id, code_object, 0)
+
+    def stop(self):
+        cls = _StepMonitor
+        cls.running.monitor = self.previous
+        with cls.lock:
+            if self.stepping:
+                self._release_codes()
+            cls.monitor_count -= 1
+            if cls.monitor_count == 0:
+                _MONITORING.set_events(cls.tool_id, 0)
+        self.frames.clear()
+        self.raised.clear()
+
+    def detach(self):
+        "1ステップ毎のHookが全て外れたら、実行中でもLINEとPY_RETURNを止める"
+        with _StepMonitor.lock:
+            if self.stepping:
+                self.stepping = False
+                self._release_codes()
+        self.frames.clear()
+
+    @staticmethod
+    def _on_line(code:types.CodeType, lineno:int):
+        # 1行毎に呼ばれるので、呼び出しをまとめている
+        self = getattr(_StepMonitor.running, 'monitor', None)
+        if self is None or not self.stepping or id(code) not in self.code_ids:
+            return None
+        statement = self.starts.get(lineno)
+        if statement is None:
+            return _MONITORING.DISABLE
+        frame = sys._getframe(1)
+        stack = self.frames.get(frame)
+        if stack is None:
+            stack = self.frames[frame] = []
+        if len(self.raised) > 0 and frame in self.raised:
+            self.raised.discard(frame)
+            self._leave(stack, lineno, False, frame)
+        else:
+            while len(stack) > 0 and not (stack[-1][0] <= lineno <= stack[-1][1]):
+                ended = stack.pop()
+                if ended[3] == 'jump':
+                    self._jump(stack)
+                else:
+                    self.postfix_hook(ended[2], ended[0], frame)
+        if len(stack) > 0 and stack[-1] is statement:
+            return None # ループの先頭の行
+        stack.append(statement)
+        self.prefix_hook(statement[2], lineno, frame)
+        return None
+
+    @staticmethod
+    def _on_return(code:types.CodeType, offset:int, retval:object):
+        self = getattr(_StepMonitor.running, 'monitor', None)
+        if self is not None:
+            frame = sys._getframe(1)
+            stack = self.frames.pop(frame, None)
+            completed = frame not in self.raised
+            self.raised.discard(frame)
+            if stack is not None and len(stack) > 0 and stack[-1][3] != 'return':
+                self._leave(stack, -1, completed, frame)
+
+    @staticmethod
+    def _on_raise(code:types.CodeType, offset:int, exception:BaseException):
+        self = getattr(_StepMonitor.running, 'monitor', None)
+        if self is not None and id(code) in self.code_ids:
+            self.raise_exception(sys._getframe(1), exception)
+
+    @staticmethod
+    def _on_unwind(code:types.CodeType, offset:int, exception:BaseException):
+        self = getattr(_StepMonitor.running, 'monitor', None)
+        if self is not None and id(code) in self.code_ids:
+            frame = sys._getframe(1)
+            self.frames.pop(frame, None)
+            self.raised.discard(frame)
+
+    def _leave(self, stack:list, lineno:int, completed:bool, frame:types.FrameType):
+        "行がlinenoになって範囲外になった文をスタックから外す(completedがFalseなら実行後のHookを呼ばない)"
+        while len(stack) > 0 and not (stack[-1][0] <= lineno <= stack[-1][1]):
+            ended = stack.pop()
+            if ended[3] == 'jump':
+                self._jump(stack)
+            elif completed:
+                self.postfix_hook(ended[2], ended[0], frame)
+
+    @staticmethod
+    def _jump(stack:list):
+        "break/continue文で抜けたループの中の文を、実行後のHookを呼ばずにスタックから外す"
+        while len(stack) > 0 and stack[-1][3] != 'loop':
+            stack.pop()
+
+    def _statement_at(self, lineno:int) -> Optional[Tuple[int,int,int,Optional[str]]]:
+        "linenoを含む最も内側の文"
+        if lineno not in self.lines:
+            found = None
+            for statement in self.statements:
+                if statement[0] > lineno:
+                    break
+                if lineno <= statement[1]:
+                    found = statement
+            self.lines[lineno] = found
+        return self.lines[lineno]
+
+    def raise_exception(self, frame:types.FrameType, exception:BaseException):
+        lineno = frame.f_lineno
+        stack = self.frames.get(frame)
+        if stack is not None:
+            # 例外の前に終わった文は実行後のHookを呼び、例外で抜ける文は次の行かreturnで外す
+            self._leave(stack, lineno, frame not in self.raised, frame)
+            self.raised.add(frame)
+        if self.error_approach is None or lineno is None:
+            return
+        statement = self._statement_at(lineno)
+        if statement is None:
+            return
+        result = self.error_approach(statement[2], statement[0], exception)
+        if result is not None and result != StepErrorApproach.DEFAULT:
+            raise SnippetStepError(exception)
+
+
+class _EvalCheckHandler(TreeHandler):
+    "bodyの各文の後に変数をチェックするHookを入れる"
+    EVAL = AstTemplate('if __step_eval_on__ and __step_target_hook__(ID,LINENO):\n  __step_eval_hook__(ID,LINENO,__step_locals__())')
+
+    def __init__(self):
+        self.hooktargets = []
+
+    def body(self, node:ast.AST, body:List[ast.stmt]) -> List[ast.stmt]:
+        newbody = []
+        for stmt in body:
+            newbody.append(stmt)
+            newbody.append(self.EVAL.clone(stmt, ID=id(stmt), LINENO=getattr(stmt, 'lineno', 0)))
+            self.hooktargets.append(id(stmt))
+        return newbody
+
+    def result(self) -> List[int]:
+        return self.hooktargets
+
+
+class _LoopHookHandler(TreeHandler):
+    "ループの先頭(内包表記は要素の式)にHookを入れて、ループの入れ子をLoopHookTargetの木にする"
+    node_types = (ast.While, ast.For, ast.AsyncFor, ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+    LOOP_INTER = AstTemplate('if __loop_hook_on__:\n  __loop_inter_hook__(id=ID)')
+    COMP_INTER = AstTemplate('(__loop_inter_hook__(id=ID,obj=OBJ) if __loop_hook_on__ else OBJ)')
+    LOOP_EXTER = AstTemplate('try:\n  BODY\nexcept SnippetOvertime:\n  break')
+
+    def __init__(self, includes_comp_loop:bool, forced_execution_mode:bool):
+        self.includes_comp_loop = includes_comp_loop
+        self.forced_execution_mode = forced_execution_mode
+        self.hook_nodes = []
+        self.stack = [self.hook_nodes]
+
+    def _is_hooked(self, node:ast.AST) -> bool:
+        return self.includes_comp_loop or type(node) in (ast.While, ast.For, ast.AsyncFor)
+
+    def enter(self, node:ast.AST):
+        if not self._is_hooked(node):
+            return
+        if type(node) is ast.While: # while文なら
+            loop = LoopHookType.WHILE
+        elif type(node) is ast.AsyncFor or type(node) is ast.For: # for文なら
+            loop = LoopHookType.FOR
+        else: # [_ for ...]文なら
+            loop = LoopHookType.COMP
+        children = []
+        self.stack[-1].append(LoopHookTarget(id(node), len(self.stack)-1, loop, children))
+        self.stack.append(children)
+
+    def body(self, node:ast.AST, body:List[ast.stmt]) -> List[ast.stmt]:
+        if type(node) is not ast.While and type(node) is not ast.For and type(node) is not ast.AsyncFor:
+            return body
+        body = self.loop_prefix(node) + body
+        if self.forced_execution_mode:
+            body = [self.LOOP_EXTER.clone(node, BODY=body)]
+        return body
+
+    def loop_prefix(self, node:ast.AST) -> List[ast.stmt]:
+        "ループの先頭に入れる文"
+        return [self.LOOP_INTER.clone(node, ID=id(node))]
+
+    def leave(self, node:ast.AST):
+        if not self._is_hooked(node):
+            return
+        self.stack.pop()
+        if type(node) is ast.DictComp:
+            node.value = self.COMP_INTER.clone(node.value, ID=id(node), OBJ=node.value).value
+        elif type(node) is not ast.While and type(node) is not ast.For and type(node) is not ast.AsyncFor:
+            node.elt = self.COMP_INTER.clone(node.elt, ID=id(node), OBJ=node.elt).value
+
+    def result(self) -> List[LoopHookTarget]:
+        return self.hook_nodes
+
+
+class _LoopGuardHandler(_LoopHookHandler):
+    """
+    Hookを呼び出す代わりに、ループの回数と内側ループのタイムアウトのチェックをループの先頭に直接入れる
+    (周波数制御と追加のHookがあるループ、内包表記は__loop_inter_hook__でチェックする)
+    追加のHookがあるループは、Hookが全て外れた時に切り替える直接のチェックも一緒にコンパイルする
+    """
+    CLEAR = AstTemplate('__loop_counts__[START:STOP] = __loop_deadlines__[START:STOP] = ZEROS')
+    TIMEOUT_CHECK = AstTemplate('if 0 < __loop_deadlines__[INDEX] < __loop_clock__():\n  raise __loop_timeout__')
+    TIMEOUT_UPDATE = AstTemplate('__loop_deadlines__[INDEX] = __loop_clock__() + TIMEOUT')
+    COUNT = AstTemplate('__loop_counts__[INDEX] += 1')
+    COUNT_CHECK = AstTemplate('if __loop_counts__[INDEX] > MAXCOUNT:\n  raise __loop_overtime__')
+    LOOP_CALL = AstTemplate('__loop_inter_hook__(id=ID)')
+    EXTRA_SWITCH = AstTemplate('if __loop_hook_on__:\n  __loop_inter_hook__(id=ID)\nelse:\n  GUARDS')
+    COMP_INTER = AstTemplate('__loop_inter_hook__(id=ID,obj=OBJ)') # 内包表記は常にHookでチェックする
+
+    def __init__(self,
+                 includes_comp_loop:bool,
+                 forced_execution_mode:bool,
+                 throttling_mode:bool,
+                 max_loop_timeout:float,
+                 max_outer_loop_count:int,
+                 max_inner_loop_count:int,
+                 uses_extra_hooks:bool):
+        super().__init__(includes_comp_loop=includes_comp_loop, forced_execution_mode=forced_execution_mode)
+        self.throttling_mode = throttling_mode
+        self.max_loop_timeout = max_loop_timeout
+        self.max_outer_loop_count = max_outer_loop_count
+        self.max_inner_loop_count = max_inner_loop_count
+        self.uses_extra_hooks = uses_extra_hooks
+        self.indices = {}
+        self.loop_count = 0
+
+    def enter(self, node:ast.AST):
+        if self._is_hooked(node):
+            self.indices[id(node)] = (self.loop_count, len(self.stack)-1)
+            self.loop_count += 1
+        super().enter(node)
+
+    def loop_prefix(self, node:ast.AST) -> List[ast.stmt]:
+        index, depth = self.indices[id(node)]
+        if self.throttling_mode and depth == 0:
+            return [self.LOOP_CALL.clone(node, ID=id(node))]
+        prefix = []
+        size = self.loop_count - index - 1 # 子孫のループ(走査済み)
+        if size > 0:
+            prefix.append(self.CLEAR.clone(node, START=index+1, STOP=index+1+size, ZEROS=(0,)*size))
+        if depth > 0 and self.max_loop_timeout > 0:
+            prefix.append(self.TIMEOUT_CHECK.clone(node, INDEX=index))
+            prefix.append(self.TIMEOUT_UPDATE.clone(node, INDEX=index, TIMEOUT=self.max_loop_timeout))
+        maxcount = self.max_outer_loop_count if depth == 0 else self.max_inner_loop_count
+        if maxcount >= 0:
+            prefix.append(self.COUNT.clone(node, INDEX=index))
+            prefix.append(self.COUNT_CHECK.clone(node, INDEX=index, MAXCOUNT=maxcount))
+        if self.uses_extra_hooks:
+            # extra_hooksが全て外れたら、Hookの呼び出しから直接コンパイルしたチェックに切り替える
+            if len(prefix) == 0:
+                return [self.LOOP_INTER.clone(node, ID=id(node))]
+            return [self.EXTRA_SWITCH.clone(node, ID=id(node), GUARDS=prefix)]
+        return prefix
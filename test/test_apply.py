@@ -601,3 +601,262 @@ class TestDiffApply:
         apply_unsirial(c1, d, idmap_target_object={id(c1):old1,id(c2):old2})
         assert c1.hogehoge == 'value1'
         assert [d for d in dir(c1) if not d.startswith('__')] == ['hogehoge']
+
+
+class TestSequenceApply:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__insert_sequenceapply(self, init_instance):
+        c = [1,2,3]
+        a = SyncSharedObject(updated_member = [],
+                             created_member = [],
+                             deleted_member = [],
+                             created_instance = [],
+                             deleted_instance = [],
+                             patched_member = [SyncInstancePatch(instance_id=id(c), member_name=None, patch_type='sequence',
+                                                                 value=[['insert', 0, [{'type': 'native', 'value': 0}]],
+                                                                        ['delete', 2, 1],
+                                                                        ['move', 0, 2],
+                                                                        ['update', 0, [{'type': 'native', 'value': 'A'}]]])])
+        apply_unsirial(c, a)
+        assert c == ['A', 3, 0]
+
+    def test__diff_sequenceapply(self, init_instance):
+        c = {'hoge':[{'A':1},{'B':2},{'C':3}]}
+        d1 = dumps(c, snippet_share_only=False)
+        c['hoge'].append(c['hoge'].pop(0))
+        c['hoge'].insert(1, {'D':4})
+        del c['hoge'][0]
+        d2 = dumps(c, snippet_share_only=False)
+        d = diff(d1, d2)
+        e = {'hoge':[{'A':1},{'B':2},{'C':3}]}
+        idmap = {id(e):id(c), id(e['hoge']):id(c['hoge'])}
+        idmap.update({id(e['hoge'][i]):id(c['hoge'][j]) for i, j in [(0,2),(2,1)]})
+        apply_unsirial(e, d, idmap_target_object=idmap)
+        assert e == {'hoge':[{'D':4},{'C':3},{'A':1}]}
+
+    def test__none_sequenceapply(self, init_instance):
+        c = {'x':[1,2,3,4]}
+        d1 = dumps(c, snippet_share_only=False)
+        e = loads(d1)
+        c['x'][1] = None
+        d2 = dumps(c, snippet_share_only=False)
+        d = SyncSharedObject.unserialized(diff(d1, d2).serialize())
+        apply_unsirial(e, d, idmap_target_object={id(e):id(c), id(e['x']):id(c['x'])})
+        assert e == {'x':[1,None,3,4]}
+
+
+class TestSharedLogApply:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__append_logapply(self, init_instance):
+        c = {'log':SharedLog(maxlen=3, entries=[1,2])}
+        d1 = dumps(c, snippet_share_only=False)
+        e = loads(d1)
+        c['log'].extend([3,{'A':4}])
+        d2 = dumps(c, snippet_share_only=False, log_since={id(c['log']):2})
+        d = SyncSharedObject.unserialized(diff(d1, d2).serialize())
+        idmap = {id(e):id(c), id(e['log']):id(c['log'])}
+        assert e['log'].consume() == [1,2]
+        apply_unsirial(e, d, idmap_target_object=idmap)
+        assert e['log'].sequence == 4
+        assert list(e['log']) == [2,3,{'A':4}]
+        assert e['log'].consume() == [3,{'A':4}]
+
+    def test__locallyappended_logapply(self, init_instance):
+        c = SharedLog(entries=[1,2])
+        a = SyncSharedObject(updated_member = [],
+                             created_member = [],
+                             deleted_member = [],
+                             created_instance = [],
+                             deleted_instance = [],
+                             patched_member = [SyncInstancePatch(instance_id=id(c), member_name=None, patch_type='log',
+                                                                 value={'sequence':1, 'entries':[{'type':'native','value':'B'}], 'truncate':True, 'known':2})])
+        c.append('local')
+        apply_unsirial(c, a)
+        assert list(c) == [1,'B','local']
+        assert c.sequence == 3
+
+class TestTextApply:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__text_apply(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_share
+        class clz:
+            def __init__(self):
+                self.text = 'abc'*5000
+                self.d = {'text':'xyz'*5000}
+        c = clz()
+        d1 = dumps(c)
+        e = loads(d1)
+        c.text = 'abc'*2000 + 'XYZ' + 'abc'*2999
+        c.d['text'] += 'end'
+        d2 = dumps(c)
+        d = SyncSharedObject.unserialized(diff(d1, d2).serialize())
+        assert len(d.patched_member) == 2
+        idmap = {id(e):id(c), id(e.d):id(c.d)}
+        apply_unsirial(e, d, idmap_target_object=idmap)
+        assert e.text == c.text
+        assert e.d['text'] == c.d['text']
+
+    def test__changed_text_apply(self, init_instance):
+        c = {'text':'abc'}
+        a = SyncSharedObject(updated_member = [],
+                             created_member = [],
+                             deleted_member = [],
+                             created_instance = [],
+                             deleted_instance = [],
+                             patched_member = [SyncInstancePatch(instance_id=id(c), member_name={'type':'native','value':'text'}, patch_type='text',
+                                                                 value={'length':4, 'ops':[['append','d']]})])
+        with pytest.raises(AttributeCannotUpdateError):
+            apply_unsirial(c, a)
+        unapplied = []
+        apply_unsirial(c, a, unapplied=unapplied)
+        assert c['text'] == 'abc'
+        assert unapplied == [[id(c), {'type':'native','value':'text'}]]
+
+    def test__changed_samelength_text_apply(self, init_instance):
+        c = {'text':'abc'*5000}
+        d1 = dumps(c, snippet_share_only=False)
+        c['text'] = 'abc'*5000 + 'd'
+        d2 = dumps(c, snippet_share_only=False)
+        d = SyncSharedObject.unserialized(diff(d1, d2).serialize())
+        assert d.patched_member[0].patch_type == 'text'
+        e = {'text':'xyz' + 'abc'*4999} # 同じ長さで内容が異なる
+        unapplied = []
+        apply_unsirial(e, d, idmap_target_object={id(e):id(c)}, unapplied=unapplied)
+        assert e['text'] == 'xyz' + 'abc'*4999
+        assert len(unapplied) == 1
+        e = {'text':'abc'*5000}
+        apply_unsirial(e, d, idmap_target_object={id(e):id(c)})
+        assert e['text'] == c['text']
+
+class TestStructApply:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__struct_apply(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_struct
+        class clz:
+            pass
+        for i in range(200):
+            clz.__annotations__[f'f{i}'] = float
+            setattr(clz, f'f{i}', 0.)
+        clz = remoteexec.communicate.serializer.snippet_struct(clz)
+        c = clz()
+        d1 = dumps(c)
+        e = loads(d1)
+        c.f10, c.f199 = 1.25, -3.5
+        d2 = dumps(c)
+        serialized = json.dumps(diff(d1, d2).serialize())
+        assert len(serialized) < 500
+        d = SyncSharedObject.unserialized(json.loads(serialized))
+        apply_unsirial(e, d, idmap_target_object={id(e):id(c)})
+        assert e.f10 == 1.25
+        assert e.f199 == -3.5
+        assert e.f11 == 0.
+
+    def test__struct_unpackable_apply(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_struct
+        class clz:
+            x: int = 0
+            y: float = 0.
+        c = clz()
+        d1 = dumps(c)
+        e = loads(d1)
+        for x, y in [(2.5, 1.), (None, 2.), (2**70, 3.), (0, 4.), (5, None), (6, 5.)]:
+            c.x, c.y = x, y
+            d2 = dumps(c)
+            d = SyncSharedObject.unserialized(json.loads(json.dumps(diff(d1, d2).serialize())))
+            apply_unsirial(e, d, idmap_target_object={id(e):id(c)})
+            assert (e.x, e.y) == (x, y) and type(e.x) is type(x)
+            d1 = d2
+
+class TestTableApply:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__table_apply(self, init_instance):
+        c = {'table':SharedTable([('step','q'),('value','f')], rows=[(i, 0.) for i in range(100)])}
+        d1 = dumps(c, snippet_share_only=False)
+        e = loads(d1)
+        c['table'].extend([(100, 1.), (101, 2.)])
+        c['table']['value'][10] = .5
+        d2 = dumps(c, snippet_share_only=False)
+        d = SyncSharedObject.unserialized(json.loads(json.dumps(diff(d1, d2).serialize())))
+        e['table'].append((-1, -1.))
+        apply_unsirial(e, d, idmap_target_object={id(e):id(c), id(e['table']):id(c['table'])})
+        assert len(e['table']) == 103
+        assert e['table'][10] == {'step':10, 'value':.5}
+        assert e['table'][101] == {'step':101, 'value':2.}
+        assert e['table'][102] == {'step':-1, 'value':-1.}
+
+class TestBufferApply:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__buffer_apply(self, init_instance):
+        c = {'ba':bytearray(b'abc'), 'mv':memoryview(bytearray(8)).cast('i')}
+        d1 = dumps(c, snippet_share_only=False)
+        e, id_map = loads(d1, return_id_map=True)
+        ba, mv = e['ba'], e['mv']
+        c['ba'][0] = ord('x')
+        c['mv'][1] = 5
+        d2 = dumps(c, snippet_share_only=False)
+        d = SyncSharedObject.unserialized(json.loads(json.dumps(diff(d1, d2).serialize())))
+        apply_unsirial(e, d, idmap_target_object=id_map)
+        assert e['ba'] is ba and ba == bytearray(b'xbc')
+        assert e['mv'] is mv and mv.tolist() == [0, 5]
+
+    def test__buffer_replace_apply(self, init_instance):
+        c = {'mv':memoryview(bytearray(8)).cast('i')}
+        d1 = dumps(c, snippet_share_only=False)
+        e, id_map = loads(d1, return_id_map=True)
+        d2 = dumps(c, snippet_share_only=False)
+        d2['instance'][id(c['mv'])]['shape'] = [1]
+        d2['instance'][id(c['mv'])]['dtype'] = 'q'
+        apply_unsirial(e, diff(d1, d2), idmap_target_object=id_map)
+        assert e['mv'].format == 'q' and e['mv'].tolist() == [0]
+
+    def test__buffer_block_apply(self, init_instance):
+        c = {'ba':bytearray(1000), 'b':bytes(1000)}
+        d1 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        e, id_map = loads(d1, return_id_map=True)
+        ba = e['ba']
+        c['ba'][950] = 1
+        d2 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        d2['instance'][id(c['b'])]['blocks'][1] = d2['instance'][id(c['ba'])]['blocks'][3]
+        d = diff(d1, d2)
+        assert all('changed' in p.value for p in d.patched_member)
+        d = SyncSharedObject.unserialized(json.loads(json.dumps(d.serialize())))
+        apply_unsirial(e, d, idmap_target_object=id_map)
+        assert e['ba'] is ba and ba == c['ba']
+        assert type(e['b']) is bytes and e['b'][350] == 1 and e['b'].count(0) == 999
+
+    def test__buffer_dirty_apply(self, init_instance):
+        c = {'ba':memoryview(bytearray(1000))}
+        d1 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        e, id_map = loads(d1, return_id_map=True)
+        mark_dirty(e['ba'])
+        dumps(e, snippet_share_only=False, buffer_block_size=300, restore_id_map=id_map)
+        c['ba'][350] = 1
+        d2 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        d = SyncSharedObject.unserialized(json.loads(json.dumps(diff(d1, d2).serialize())))
+        apply_unsirial(e, d, idmap_target_object=id_map)
+        f = dumps(e, snippet_share_only=False, buffer_block_size=300, restore_id_map=id_map)
+        d = diff(d2, f)
+        assert d.patched_member == [] and d.updated_member == [] # 受信したブロックを書き戻さない
+        e['ba'][10] = 2
+        mark_dirty(e['ba'], 10, 11)
+        d = diff(d2, dumps(e, snippet_share_only=False, buffer_block_size=300, restore_id_map=id_map))
+        assert [index for index, _ in d.patched_member[0].value['changed']] == [0]
+        unmark_dirty(e['ba'])
@@ -54,17 +54,19 @@ class TestComminucator:
         fpC = QueueIO(qc, qs)
         return fpS, fpC
     
-    def start_communicate(self, sync_frequency, reciever, shared_object, configure_object):
+    def start_communicate(self, sync_frequency, reciever, shared_object, configure_object, float_deadband=None, remote_reference_depth=None, contents=None, legacy_configure_object=None):
         fpS, fpC = self.make_io()
         server = Communicator(connection=fpS, sync_frequency=sync_frequency, use_compress=self.use_compress)
         client = Communicator(connection=fpC, sync_frequency=sync_frequency, use_compress=self.use_compress)
+        self.server = server
         def run_server():
             server.host(reciever=reciever)
         threadS = threading.Thread(target=run_server)
         threadS.start()
 
         def run_client():
-            client.client(shared_object=shared_object, configure_object=configure_object, conflict=ConflictSolvePolicy.HOST_PRIORITIZED, snippet_share_only=False)
+            client.client(shared_object=shared_object, configure_object=configure_object, conflict=ConflictSolvePolicy.HOST_PRIORITIZED, snippet_share_only=False, float_deadband=float_deadband,
+                          remote_reference_depth=remote_reference_depth, contents=contents, legacy_configure_object=legacy_configure_object)
         threadC = threading.Thread(target=run_client)
         threadC.start()
 
@@ -401,6 +403,299 @@ class TestComminucator:
         assert shared_object.hoge == reciever.shared_object.hoge
         assert shared_object.history[:4] == [(1,1),(2,16),(3,81),(4,256)]
 
+    def test__functionreference_server2client(self, init_instance):
+        history, sent = [], []
+        def update(x):
+            if not hasattr(x, 'stop'):
+                x.hoge += 1
+                history.append(x.buufuu(x.table) is x.items)
+        class shared:
+            def __init__(self):
+                self.hoge = 0
+                self.table = {str(i):i for i in range(1000)}
+                self.items = [1, 2, 3]
+            def buufuu(self, table):
+                sent.append(table is self.table)
+                return self.items
+        shared_object = shared()
+        configure_object = shared()
+        reciever = Reciever(update)
+        log = []
+        class Log(CommunicationLog):
+            def log(self, tag, command, dump):
+                if command == 'responce':
+                    log.append(len(dump))
+
+        fpS, fpC = self.make_io()
+        server = Communicator(connection=fpS, sync_frequency=100, use_compress=self.use_compress, log_hook=Log())
+        client = Communicator(connection=fpC, sync_frequency=100, use_compress=self.use_compress)
+        threadS = threading.Thread(target=lambda: server.host(reciever=reciever))
+        threadS.start()
+        threadC = threading.Thread(target=lambda: client.client(shared_object=shared_object, configure_object=configure_object, conflict=ConflictSolvePolicy.HOST_PRIORITIZED, snippet_share_only=False))
+        threadC.start()
+
+        time.sleep(.5)
+        shared_object.stop = 1
+        time.sleep(.1) # wait to sync
+        shared_object.end = 1
+
+        threadS.join()
+        threadC.join()
+        assert len(sent) > 0 and all(sent)
+        assert len(history) > 0 and all(history)
+        assert max(log) < 1000
+
+    def test__functionreference_changed_server2client(self, init_instance):
+        sent = []
+        def update(x):
+            if not hasattr(x, 'stop'):
+                x.hoge += 1
+                x.table['x'] = x.hoge # 同期後に変更したので参照渡ししない
+                x.buufuu(x.table, x.hoge)
+        class shared:
+            def __init__(self):
+                self.hoge = 0
+                self.table = {'x':0}
+            def buufuu(self, table, expected):
+                sent.append((table is self.table, table['x'] == expected))
+        shared_object = shared()
+        configure_object = shared()
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object)
+
+        time.sleep(.5)
+        shared_object.stop = 1
+        time.sleep(.1) # wait to sync
+        shared_object.end = 1
+
+        threadS.join()
+        threadC.join()
+        assert len(sent) > 0
+        assert all(not same and current for same, current in sent)
+
+    def test__functionreference_changed_return(self, init_instance):
+        returned = []
+        def update(x):
+            if not hasattr(x, 'stop'):
+                x.hoge += 1
+                items = x.buufuu(x.hoge)
+                returned.append((items is x.items, items[0] == x.hoge))
+        class shared:
+            def __init__(self):
+                self.hoge = 0
+                self.items = [0, 1, 2]
+            def buufuu(self, value):
+                # 同期済みのインスタンスを変更して返すので参照渡ししない
+                self.items[0] = value
+                returned.append(None)
+                return self.items
+        shared_object = shared()
+        configure_object = shared()
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object)
+
+        time.sleep(.5)
+        shared_object.stop = 1
+        time.sleep(.1) # wait to sync
+        shared_object.end = 1
+
+        threadS.join()
+        threadC.join()
+        results = [r for r in returned if r is not None]
+        assert len(results) > 0
+        assert all(not same and current for same, current in results)
+
+    def test__oneway_server2client(self, init_instance):
+        history, returns = [], []
+        def update(x):
+            if not hasattr(x, 'stop'):
+                x.hoge += 1
+                returns.append(x.buufuu(x.hoge))
+        class shared:
+            def __init__(self):
+                self.hoge = 0
+            @snippet_oneway
+            def buufuu(self, x):
+                history.append(x)
+                return x
+        shared_object = shared()
+        configure_object = shared()
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object)
+        
+        time.sleep(1)
+        shared_object.stop = 1
+        time.sleep(.1) # wait to sync
+        shared_object.end = 1
+        time.sleep(.1)
+
+        threadS.join()
+        threadC.join()
+        assert shared_object.hoge == reciever.shared_object.hoge
+        assert history == list(range(1, shared_object.hoge + 1))
+        assert set(returns) == {None}
+
+    def test__batch_server2client(self, init_instance):
+        history, returns, inside, outside = [], [], [], []
+        def update(x):
+            if x.hoge < 3:
+                x.hoge += 1
+                with batch():
+                    for i in range(5):
+                        returns.append(x.buufuu(x.hoge * 10 + i))
+                    inside.append(len(history))
+                outside.append(len(history))
+        class shared:
+            def __init__(self):
+                self.hoge = 0
+            def buufuu(self, x):
+                history.append(x)
+                return x
+        shared_object = shared()
+        configure_object = shared()
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object)
+        
+        time.sleep(.5)
+        shared_object.end = 1
+        time.sleep(.1)
+
+        threadS.join()
+        threadC.join()
+        assert inside == [0, 5, 10]
+        assert outside == [5, 10, 15]
+        assert history == [10, 11, 12, 13, 14, 20, 21, 22, 23, 24, 30, 31, 32, 33, 34]
+        assert set(returns) == {None}
+
+    def test__cached_server2client(self, init_instance):
+        history, returns = [], []
+        def update(x):
+            if not hasattr(x, 'stop'):
+                returns.append((x.lookup('a'), x.lookup(key='b'), x.lookup('a')))
+        class shared:
+            def __init__(self):
+                self.values = {'a':1, 'b':2}
+            @snippet_pure
+            def lookup(self, key):
+                history.append(key)
+                return self.values[key]
+        shared_object = shared()
+        configure_object = {"hoge":0}
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object)
+        
+        time.sleep(.5)
+        shared_object.values['a'] = 10
+        time.sleep(.5)
+        shared_object.stop = 1
+        time.sleep(.1) # wait to sync
+        shared_object.end = 1
+        time.sleep(.1)
+
+        threadS.join()
+        threadC.join()
+        assert returns[0] == (1, 2, 1)
+        assert returns[-1] == (10, 2, 10)
+        assert history == ['a', 'b', 'a', 'b'] # valuesの変更で無効になる
+        assert self.server.call_cache.hits == len(returns) * 3 - 4
+        assert self.server.call_cache.misses == 4
+
+    def test__serverside_server2client(self, init_instance):
+        history, returns, served = [], [], []
+        def update(x):
+            if not hasattr(x, 'stop'):
+                x.w += 1
+                returns.append((x.w, x.area(), x.escape()))
+        class shared:
+            def __init__(self):
+                self.w, self.h = 0, 3
+            @snippet_serverside
+            def area(self):
+                return self.w * self.h
+            @snippet_serverside
+            def escape(self):
+                history.append('escape')
+                return __name__
+        class CompileReciever(Reciever):
+            def compile_function(self, source):
+                func = remoteexec.SnippetRunnerLocal().compile_function(source, remoteexec.RunningConditions())
+                def served_func(*args, **kwargs):
+                    served.append(1)
+                    return func(*args, **kwargs)
+                return served_func
+        shared_object = shared()
+        configure_object = {"hoge":0}
+        reciever = CompileReciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object)
+        
+        time.sleep(.5)
+        shared_object.stop = 1
+        time.sleep(.1) # wait to sync
+        shared_object.end = 1
+        time.sleep(.1)
+
+        threadS.join()
+        threadC.join()
+        assert all(area == w * 3 for w, area, _ in returns)
+        assert len(served) == len(returns) # サーバー側で実行
+        assert history.count('escape') == len(returns) # __を含むのでクライアント側で実行
+        assert returns[0][2] == __name__
+
+    def test__content_upload(self, init_instance):
+        known, uploaded = {}, []
+        class ContentReciever(Reciever):
+            def has_content(self, key):
+                return key in known
+            def init_contents(self, contents):
+                uploaded.append(list(contents.keys()))
+                known.update(contents)
+            def init_configure_object(self, configure_object):
+                self.source = known[configure_object['code']]
+        code = 'a = 1\n' * 100
+        key = remoteexec.communicate.communicator.content_hash(code)
+        for _ in range(2):
+            shared_object = {"hoge":0}
+            configure_object = {"code":key}
+            reciever = ContentReciever()
+
+            threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object, contents={key:code})
+
+            time.sleep(.2)
+            shared_object["end"] = 1
+
+            threadS.join()
+            threadC.join()
+            assert reciever.source == code
+        assert uploaded == [[key]] # 2回目はアップロードしない
+
+    def test__content_legacy_host(self, init_instance, monkeypatch):
+        # contentsに対応していない古いホストには内容を含めた設定を送る
+        monkeypatch.setattr(remoteexec.communicate.communicator, 'HOST_CAPABILITIES', ())
+        class ContentReciever(Reciever):
+            def has_content(self, key):
+                raise AssertionError('contents must not be sent to legacy host')
+            def init_configure_object(self, configure_object):
+                self.source = configure_object['code']
+        code = 'a = 1\n' * 100
+        key = remoteexec.communicate.communicator.content_hash(code)
+        shared_object = {"hoge":0}
+        reciever = ContentReciever()
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, {"code":None}, contents={key:code}, legacy_configure_object={"code":code})
+
+        time.sleep(.2)
+        shared_object["end"] = 1
+
+        threadS.join()
+        threadC.join()
+        assert reciever.source == code
+
     def test__exception_errorinserver(self, init_instance):
         def update(x):
             if not hasattr(x, 'stop'):
@@ -503,3 +798,156 @@ class TestComminucator:
         assert error_handled
         assert error_message == "ZeroDivisionError(division by zero)"
         
+
+    def test__sharedlog_server2client(self, init_instance):
+        def update(x):
+            if 'stop' not in x:
+                x['log'].append({'sample':x['log'].sequence})
+        shared_object = {'log':SharedLog(maxlen=10)}
+        configure_object = {"hoge":0}
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(20, reciever, shared_object, configure_object)
+
+        consumed = []
+        for i in range(50):
+            time.sleep(.02)
+            consumed.extend(shared_object['log'].consume())
+        shared_object["stop"] = 1
+        time.sleep(.1) # wait to sync
+        consumed.extend(shared_object['log'].consume())
+        shared_object["end"] = 1
+
+        threadS.join()
+        threadC.join()
+        assert shared_object['log'] == reciever.shared_object['log']
+        assert len(shared_object['log']) == 10
+        assert shared_object['log'].sequence > 10
+        assert [c['sample'] for c in consumed] == list(range(shared_object['log'].sequence))
+
+    def test__sharedtable_client2server(self, init_instance):
+        def update(x):
+            pass
+        shared_object = {'table':SharedTable([('value','d')], rows=[(i * 0.37,) for i in range(10000)])}
+        configure_object = {"hoge":0}
+        reciever = Reciever(update)
+        log = []
+        class Log(CommunicationLog):
+            def log(self, tag, command, dump):
+                if tag == 'recv' and command == 'sync':
+                    log.append(len(dump))
+
+        fpS, fpC = self.make_io()
+        server = Communicator(connection=fpS, sync_frequency=50, use_compress=self.use_compress, log_hook=Log())
+        client = Communicator(connection=fpC, sync_frequency=50, use_compress=self.use_compress)
+        threadS = threading.Thread(target=lambda: server.host(reciever=reciever))
+        threadS.start()
+        threadC = threading.Thread(target=lambda: client.client(shared_object=shared_object, configure_object=configure_object, conflict=ConflictSolvePolicy.HOST_PRIORITIZED, snippet_share_only=False))
+        threadC.start()
+
+        for i in range(20):
+            time.sleep(.02)
+            shared_object['table']['value'][5000 + i] = -1.
+            shared_object['table'].append((float(i),))
+        shared_object["stop"] = 1
+        time.sleep(.1) # wait to sync
+        shared_object["end"] = 1
+
+        threadS.join()
+        threadC.join()
+        assert shared_object['table'] == reciever.shared_object['table']
+        assert len(shared_object['table']) == 10020
+        assert shared_object['table']['value'][5019] == -1.
+        assert len(log) > 5
+        assert max(log) < 10000 # 全体(100KB以上)ではなく変更範囲のみ
+
+    def test__deadband_server2client(self, init_instance):
+        def update(x):
+            if 'stop' not in x:
+                x['value'] += 0.001
+            else:
+                x['end'] = 1
+        shared_object = {'value':0.0}
+        configure_object = {"hoge":0}
+        client_history = []
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object, float_deadband=FloatDeadband(deadband=0.05))
+
+        for i in range(50):
+            time.sleep(.02)
+            client_history.append(shared_object['value'])
+        shared_object["stop"] = 1
+
+        threadS.join()
+        threadC.join()
+        steps = [b - a for a, b in zip(client_history, client_history[1:]) if b != a]
+        assert len(steps) > 0
+        assert all(step >= 0.05 for step in steps)
+        assert shared_object['value'] == reciever.shared_object['value']
+
+    def test__remote_reference_fetch_cache(self, init_instance, monkeypatch):
+        # 取得の度に共有オブジェクト全体を辿らない
+        counts = {'tick':0, 'fetch':0, 'root':0}
+        def update(x):
+            if 'stop' not in x and counts['tick'] < 10:
+                for i in range(counts['tick'] * 10, counts['tick'] * 10 + 10):
+                    x[f'item{i}']['w'][0] += 1 # 周期毎に10回取得する
+                counts['tick'] += 1
+        original_dumps = remoteexec.communicate.communicator.dumps
+        def counting_dumps(obj, *args, **kwargs):
+            if obj is reciever.shared_object and kwargs.get('return_caller', False):
+                counts['root'] += 1
+            return original_dumps(obj, *args, **kwargs)
+        monkeypatch.setattr(remoteexec.communicate.communicator, 'dumps', counting_dumps)
+        original_send = Communicator._send
+        def counting_send(self, send_object):
+            if send_object['cmd'] == 'fetch':
+                counts['fetch'] += 1
+            return original_send(self, send_object)
+        monkeypatch.setattr(Communicator, '_send', counting_send)
+        shared_object = {f'item{i}':{'w':[i]} for i in range(100)}
+        configure_object = {"hoge":0}
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object, remote_reference_depth=1)
+
+        time.sleep(.3)
+        shared_object["stop"] = 1
+        time.sleep(.2)
+        shared_object["end"] = 1
+
+        threadS.join()
+        threadC.join()
+        assert counts['tick'] == 10
+        assert shared_object['item99']['w'][0] == 100
+        assert counts['fetch'] == 100
+        assert counts['root'] <= counts['tick'] # 取得毎ではなく同期周期毎に辿る
+
+    def test__remote_reference(self, init_instance):
+        history = []
+        def update(x):
+            if 'stop' not in x:
+                history.append(type(x['big']['items']).__name__)
+                x['big']['items'][3]['v'] += 1
+        shared_object = {'big':{'items':[{'v':i, 'sub':{'w':[i]}} for i in range(100)]}, 'other':{'x':[1, 2, 3]}}
+        configure_object = {"hoge":0}
+        reciever = Reciever(update)
+
+        threadC, threadS = self.start_communicate(100, reciever, shared_object, configure_object, remote_reference_depth=1)
+
+        time.sleep(.3)
+        shared_object['big']['items'][50]['v'] = -1
+        time.sleep(.3)
+        shared_object["stop"] = 1
+        time.sleep(.2)
+        shared_object["end"] = 1
+
+        threadS.join()
+        threadC.join()
+        assert history[0] == 'RemoteReference'
+        assert shared_object['big']['items'][3]['v'] > 3
+        assert shared_object['big']['items'][3]['v'] == reciever.shared_object['big']['items'][3]['v']
+        assert reciever.shared_object['big']['items'][50]['v'] == -1
+        assert type(reciever.shared_object['other']['x']) is RemoteReference
+        assert reciever.shared_object['other']['x'].__remote_target__ is None
@@ -5,6 +5,10 @@ from typing import List, Dict, Tuple, Union, Callable, Optional
 from textwrap import dedent
 import time
 import threading
+import gc
+import sys
+import os
+import ast
 import remoteexec
 from remoteexec.hooks import *
 from remoteexec.exceptions import *
@@ -175,6 +179,92 @@ class TestRunningConditions:
         assert not thread.is_alive()
         assert round((end_time - start_time)*10) == 5
 
+    def test__timeoutservice_concurrent(self, init_instance):
+        service = SnippetTimeoutService()
+        runner = SnippetRunnerLocal(timeout_service=service)
+        code = dedent("""\
+        while True:
+            time.sleep(0.01)
+        """)
+        results = {}
+        def run_start(index):
+            timeout = 0.3 if index % 2 == 0 else 0.6
+            cond = RunningConditions(allow_import_modules=['time'], total_timeout_sec=timeout)
+            start_time = time.time()
+            try:
+                runner.exec(code if index % 4 != 1 else 'time.sleep(0.01)', cond)
+                results[index] = None
+            except SnippetTotalTimeout:
+                results[index] = round(time.time() - start_time, 1)
+        thread_count = threading.active_count()
+        threads = [threading.Thread(target=run_start, args=(index,)) for index in range(100)]
+        for thread in threads:
+            thread.start()
+        assert threading.active_count() <= thread_count + 100 + 1 # 監視スレッドは1つだけ
+        for thread in threads:
+            thread.join()
+        for index in range(100):
+            if index % 4 == 1:
+                assert results[index] is None # 期限前に終わった実行は中断しない
+            else:
+                assert results[index] == (0.3 if index % 2 == 0 else 0.6)
+        assert len(service) == 0
+
+    def test__timeoutservice_cancelled(self, init_instance):
+        service = SnippetTimeoutService()
+        runner = SnippetRunnerLocal(timeout_service=service)
+        cond = RunningConditions(total_timeout_sec=3600)
+        result = []
+        def run_start():
+            for _ in range(1000):
+                runner.exec('x = 1', cond)
+            result.append(len(service._heap))
+        thread = threading.Thread(target=run_start)
+        thread.start()
+        thread.join()
+        assert result[0] <= 1 # 取り消した期限はヒープに溜まらない
+        assert len(service) == 0
+
+    def test__compile_function(self, init_instance):
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(allow_global_functions=['len'])
+        func = runner.compile_function(dedent("""\
+        def area(self, scale=1):
+            return self.w * self.h * scale + len(self.name)
+        """), cond)
+        class rect:
+            def __init__(self):
+                self.w, self.h, self.name = 2, 3, 'ab'
+        assert func(rect(), scale=2) == 14
+        with pytest.raises(SnippetProhibitionError):
+            runner.compile_function(dedent("""\
+            def escape(self):
+                return __import__('os')
+            """), cond)
+        with pytest.raises(SnippetProhibitionError):
+            runner.compile_function("a = 1", cond)
+        func = runner.compile_function(dedent("""\
+        def count(self):
+            return float(len(self.name))
+        """), cond)
+        with pytest.raises(NameError):
+            func(rect())
+
+    def test__cached_builtins(self, init_instance):
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(allow_global_functions=['len'], allow_import_modules=['math'])
+        SnippetRunnerLocal.warm_up(cond)
+        builtins1 = runner._make_cleaned_builtins(cond)
+        builtins2 = runner._make_cleaned_builtins(cond)
+        assert builtins1 == builtins2 and builtins1 is not builtins2
+        assert builtins1['math'] is builtins2['math']
+        builtins1['len'] = None
+        assert runner._make_cleaned_builtins(cond)['len'] is len
+        shared = {'a':[]}
+        runner.exec("a.append(len('abc'))\nlen = 0", RunningConditions(shared_objects=shared, allow_global_functions=['len'], allow_import_modules=['math']))
+        runner.exec("a.append(len('ab'))", RunningConditions(shared_objects=shared, allow_global_functions=['len'], allow_import_modules=['math']))
+        assert shared['a'] == [3, 2]
+
 
 class TestRunningFeatures:
     @pytest.fixture
@@ -249,6 +339,121 @@ class TestRunningFeatures:
         except SnippetStepError:
             pass
 
+    @pytest.mark.skipif(not hasattr(sys, 'monitoring'), reason='sys.monitoring requires Python 3.12')
+    def test__RunningWithSteppingCheckMonitoring(self, init_instance):
+        share = {'hoge':[]}
+        cond = RunningConditions(shared_objects=share)
+        class MyPrefixHook(StepHook):
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(f"MyPrefixHook - {lineno}")
+        class MyPostfixHook(StepHook):
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(f"MyPostfixHook - {lineno}")
+        class MyErrorHook(StepErrorHook):
+            def hook(self, id:int, lineno:int) -> StepErrorApproach:
+                share['hoge'].append(f"MyErrorHook - {lineno}")
+                return StepErrorApproach.DEFAULT
+        code = dedent("""\
+        for i in range(2):
+            hoge.append(i)
+        def f(x):
+            return 10 // x
+        try:
+            f(0)
+        except:
+            hoge.append('except')
+        hoge.append(f(5))
+        """)
+        results = []
+        for backend in [StepBackend.AST, StepBackend.MONITORING]:
+            share['hoge'] = []
+            feature = RunningWithSteppingCheck(prefix_hook_class=MyPrefixHook, postfix_hook_class=MyPostfixHook, error_hook_class=MyErrorHook, backend=backend)
+            SnippetRunnerLocal().exec(code, cond=cond, features=[feature])
+            results.append(share['hoge'])
+        assert results[0] == results[1]
+        assert results[1][:4] == ['MyPrefixHook - 1', 'MyPrefixHook - 2', 0, 'MyPostfixHook - 2']
+        assert 'MyErrorHook - 4' in results[1] and 'MyErrorHook - 6' in results[1]
+
+    @pytest.mark.skipif(not hasattr(sys, 'monitoring'), reason='sys.monitoring requires Python 3.12')
+    def test__RunningWithSteppingCheckMonitoringJump(self, init_instance):
+        share = {'hoge':[]}
+        cond = RunningConditions(shared_objects=share)
+        class MyPrefixHook(StepHook):
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(('pre', lineno))
+        class MyPostfixHook(StepHook):
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(('post', lineno))
+        code = dedent("""\
+        for i in range(3):
+            if i == 0:
+                continue
+            if i == 2:
+                break
+            hoge.append(i)
+        def f():
+            while True:
+                if True:
+                    break
+        f()
+        """)
+        results = []
+        for backend in [StepBackend.AST, StepBackend.MONITORING]:
+            share['hoge'] = []
+            feature = RunningWithSteppingCheck(prefix_hook_class=MyPrefixHook, postfix_hook_class=MyPostfixHook, backend=backend)
+            SnippetRunnerLocal().exec(code, cond=cond, features=[feature])
+            results.append(share['hoge'])
+        assert results[0] == results[1]
+        # break/continueで抜けた文は実行後のHookを呼ばない
+        assert ('post', 3) not in results[1] and ('post', 5) not in results[1] and ('post', 10) not in results[1]
+        assert ('post', 1) in results[1] and ('post', 8) in results[1]
+
+    @pytest.mark.skipif(not hasattr(sys, 'monitoring'), reason='sys.monitoring requires Python 3.12')
+    def test__RunningWithSteppingCheckMonitoringError(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share)
+        code = dedent("""\
+        try:
+            hoge.append(100 / 0)
+        except:
+            hoge.append('except')
+        hoge.append(100 / 0)
+        """)
+        class MyErrorHook(StepErrorHook):
+            def hook(self, id:int, lineno:int) -> StepErrorApproach:
+                return StepErrorApproach.RAISE_ERROR
+        with pytest.raises(SnippetStepError):
+            runner.exec(code, cond=cond, features=[RunningWithSteppingCheck(error_hook_class=MyErrorHook, backend=StepBackend.MONITORING)])
+        assert share['hoge'] == ['except']
+        # DEFAULTならコードの例外処理はそのまま動く
+        with pytest.raises(ZeroDivisionError):
+            runner.exec(code, cond=cond, features=[RunningWithSteppingCheck(backend=StepBackend.MONITORING)])
+        assert share['hoge'] == ['except', 'except']
+        # 実行後はイベントを止める
+        from remoteexec.runnerfeature import _StepMonitor
+        assert _StepMonitor.monitor_count == 0 and len(_StepMonitor.code_counts) == 0
+
+    @pytest.mark.skipif(not hasattr(sys, 'monitoring'), reason='sys.monitoring requires Python 3.12')
+    @pytest.mark.skipif('REMOTEEXEC_BENCHMARK' not in os.environ, reason='benchmark (set REMOTEEXEC_BENCHMARK to run)')
+    def test__SteppingBackendBenchmark(self, init_instance):
+        code = ''.join(f"a{i} = {i}\nif a{i} > 0:\n    a{i} += 1\n" for i in range(1000))
+        def run(backend):
+            # 変形とコンパイルを含めた1回目の実行
+            start_time = time.perf_counter()
+            feature = RunningWithSteppingCheck(prefix_hook_class=None, postfix_hook_class=None, backend=backend)
+            SnippetRunnerLocal(code_cache=SnippetCodeCache()).exec(code, cond=RunningConditions(), features=[feature])
+            return time.perf_counter() - start_time
+        ast_time = min(run(StepBackend.AST) for _ in range(3))
+        monitoring_time = min(run(StepBackend.MONITORING) for _ in range(3))
+        assert monitoring_time < ast_time # ASTの変形では6倍程度かかった
+
+    @pytest.mark.skipif(hasattr(sys, 'monitoring'), reason='sys.monitoring is available')
+    def test__RunningWithSteppingCheckMonitoringFallback(self, init_instance):
+        with pytest.warns(RuntimeWarning):
+            feature = RunningWithSteppingCheck(backend=StepBackend.MONITORING)
+        assert feature.backend == StepBackend.AST
+
     def test__RunningWithEvalCheck(self, init_instance):
         share = {'hoge':[]}
         runner = SnippetRunnerLocal()
@@ -270,6 +475,36 @@ class TestRunningFeatures:
         runner.exec(code, cond=cond, features=[feature])
         assert share['hoge'] == ['start','StepEvalHook -- lineno=2 name=target value=abcde','fghij','end','StepEvalHook -- lineno=4 name=target value=fghij']
 
+    def test__RunningWithEvalCheckAccessor(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share) # evalは不要
+        class MyStepTargetHook(StepTargetHook):
+            def hook(self, id:int, lineno:int) -> Optional[List[str]]:
+                if lineno == 4:
+                    return ["total", "i", "point.real", "point.nothing", "missing", "len"]
+                return HookSignal.DETACH if lineno == 7 else None
+        class MyStepEvalHook(StepEvalHook):
+            def hook_values(self, id:int, lineno:int, values:Dict[str,Optional[object]]):
+                share['hoge'].append((lineno, values))
+        feature = RunningWithEvalCheck(target_hook_class=MyStepTargetHook,
+                                   eval_hook_class=MyStepEvalHook)
+        code = dedent("""\
+        def calc(point):
+            total = 0
+            for i in range(2):
+                total += i
+            return total
+        calc(complex(3, 4))
+        hoge.append('end')
+        calc(complex(3, 4))
+        """)
+        runner.exec(code, cond=cond, features=[feature])
+        assert share['hoge'] == [
+            (4, {'total':0, 'i':0, 'point.real':3.0, 'point.nothing':None, 'missing':None, 'len':len}),
+            (4, {'total':1, 'i':1, 'point.real':3.0, 'point.nothing':None, 'missing':None, 'len':len}),
+            'end']
+
     def test__RunningWithLoopHook(self, init_instance):
         share = {'hoge':[]}
         runner = SnippetRunnerLocal()
@@ -285,6 +520,282 @@ class TestRunningFeatures:
         runner.exec(code, cond=cond, features=[feature])
         assert share['hoge'] == ['hoge'] * 5
 
+    def test__RunningWithLoopHookCodeCache(self, init_instance, tmp_path):
+        share = {'hoge':[]}
+        cache = SnippetCodeCache(cache_dir=str(tmp_path))
+        runner = SnippetRunnerLocal(code_cache=cache)
+        cond = RunningConditions(shared_objects=share)
+        class MyCounterLoopHook(CounterLoopHook):
+           def __init__(self, loops:List[HookTarget]):
+               super().__init__(loops=loops, maxcount=5)
+        code = dedent("""\
+        for i in range(500):
+            hoge.append('hoge')
+        """)
+        for _ in range(3):
+            feature = RunningWithLoopHook([MyCounterLoopHook], forced_execution_mode=True)
+            runner.exec(code, cond=cond, features=[feature])
+        assert share['hoge'] == ['hoge'] * 15 # Hookは実行毎に新しく作る
+        assert (cache.misses, cache.hits) == (1, 2)
+
+        disk_cache = SnippetCodeCache(cache_dir=str(tmp_path))
+        feature = RunningWithLoopHook([MyCounterLoopHook], forced_execution_mode=True)
+        SnippetRunnerLocal(code_cache=disk_cache).exec(code, cond=cond, features=[feature])
+        assert share['hoge'] == ['hoge'] * 20
+        assert (disk_cache.misses, disk_cache.hits) == (0, 1)
+
+        feature = RunningWithLoopHook([MyCounterLoopHook], forced_execution_mode=False)
+        with pytest.raises(SnippetLoopOvertime):
+            runner.exec(code, cond=cond, features=[feature])
+        assert cache.misses == 2
+
+    def test__RunningWithLoopHookComprehension(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share)
+        targets = []
+        class MyLoopHook(LoopHook):
+            def __init__(self, loops:List[HookTarget]):
+                super().__init__(loops=loops)
+                targets.extend(loops)
+        feature = RunningWithLoopHook([MyLoopHook])
+        runner.exec("hoge.append([[j for j in range(2)] for i in range(2)])", cond=cond, features=[feature])
+        assert share['hoge'] == [[[0, 1], [0, 1]]]
+        assert len(targets) == 2 # 内包表記の中の内包表記もHookする
+
+    def test__TreeHandlerFeature(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share)
+        class CallNameHandler(TreeHandler):
+            node_types = (ast.Call,)
+            def __init__(self):
+                self.names = []
+            def enter(self, node):
+                if type(node.func) is ast.Attribute:
+                    self.names.append(node.func.attr)
+            def result(self):
+                return self.names
+        class CallNameFeature(RunningFeatureBase):
+            def __init__(self):
+                super().__init__()
+                self.rank = 10
+            def tree_key(self):
+                return ()
+            def tree_handler(self):
+                return CallNameHandler()
+            def bind_tree(self, tree_data, ext_objects):
+                share['hoge'].append(tree_data)
+        feature = RunningWithSteppingCheck()
+        for _ in range(2):
+            runner.exec("hoge.append(1)\nhoge.extend([2])", cond=cond, features=[feature, CallNameFeature()])
+        # 挿入したHookの呼び出しは走査しない
+        assert share['hoge'] == [['append', 'extend'], 1, 2, ['append', 'extend'], 1, 2]
+
+    def test__TreeTransformerGcState(self, init_instance):
+        class RaiseHandler(TreeHandler):
+            node_types = (ast.Call,)
+            def enter(self, node):
+                assert not gc.isenabled() # 走査中はGCを止める
+                raise ValueError()
+        root = ast.parse("a = 1\nprint(a)")
+        assert gc.isenabled()
+        TreeTransformer([]).visit(root)
+        assert gc.isenabled()
+        with pytest.raises(ValueError):
+            TreeTransformer([RaiseHandler()]).visit(root)
+        assert gc.isenabled() # 例外時も元に戻す
+        gc.disable()
+        try:
+            TreeTransformer([]).visit(root)
+            assert not gc.isenabled() # 呼び出し元で止めていれば再開しない
+        finally:
+            gc.enable()
+
+    @pytest.mark.skipif('REMOTEEXEC_BENCHMARK' not in os.environ, reason='benchmark (set REMOTEEXEC_BENCHMARK to run)')
+    def test__TransformBenchmark(self, init_instance):
+        lines = []
+        for i in range(1000):
+            lines += [f"a{i} = {i}", "for j in range(2):", "    b = [k for k in range(j)]", "    if b:", f"        a{i} += len(b)"]
+        code = '\n'.join(lines)
+        runner = SnippetRunnerLocal()
+        def run():
+            features = [RunningWithSteppingCheck(), RunningWithEvalCheck(), RunningWithLoopHook(forced_execution_mode=True)]
+            root = runner._parse(code)
+            start_time = time.perf_counter()
+            runner._transform_tree(root, RunningConditions(), features, {})
+            transform_time = time.perf_counter() - start_time
+            compile(root, '', 'exec')
+            return transform_time
+        transform_time = min(run() for _ in range(3))
+        assert transform_time < 1 # 5000行で0.4～0.75秒程度(以前はFeature毎にASTを辿り、文毎にcompileして20秒程度かかった)
+
+    def test__RunningWithOuterFrequencyInlineGuards(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share)
+        code = dedent("""\
+        def run():
+            for i in range(3):
+                for j in range(5):
+                    hoge.append(j)
+        run()
+        """)
+        feature = RunningWithOuterFrequency(throttling_mode=False, max_inner_loop_count=2, forced_execution_mode=True)
+        runner.exec(code, cond=cond, features=[feature])
+        assert share['hoge'] == [0, 1] * 3 # 内側ループの回数は外側ループ毎にリセット
+        feature = RunningWithOuterFrequency(throttling_mode=False, max_inner_loop_count=2)
+        with pytest.raises(SnippetLoopOvertime):
+            runner.exec(code, cond=cond, features=[feature])
+        code = dedent("""\
+        for i in range(2):
+            for j in range(3):
+                time.sleep(0.1)
+        """)
+        feature = RunningWithOuterFrequency(throttling_mode=False, max_loop_timeout=0.05)
+        with pytest.raises(SnippetLoopTimeout):
+            runner.exec(code, cond=cond, features=[feature])
+
+    @pytest.mark.skipif('REMOTEEXEC_BENCHMARK' not in os.environ, reason='benchmark (set REMOTEEXEC_BENCHMARK to run)')
+    def test__RunningWithOuterFrequencyBenchmark(self, init_instance):
+        runner = SnippetRunnerLocal()
+        code = dedent("""\
+        for i in range(20):
+            for j in range(20000):
+                pass
+        """)
+        class MyCounterLoopHook(CounterLoopHook):
+            def __init__(self, loops:List[HookTarget]):
+                super().__init__(loops=loops, maxcount=10**6)
+        class MyTimeoutLoopHook(TimeoutLoopHook):
+            def __init__(self, loops:List[HookTarget]):
+                super().__init__(loops=loops, timeout=60)
+        def run(features):
+            start_time = time.perf_counter()
+            runner.exec(code, cond=RunningConditions(), features=features)
+            return time.perf_counter() - start_time
+        guard_time = min(run([RunningWithOuterFrequency(throttling_mode=False, max_loop_timeout=60, max_inner_loop_count=10**6)]) for _ in range(3))
+        hook_time = min(run([RunningWithLoopHook([MyCounterLoopHook, MyTimeoutLoopHook])]) for _ in range(3))
+        assert guard_time < hook_time # 同じ回数と時間のチェックをHookの呼び出しで行うより速い
+
+    def test__HookSampling(self, init_instance):
+        sample = HookSampling(every=10).sampler()
+        assert [index for index in range(30) if sample()] == [0, 10, 20]
+        sample = HookSampling(probability=0.1, seed=1).sampler()
+        assert 9000 < sum(1 for _ in range(100000) if sample()) < 11000
+        sample = HookSampling(probability=0.).sampler()
+        assert not any(sample() for _ in range(1000))
+        sample = HookSampling(interval=0.05).sampler()
+        count = 0
+        end_time = time.monotonic() + 0.22
+        while time.monotonic() < end_time:
+            count += 1 if sample() else 0
+        assert 4 <= count <= 5
+
+    def test__RunningWithLoopHookSampling(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share)
+        class MyLoopHook(LoopHook):
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(id)
+        feature = RunningWithLoopHook([MyLoopHook], sampling=HookSampling(every=100))
+        runner.exec("for i in range(1000):\n    pass", cond=cond, features=[feature])
+        assert len(share['hoge']) == 10
+        share['hoge'].clear()
+        feature = RunningWithOuterFrequency(throttling_mode=False, max_outer_loop_count=500, forced_execution_mode=True, sampling=HookSampling(every=100))
+        feature.extra_hooks.append(MyLoopHook([]))
+        runner.exec("for i in range(1000):\n    pass", cond=cond, features=[feature])
+        assert len(share['hoge']) == 5 # 回数のチェックは間引かない
+
+    def test__RunningWithLoopHookSamplingClear(self, init_instance):
+        class MyCounterLoopHook(CounterLoopHook):
+            def __init__(self, loops:List[HookTarget]):
+                super().__init__(loops=loops, maxcount=5)
+        code = "for i in range(10):\n    for j in range(6):\n        pass"
+        # 間引いたループの実行でも内側ループの回数はクリアする
+        feature = RunningWithLoopHook([MyCounterLoopHook], sampling=HookSampling(every=2))
+        SnippetRunnerLocal().exec(code, cond=RunningConditions(), features=[feature])
+
+    def test__RunningWithSteppingCheckSamplingPair(self, init_instance):
+        code = dedent("""\
+        def f(n):
+            if n > 0:
+                f(n - 1)
+            hoge.append(n)
+        for i in range(20):
+            try:
+                f(i % 3)
+                hoge.append(10 // (i % 2))
+            except:
+                pass
+        """)
+        def snippet_key(lineno):
+            frame = sys._getframe()
+            while frame.f_code.co_filename != '':
+                frame = frame.f_back
+            return (lineno, frame.f_locals.get('n'), frame.f_locals.get('i') if lineno != 5 else None)
+        backends = [StepBackend.AST] + ([StepBackend.MONITORING] if hasattr(sys, 'monitoring') else [])
+        for backend, every in [(backend, every) for backend in backends for every in (2, 3)]:
+            pending, posts, unpaired = {}, [], []
+            class MyPrefixHook(StepHook):
+                def hook(self, id:int, lineno:int):
+                    key = snippet_key(lineno)
+                    pending[key] = pending.get(key, 0) + 1
+            class MyPostfixHook(StepHook):
+                def hook(self, id:int, lineno:int):
+                    key = snippet_key(lineno)
+                    if pending.get(key, 0) == 0:
+                        unpaired.append(key)
+                    else:
+                        pending[key] -= 1
+                    posts.append(key)
+            feature = RunningWithSteppingCheck(prefix_hook_class=MyPrefixHook, postfix_hook_class=MyPostfixHook,
+                                               sampling=HookSampling(every=every), backend=backend)
+            SnippetRunnerLocal().exec(code, cond=RunningConditions(shared_objects={'hoge':[]}), features=[feature])
+            assert len(posts) > 0
+            assert unpaired == [] # 実行後のHookは同じ文の同じフレームの実行前のHookと対になる
+
+    def test__RunningWithLoopHookDetach(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share)
+        hook_ids = []
+        class MyLoopHook(LoopHook):
+            def hook(self, id:int, lineno:int):
+                hook_ids.append(id)
+                if len(hook_ids) >= 10:
+                    return HookSignal.DETACH
+        feature = RunningWithLoopHook([MyLoopHook])
+        runner.exec("for i in range(1000):\n    pass\nb = [j for j in range(1000)]", cond=cond, features=[feature])
+        assert len(hook_ids) == 10
+        hook_ids.clear()
+        # 外れた後は直接コンパイルした回数のチェックに切り替わる
+        feature = RunningWithOuterFrequency(throttling_mode=False, max_inner_loop_count=500, forced_execution_mode=True)
+        feature.extra_hooks.append(MyLoopHook([]))
+        runner.exec("for i in range(3):\n    for j in range(1000):\n        hoge.append(j)", cond=cond, features=[feature])
+        assert len(hook_ids) == 10
+        assert len(share['hoge']) == 1500
+
+    def test__RunningWithSteppingCheckDetach(self, init_instance):
+        share = {'hoge':[]}
+        cond = RunningConditions(shared_objects=share)
+        class MyPrefixHook(StepHook):
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(f"MyPrefixHook - {lineno}")
+                if len(share['hoge']) >= 5:
+                    return HookSignal.DETACH
+        code = dedent("""\
+        for i in range(100):
+            a = i
+        """)
+        backends = [StepBackend.AST] + ([StepBackend.MONITORING] if hasattr(sys, 'monitoring') else [])
+        for backend in backends:
+            share['hoge'] = []
+            feature = RunningWithSteppingCheck(prefix_hook_class=MyPrefixHook, postfix_hook_class=None, backend=backend)
+            SnippetRunnerLocal().exec(code, cond=cond, features=[feature])
+            assert share['hoge'] == ['MyPrefixHook - 1'] + ['MyPrefixHook - 2'] * 4
+
     def test__RunningWithLoopHookMulti(self, init_instance):
         share = {'hoge':[]}
         runner = SnippetRunnerLocal()
@@ -317,6 +828,37 @@ class TestRunningFeatures:
         assert int(round(time.time() - start_time)) == 10
         assert share['hoge'] == ['hoge'] * 5
 
+    def test__RunningWithOuterFrequencyStats(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunnerLocal()
+        cond = RunningConditions(shared_objects=share)
+        feature = RunningWithOuterFrequency(frequency=200, spin_threshold=0.0)
+        code = dedent("""\
+        for i in range(201):
+            hoge.append(i)
+        """)
+        start_time = time.monotonic()
+        runner.exec(code, cond=cond, features=[feature])
+        # 期限は絶対時刻なので1秒より早くは終わらない(遅れはCPUの混雑に依存するので上限は緩く見る)
+        assert 0.98 < time.monotonic() - start_time < 5
+        assert share['hoge'] == list(range(201))
+        assert len(feature.frequency_stats) == 1
+        stats = list(feature.frequency_stats.values())[0]
+        assert stats.count == 200
+        assert len(stats.histogram) == len(stats.bins) + 1
+        assert sum(stats.histogram) == 200
+        assert 0 <= stats.overruns <= 200
+        assert 0 <= stats.mean_jitter <= stats.max_jitter
+
+        hook = FrequencyLoopHook([HookTarget(1)], frequency=100, spin_threshold=0.0)
+        hook.hook(id=1, lineno=0)
+        time.sleep(0.015)
+        hook.hook(id=1, lineno=0) # 期限に間に合わない
+        hook.hook(id=1, lineno=0)
+        assert hook.stats[1].count == 2
+        assert hook.stats[1].overruns == 1
+        assert hook.stats[1].max_jitter >= 0.005
+
     def test__RunningWithOuterFrequencyNoThrottling(self, init_instance):
         share = {'hoge':[]}
         runner = SnippetRunnerLocal()
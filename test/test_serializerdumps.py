@@ -3,6 +3,7 @@ from typing import List, Dict, Tuple, Union, Callable, Optional
 import types
 import json
 import time
+import gc
 import remoteexec
 from remoteexec.communicate import *
 from remoteexec.communicate.exceptions import *
@@ -406,3 +407,146 @@ class TestSerializerDumps:
         j = json.dumps(d)
         r = caller.function_call(id(c), 'hogehoge', tuple(), {})
         assert r == 'checked'
+
+    def test__fingerprint_dump(self, init_instance):
+        c = {'hoge':[1,2,3],'boo':{'huu':'foo'}}
+        d = dumps(c, snippet_share_only=False, fingerprint=True)
+        assert set(d['fingerprint'].keys()) == {id(c), id(c['hoge']), id(c['boo'])}
+        j = json.dumps(d)
+        e = dumps(c, snippet_share_only=False, fingerprint=True)
+        assert d['fingerprint'] == e['fingerprint']
+        c['boo']['huu'] = 'bar'
+        f = dumps(c, snippet_share_only=False, fingerprint=True)
+        assert f['fingerprint'][id(c['hoge'])] == d['fingerprint'][id(c['hoge'])]
+        assert f['fingerprint'][id(c['boo'])][0] != d['fingerprint'][id(c['boo'])][0]
+        assert f['fingerprint'][id(c)][0] == d['fingerprint'][id(c)][0]
+        assert f['fingerprint'][id(c)][1] != d['fingerprint'][id(c)][1]
+
+    def test__fingerprintcycle_dump(self, init_instance):
+        class node:
+            def __init__(self, value):
+                self.value = value
+                self.next = None
+        c1, c2 = node(1), node(2)
+        c1.next, c2.next = c2, c1
+        d = dumps(c1, snippet_share_only=False, fingerprint=True)
+        assert d['fingerprint'][id(c1)][1] == d['fingerprint'][id(c2)][1]
+        c2.value = 3
+        e = dumps(c1, snippet_share_only=False, fingerprint=True)
+        assert e['fingerprint'][id(c1)][0] == d['fingerprint'][id(c1)][0]
+        assert e['fingerprint'][id(c1)][1] != d['fingerprint'][id(c1)][1]
+
+    def test__struct_dump(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_struct
+        class clz:
+            x: float = 0.
+            n: int = 0
+            flag: bool = False
+            name: str = 'a'
+            def __init__(self):
+                self.x = 1.5
+                self.n = 2
+        c = clz()
+        d = dumps(c)
+        assert d['instance'][id(c)]['__struct__']['names'] == ['x', 'n', 'flag']
+        assert d['instance'][id(c)]['__struct__']['format'] == '<dq?'
+        assert d['instance'][id(c)]['name'] == {'type':'native','value':'a'}
+        assert 'x' not in d['instance'][id(c)]
+        j = json.dumps(d)
+        for value in [1.5, None, 2**70]:
+            c.n = value # パックできない値は個別に同期する
+            d = dumps(c)
+            assert d['instance'][id(c)]['__struct__']['skip'] == ['n']
+            assert d['instance'][id(c)]['n'] == {'type':'native','value':value}
+            assert loads(d).n == value
+
+    def test__buffer_dump(self, init_instance):
+        c = {'b':b'abc', 'ba':bytearray(b'xyz'), 'mv':memoryview(bytearray(16)).cast('i', [2, 2])}
+        d = dumps(c, snippet_share_only=False)
+        j = json.dumps(d)
+        assert d['instance'][id(c['b'])] == {'__type__':'buffer', 'kind':'bytes', 'dtype':'B', 'shape':[3], 'data':'YWJj'}
+        assert d['instance'][id(c['ba'])]['kind'] == 'bytearray'
+        assert d['instance'][id(c['mv'])]['dtype'] == 'i'
+        assert d['instance'][id(c['mv'])]['shape'] == [2, 2]
+        assert d['instance'][id(c)]['values'][0] == {'type':'pointer', 'value':id(c['b'])}
+
+    def test__buffer_block_dump(self, init_instance):
+        c = {'ba':memoryview(bytearray(100))}
+        d = dumps(c, snippet_share_only=False, buffer_block_size=30)
+        assert 'data' not in d['instance'][id(c['ba'])]
+        assert d['instance'][id(c['ba'])]['block_size'] == 30
+        assert len(d['instance'][id(c['ba'])]['blocks']) == 4
+        mark_dirty(c['ba'])
+        d1 = dumps(c, snippet_share_only=False, buffer_block_size=30)
+        c['ba'][0] = 1
+        c['ba'][40] = 1
+        mark_dirty(c['ba'], 40, 41)
+        d2 = dumps(c, snippet_share_only=False, buffer_block_size=30)
+        unmark_dirty(c['ba'])
+        blocks1, blocks2 = d1['instance'][id(c['ba'])]['blocks'], d2['instance'][id(c['ba'])]['blocks']
+        assert blocks2[0] is blocks1[0]
+        assert blocks2[1] != blocks1[1]
+        d3 = dumps(c, snippet_share_only=False, buffer_block_size=30)
+        assert d3['instance'][id(c['ba'])]['blocks'][0] != blocks1[0]
+
+    def test__buffer_dirty_release(self, init_instance):
+        from remoteexec.communicate import serializer
+        with pytest.raises(TypeError):
+            mark_dirty(bytearray(100)) # 弱参照できない
+        mv = memoryview(bytearray(100))
+        mark_dirty(mv)
+        key = id(mv)
+        dumps({'mv':mv}, snippet_share_only=False, buffer_block_size=30)
+        assert key in serializer.__buffer_dirty__
+        del mv
+        gc.collect() # dumpsの循環参照
+        assert key not in serializer.__buffer_dirty__
+
+    def test__remote_reference_dump(self, init_instance):
+        c = {'a':[1, {'x':[2]}], 'b':{3}}
+        d = dumps(c, snippet_share_only=False, remote_reference=lambda instanceid, obj, depth: depth >= 2)
+        j = json.dumps(d)
+        assert d['instance'][id(c['a'][1])] == {'__type__':'remote'}
+        assert id(c['a'][1]['x']) not in d['instance']
+        assert d['instance'][id(c['a'])]['1'] == {'type':'pointer', 'value':id(c['a'][1])}
+        assert d['instance'][id(c['b'])]['__type__'] == 'set'
+
+    def test__oneway_dump(self, init_instance):
+        class clz:
+            def __init__(self):
+                self.x = 1
+            def call(self):
+                return 1
+            @snippet_oneway
+            def send(self, message):
+                pass
+        c = clz()
+        d = dumps(c, snippet_share_only=False)
+        assert d['instance'][id(c)]['call'] == {'type':'function'}
+        assert d['instance'][id(c)]['send'] == {'type':'function', 'oneway':True}
+        j = json.dumps(d)
+
+    def test__cacheable_dump(self, init_instance):
+        class clz:
+            @snippet_pure
+            def pure(self, x):
+                return x
+            @snippet_cacheable(ttl=0.5)
+            def cacheable(self):
+                return 1
+        c = clz()
+        d = dumps(c, snippet_share_only=False)
+        assert d['instance'][id(c)]['pure'] == {'type':'function', 'cache':True}
+        assert d['instance'][id(c)]['cacheable'] == {'type':'function', 'cache':True, 'ttl':0.5}
+
+    def test__serverside_dump(self, init_instance):
+        class clz:
+            def __init__(self):
+                self.w = 2
+            @snippet_serverside
+            def double(self, scale=1):
+                return self.w * 2 * scale
+        c = clz()
+        d = dumps(c, snippet_share_only=False)
+        assert d['instance'][id(c)]['double'] == {'type':'function', 'source':'def double(self, scale=1):\n    return self.w * 2 * scale'}
+        j = json.dumps(d)
@@ -5,6 +5,7 @@ import json
 import time
 import remoteexec
 from remoteexec.communicate import *
+from remoteexec.communicate.exceptions import *
 from remoteexec.communicate.serializer import loads, dumps
 
 
@@ -432,3 +433,91 @@ class TestSerializerLoads:
         e = loads(d, function_hook=hook)
         r = e.hogehoge()
         assert r == 'checked'
+
+    def test__sharedlog_load(self, init_instance):
+        c = {'log':SharedLog(maxlen=3, entries=[1,2,{'A':3},'4'])}
+        d = dumps(c, snippet_share_only=False)
+        j = json.loads(json.dumps(d))
+        assert d['instance'][id(c['log'])]['sequence'] == 4
+        assert d['instance'][id(c['log'])]['base'] == 1
+        e = loads(d)
+        assert isinstance(e['log'], SharedLog)
+        assert e['log'].sequence == 4
+        assert list(e['log']) == [2,{'A':3},'4']
+        d = dumps(c, snippet_share_only=False, log_since={id(c['log']):3})
+        assert d['instance'][id(c['log'])]['base'] == 3
+        assert d['instance'][id(c['log'])]['entries'] == [{'type':'native','value':'4'}]
+
+    def test__struct_load(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_struct
+        class clz:
+            x: float = 0.
+            n: int = 0
+            def __init__(self):
+                self.x = 1.5
+                self.n = 2
+                self.child = {'A':1}
+        c = clz()
+        d = dumps(c)
+        e = loads(d)
+        assert e.x == 1.5
+        assert e.n == 2
+        assert e.child == {'A':1}
+        assert dumps(e, snippet_share_only=False, restore_id_map={id(e):id(c), id(e.child):id(c.child)}) == d
+
+    def test__sharedtable_load(self, init_instance):
+        c = {'table':SharedTable([('step','q'),('value','d')], rows=[(0, .5), {'step':1, 'value':1.5}])}
+        d = dumps(c, snippet_share_only=False)
+        j = json.dumps(d)
+        assert d['instance'][id(c['table'])]['columns'] == [['step','q'],['value','d']]
+        assert d['instance'][id(c['table'])]['length'] == 2
+        e = loads(d)
+        assert isinstance(e['table'], SharedTable)
+        assert e['table'] == c['table']
+        assert list(e['table']['value']) == [.5, 1.5]
+        assert e['table'][1] == {'step':1, 'value':1.5}
+
+    def test__buffer_load(self, init_instance):
+        ba = bytearray(b'xyz')
+        c = {'b':b'abc', 'ba':ba, 'l':[ba], 'mv':memoryview(bytearray(range(16))).cast('i', [2, 2])}
+        d = dumps(c, snippet_share_only=False)
+        j = json.dumps(d)
+        e, id_map = loads(d, return_id_map=True)
+        assert e['b'] == b'abc'
+        assert type(e['ba']) is bytearray and e['ba'] == ba
+        assert e['l'][0] is e['ba']
+        assert e['mv'].format == 'i' and e['mv'].tolist() == c['mv'].tolist()
+        assert id_map[id(e['ba'])] == id(ba)
+
+    def test__remote_reference_load(self, init_instance):
+        c = {'a':[1, {'x':[2]}], 'b':[3]}
+        d, caller = dumps(c, snippet_share_only=False, return_caller=True, remote_reference=lambda instanceid, obj, depth: depth >= 2)
+        fetched = []
+        class FetchHook(UnsirializeFunctionHook):
+            def fetch(self, instanceids):
+                fetched.append(instanceids)
+                return {instanceid:loads(dumps(caller.out_instance[instanceid].obj, snippet_share_only=False)) for instanceid in instanceids}
+        e, id_map = loads(d, function_hook=FetchHook(), return_id_map=True)
+        assert type(e['a'][1]) is RemoteReference
+        assert id_map[id(e['a'][1])] == id(c['a'][1])
+        assert fetched == []
+        assert e['a'][1]['x'] == [2]
+        assert len(e['a'][1]) == 1
+        assert fetched == [[id(c['a'][1])]]
+        assert resolve_remote(e['a'][1]) == {'x':[2]}
+        f = loads(d, known_instance={id(c['a'][1]):c['a'][1]})
+        assert f['a'][1] is c['a'][1]
+        g = loads(d)
+        with pytest.raises(RemoteReferenceError):
+            g['a'][1]['x']
+
+    def test__ndarray_load(self, init_instance):
+        numpy = pytest.importorskip('numpy')
+        c = {'a':numpy.arange(12, dtype=numpy.float32).reshape(3, 4).T}
+        d = dumps(c, snippet_share_only=False)
+        assert d['instance'][id(c['a'])]['shape'] == [4, 3]
+        j = json.dumps(d)
+        e = loads(d)
+        assert e['a'].dtype == numpy.float32
+        assert (e['a'] == c['a']).all()
+        e['a'][0, 0] = 1.
@@ -221,6 +221,29 @@ class TestRunningHooks:
         runner.exec(code, cond=cond, step_prefix_hook=MyPrefixHook(), step_postfix_hook=MyPostfixHook())
         assert share['hoge'] == ['MyPrefixHook - 1', 'MyPrefixHook - 2', 1, 'MyPostfixHook - 2', 'MyPrefixHook - 2', 1, 'MyPostfixHook - 2', 'MyPrefixHook - 2', 1, 'MyPostfixHook - 2', 'MyPostfixHook - 1']
 
+    def test__RunningWithSteppingCheckSampling(self, init_instance):
+        share = {'hoge':[]}
+        runner = SnippetRunner(local_run=True)
+        cond = RunningConditions(shared_objects=share)
+        class MyPrefixHook(StepHook):
+            def __init__(self):
+                super().__init__([])
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(f"MyPrefixHook - {lineno}")
+        class MyPostfixHook(StepHook):
+            def __init__(self):
+                super().__init__([])
+            def hook(self, id:int, lineno:int):
+                share['hoge'].append(f"MyPostfixHook - {lineno}")
+        code = dedent("""\
+        for i in range(9):
+            hoge.append(1)
+        """)
+        runner.exec(code, cond=cond, step_prefix_hook=MyPrefixHook(), step_postfix_hook=MyPostfixHook(), hook_sampling=HookSampling(every=3))
+        assert share['hoge'] == ['MyPrefixHook - 1'] + \
+                                [1, 1, 'MyPrefixHook - 2', 1, 'MyPostfixHook - 2'] * 3 + \
+                                ['MyPostfixHook - 1']
+
     def test__RunningWithIgnoreError(self, init_instance):
         share = {'hoge':[]}
         runner = SnippetRunner(local_run=True)
@@ -3,6 +3,8 @@ from typing import List, Dict, Tuple, Union, Callable, Optional
 import types
 import json
 import time
+import base64
+import struct
 import remoteexec
 from remoteexec.communicate import *
 from remoteexec.communicate.serializer import loads, dumps
@@ -547,4 +549,424 @@ class TestMarge:
         assert m.deleted_instance[0].value == {'__type__': 'object'}
 
 
+class TestFingerprintDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__unchanged_diff(self, init_instance):
+        c = {'hoge':[1,2,3],'boo':{'huu':'foo'}}
+        d1 = dumps(c, snippet_share_only=False, fingerprint=True)
+        d2 = dumps(c, snippet_share_only=False, fingerprint=True)
+        assert unchanged(d1, d2)
+        assert root_fingerprint(d1) == [id(c), d1['fingerprint'][id(c)][1]]
+        e = diff(d1, d2)
+        assert e.updated_member == []
+        assert e.created_member == []
+        assert e.deleted_member == []
+        assert e.created_instance == []
+        assert e.deleted_instance == []
+
+    def test__deepupdate_diff(self, init_instance):
+        c = {'hoge':[1,2,3],'boo':{'huu':{'foo':'bar'}}}
+        d1 = dumps(c, snippet_share_only=False, fingerprint=True)
+        c['boo']['huu']['foo'] = 'baz'
+        d2 = dumps(c, snippet_share_only=False, fingerprint=True)
+        assert not unchanged(d1, d2)
+        e = diff(d1, d2)
+        assert len(e.updated_member) == 1
+        assert e.updated_member[0].instance_id == id(c['boo']['huu'])
+        assert e.updated_member[0].member_name == {'type': 'native', 'value': 'foo'}
+        assert e.updated_member[0].value == {'type': 'native', 'value': 'baz'}
+        assert e.created_member == []
+        assert e.deleted_member == []
+        assert e.created_instance == []
+        assert e.deleted_instance == []
+
+    def test__instance_diff(self, init_instance):
+        c = {'hoge':[1,2,3],'boo':{'huu':'foo'}}
+        d1 = dumps(c, snippet_share_only=False, fingerprint=True)
+        old = c['boo']
+        c['boo'] = {'bar':'baz'}
+        d2 = dumps(c, snippet_share_only=False, fingerprint=True)
+        e = diff(d1, d2)
+        f = diff({'object':d1['object'],'instance':d1['instance']}, {'object':d2['object'],'instance':d2['instance']})
+        assert [str(m) for m in e.updated_member] == [str(m) for m in f.updated_member]
+        assert [m.instance_id for m in e.created_instance] == [id(c['boo'])]
+        assert [m.instance_id for m in e.deleted_instance] == [id(old)]
+
+    def test__fingerprint_marge(self, init_instance):
+        c = {'hoge':{'A':0},'boo':{'B':0}}
+        d1 = dumps(c, snippet_share_only=False, fingerprint=True)
+        c['hoge']['A'] = 1
+        d2 = dumps(c, snippet_share_only=False, fingerprint=True)
+        c['hoge']['A'] = 0
+        c['boo']['B'] = 1
+        d3 = dumps(c, snippet_share_only=False, fingerprint=True)
+        m = marge(diff(d1, d2), diff(d1, d3))
+        assert len(m.updated_member) == 2
+        assert {m.instance_id for m in m.updated_member} == {id(c['hoge']), id(c['boo'])}
+
+
+class TestSequenceDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__insert_sequencediff(self, init_instance):
+        c = list(range(10000))
+        d1 = dumps(c, snippet_share_only=False)
+        c.insert(0, -1)
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.updated_member == []
+        assert e.created_member == []
+        assert e.deleted_member == []
+        assert len(e.patched_member) == 1
+        assert e.patched_member[0].instance_id == id(c)
+        assert e.patched_member[0].member_name is None
+        assert e.patched_member[0].patch_type == 'sequence'
+        assert e.patched_member[0].value == [['insert', 0, [{'type': 'native', 'value': -1}]]]
+
+    def test__delete_sequencediff(self, init_instance):
+        c = [1,2,3,4,5]
+        d1 = dumps(c, snippet_share_only=False)
+        del c[1:3]
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.deleted_member == []
+        assert e.patched_member[0].value == [['delete', 1, 2]]
+
+    def test__move_sequencediff(self, init_instance):
+        c = [1,2,3,4]
+        d1 = dumps(c, snippet_share_only=False)
+        c.append(c.pop(0))
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.patched_member[0].value == [['move', 0, 3]]
+
+    def test__update_sequencediff(self, init_instance):
+        c = [1,2,3,4]
+        d1 = dumps(c, snippet_share_only=False)
+        c[2] = 'three'
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.patched_member[0].value == [['update', 2, [{'type': 'native', 'value': 'three'}]]]
+
+    def test__serialize_sequencediff(self, init_instance):
+        c = [1,2,3,4]
+        d1 = dumps(c, snippet_share_only=False)
+        c.insert(2, 'x')
+        d2 = dumps(c, snippet_share_only=False)
+        e = SyncSharedObject.unserialized(diff(d1, d2).serialize())
+        assert len(e.patched_member) == 1
+        assert e.patched_member[0].value == [['insert', 2, [{'type': 'native', 'value': 'x'}]]]
+
+    def test__sequence_marge(self, init_instance):
+        c = {'hoge':[1,2,3],'boo':[4,5,6]}
+        d1 = dumps(c, snippet_share_only=False)
+        c['hoge'].append(4)
+        d2 = dumps(c, snippet_share_only=False)
+        c['hoge'].pop()
+        c['hoge'].insert(0, 0)
+        c['boo'].pop(0)
+        d3 = dumps(c, snippet_share_only=False)
+        m = marge(diff(d1, d2), diff(d1, d3))
+        assert len(m.patched_member) == 2
+        assert m.patched_member[0].instance_id == id(c['hoge'])
+        assert m.patched_member[0].value == [['insert', 3, [{'type': 'native', 'value': 4}]]]
+        assert m.patched_member[1].instance_id == id(c['boo'])
+
+
+class TestSharedLogDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__append_logdiff(self, init_instance):
+        c = {'log':SharedLog(maxlen=100, entries=list(range(100)))}
+        d1 = dumps(c, snippet_share_only=False)
+        c['log'].append(100)
+        c['log'].append(101)
+        d2 = dumps(c, snippet_share_only=False, log_since={id(c['log']):100})
+        assert len(d2['instance'][id(c['log'])]['entries']) == 2
+        e = diff(d1, d2)
+        assert e.updated_member == []
+        assert e.created_member == []
+        assert e.deleted_member == []
+        assert len(e.patched_member) == 1
+        assert e.patched_member[0].patch_type == 'log'
+        assert e.patched_member[0].value == {'sequence':100,
+                                             'entries':[{'type':'native','value':100},{'type':'native','value':101}],
+                                             'truncate':False,
+                                             'known':100}
+
+    def test__diverge_logdiff(self, init_instance):
+        c = {'log':SharedLog(entries=[1,2,3])}
+        d1 = dumps(c, snippet_share_only=False)
+        c['log'].append(4)
+        d2 = dumps(c, snippet_share_only=False)
+        c['log']._truncate(3)
+        c['log'].append(5)
+        d3 = dumps(c, snippet_share_only=False)
+        e = diff(d2, d3)
+        assert e.patched_member[0].value == {'sequence':3,
+                                             'entries':[{'type':'native','value':5}],
+                                             'truncate':True,
+                                             'known':4}
+        e = diff(d1, d1)
+        assert e.patched_member == []
+
+class TestTextDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__append_textdiff(self, init_instance):
+        c = {'text':'a'*10000}
+        d1 = dumps(c, snippet_share_only=False)
+        c['text'] += 'bcd'
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.updated_member == []
+        assert len(e.patched_member) == 1
+        assert e.patched_member[0].patch_type == 'text'
+        assert e.patched_member[0].member_name == {'type':'native','value':'text'}
+        assert len(e.patched_member[0].value.pop('digest')) == 16 # 作成元のハッシュ
+        assert e.patched_member[0].value == {'length':10000, 'ops':[['append','bcd']]}
+
+    def test__truncate_splice_textdiff(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_share
+        class clz:
+            def __init__(self):
+                self.text = 'abc'*5000
+        c = clz()
+        d1 = dumps(c)
+        c.text = 'abc'*4000
+        d2 = dumps(c)
+        e = diff(d1, d2)
+        assert e.patched_member[0].member_name == 'text'
+        assert e.patched_member[0].value.pop('digest') is not None
+        assert e.patched_member[0].value == {'length':15000, 'ops':[['truncate',12000]]}
+        c.text = 'abc'*2000 + 'XYZ' + 'abc'*1999
+        d3 = dumps(c)
+        e = diff(d2, d3)
+        assert e.patched_member[0].value.pop('digest') is not None
+        assert e.patched_member[0].value == {'length':12000, 'ops':[['splice',6000,3,'XYZ']]}
+
+    def test__short_textdiff(self, init_instance):
+        c = {'text':'a'*100}
+        d1 = dumps(c, snippet_share_only=False)
+        c['text'] += 'b'
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.patched_member == []
+        assert e.updated_member[0].value == {'type':'native','value':'a'*100+'b'}
+        e = diff(d1, d2, text_delta_threshold=10)
+        assert e.updated_member == []
+        assert e.patched_member[0].value.pop('digest') is not None
+        assert e.patched_member[0].value == {'length':100, 'ops':[['append','b']]}
 
+class TestFloatDeadband:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__deadband(self, init_instance):
+        c = {'x':1.0, 'y':1.0, 'n':'a'}
+        d1 = dumps(c, snippet_share_only=False)
+        c['x'], c['y'], c['n'] = 1.01, 1.2, 'b'
+        d2 = dumps(c, snippet_share_only=False)
+        e, synced = deadband(diff(d1, d2), d1, FloatDeadband(deadband=0.1))
+        assert [m.member_name['value'] for m in e.updated_member] == ['y', 'n']
+        assert [(m.member_name['value'], m.value['value']) for m in synced] == [('x', 1.0)]
+        update_serial(d2, synced)
+        assert d2['instance'][id(c)]['values'][0] == {'type':'native','value':1.0}
+
+    def test__quantize_path_deadband(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_share
+        class clz:
+            def __init__(self):
+                self.x = 0.0
+                self.y = 0.0
+        c = {'robot':clz(), 'z':0.0}
+        d1 = dumps(c, snippet_share_only=False, fingerprint=True)
+        c['robot'].x, c['robot'].y, c['z'] = 0.26, 0.01, 0.01
+        d2 = dumps(c, snippet_share_only=False, fingerprint=True)
+        e, synced = deadband(diff(d1, d2), d1, FloatDeadband(paths={'robot':(0., 0.5), 'robot.y':(0.001, 0.)}))
+        assert sorted([(m.member_name if type(m.member_name) is str else m.member_name['value'], m.value['value']) for m in e.updated_member]) ==\
+               [('x', 0.5), ('y', 0.01), ('z', 0.01)]
+        assert [(m.member_name, m.value['value']) for m in synced] == [('x', 0.5)]
+        update_serial(d2, synced)
+        c['robot'].x = 0.5
+        assert d2['fingerprint'] == dumps(c, snippet_share_only=False, fingerprint=True)['fingerprint']
+
+class TestStructDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__struct_diff(self, init_instance):
+        @remoteexec.communicate.serializer.snippet_struct
+        class clz:
+            a: float = 0.
+            b: int = 0
+            c: bool = False
+            name: str = 'a'
+        c = clz()
+        d1 = dumps(c)
+        c.b = 3
+        c.name = 'b'
+        d2 = dumps(c)
+        e = diff(d1, d2)
+        assert [m.member_name for m in e.updated_member] == ['name']
+        assert len(e.patched_member) == 1
+        assert e.patched_member[0].member_name == '__struct__'
+        assert e.patched_member[0].patch_type == 'struct'
+        assert e.patched_member[0].value == {'changed':base64.b64encode(bytes([0b010])).decode('utf-8'),
+                                             'data':base64.b64encode(struct.pack('<q', 3)).decode('utf-8')}
+        e = diff(d2, d2)
+        assert e.patched_member == []
+
+class TestTableDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__table_diff(self, init_instance):
+        c = {'table':SharedTable([('step','q'),('value','d')], rows=[(i, 0.) for i in range(1000)])}
+        d1 = dumps(c, snippet_share_only=False)
+        c['table'].append((1000, 1.))
+        c['table']['value'][500] = 2.
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.updated_member == []
+        assert len(e.patched_member) == 1
+        assert e.patched_member[0].patch_type == 'table'
+        value = e.patched_member[0].value
+        assert value['known'] == 1000
+        assert value['length'] == 1001
+        assert [r[0] for r in value['columns']['step']] == [1000]
+        assert [r[0] for r in value['columns']['value']] == [448, 1000]
+        assert value['columns']['value'][0][:2] == [448, 448 + TABLE_BLOCK_ROWS]
+        assert len(base64.b64decode(value['columns']['value'][0][2])) == TABLE_BLOCK_ROWS * 8
+        e = diff(d2, d2)
+        assert e.patched_member == []
+
+    def test__table_since_diff(self, init_instance):
+        c = {'table':SharedTable([('step','q'),('value','d')], rows=[(i, 0.) for i in range(1000)])}
+        table_since = {}
+        d1 = dumps(c, snippet_share_only=False, fingerprint=True, table_since=table_since)
+        assert 'data' in d1['instance'][id(c['table'])]
+        snapshot = table_since[id(c['table'])][1]
+        d2 = dumps(c, snippet_share_only=False, fingerprint=True, table_since=table_since)
+        assert d2['instance'][id(c['table'])]['ranges'] == {}
+        assert table_since[id(c['table'])][1] is snapshot # 変更が無ければ複製しない
+        assert d2['fingerprint'] == d1['fingerprint'] # 変更範囲のみでもフィンガープリントは同じ
+        c['table'].append((1000, 1.))
+        c['table']['value'][500] = 2.
+        length = c['table']._length
+        assert len(c['table']) == 1001 and c['table']._length == length # __len__は状態を変えない
+        d3 = dumps(c, snippet_share_only=False, fingerprint=True, table_since=table_since)
+        value = d3['instance'][id(c['table'])]
+        assert 'data' not in value and value['since'] == 1000
+        assert [r[:2] for r in value['ranges']['step']] == [[1000, 1001]]
+        assert [r[:2] for r in value['ranges']['value']] == [[448, 448 + TABLE_BLOCK_ROWS], [1000, 1001]]
+        full = dumps(c, snippet_share_only=False, fingerprint=True)
+        assert d3['fingerprint'] == full['fingerprint']
+        assert expand_tables(d3, d1) == []
+        assert d3 == full
+        assert diff(d1, d3).patched_member[0].value == diff(d1, full).patched_member[0].value
+        # 基準の行数が合意した状態と異なれば、合意した状態に置き換えて全体を送り直してもらう
+        c['table']['value'][0] = 3.
+        d4 = dumps(c, snippet_share_only=False, fingerprint=True, table_since=table_since)
+        assert expand_tables(d4, d1) == [id(c['table'])]
+        assert d4['instance'][id(c['table'])] == d1['instance'][id(c['table'])]
+        assert diff(d1, d4).patched_member == []
+
+    def test__table_marge(self, init_instance):
+        c = {'table':SharedTable([('value','d')], rows=[(0.,) for i in range(200)])}
+        d1 = dumps(c, snippet_share_only=False)
+        c['table'].append((1.,))
+        d2 = dumps(c, snippet_share_only=False)
+        c['table']._resize(200)
+        c['table']['value'][0] = 2.
+        c['table']['value'][199] = 3.
+        d3 = dumps(c, snippet_share_only=False)
+        e = marge(diff(d1, d2), diff(d1, d3))
+        assert len(e.patched_member) == 2
+        assert e.patched_member[0].value['length'] == 201
+        assert e.patched_member[1].value == {'columns':diff(d1, d3).patched_member[0].value['columns']}
+        assert [r[:2] for r in e.patched_member[1].value['columns']['value']] == [[0, TABLE_BLOCK_ROWS], [192, 200]]
+
+class TestBufferDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__buffer_diff(self, init_instance):
+        c = {'ba':bytearray(1000), 'b':b'abc'}
+        d1 = dumps(c, snippet_share_only=False)
+        c['ba'][10] = 1
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.updated_member == []
+        assert len(e.patched_member) == 1
+        assert e.patched_member[0].patch_type == 'buffer'
+        assert e.patched_member[0].instance_id == id(c['ba'])
+        assert base64.b64decode(e.patched_member[0].value['data'])[10] == 1
+        c['b'] = b'abcd'
+        d3 = dumps(c, snippet_share_only=False)
+        e = diff(d2, d3)
+        assert e.patched_member == []
+        assert len(e.created_instance) == 1
+        assert len(e.updated_member) == 1
+
+    def test__buffer_block_diff(self, init_instance):
+        c = {'ba':bytearray(1000)}
+        d1 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        c['ba'][10] = 1
+        c['ba'][950] = 2
+        d2 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        e = diff(d1, d2)
+        assert len(e.patched_member) == 1
+        value = e.patched_member[0].value
+        assert 'blocks' not in value
+        assert [index for index, _ in value['changed']] == [0, 3]
+        assert len(base64.b64decode(value['changed'][1][1])) == 100
+        c['ba'].append(0)
+        d3 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        assert 'changed' not in diff(d2, d3).patched_member[0].value
+
+    def test__buffer_block_marge(self, init_instance):
+        c = {'ba':bytearray(1000)}
+        d1 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        c['ba'][10] = 1
+        d2 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        c['ba'][10] = 0
+        c['ba'][20] = 2
+        c['ba'][500] = 3
+        d3 = dumps(c, snippet_share_only=False, buffer_block_size=300)
+        e = marge(diff(d1, d2), diff(d1, d3))
+        assert len(e.patched_member) == 2
+        assert [index for index, _ in e.patched_member[0].value['changed']] == [0]
+        assert [index for index, _ in e.patched_member[1].value['changed']] == [1]
+
+class TestRemoteReferenceDiff:
+    @pytest.fixture
+    def init_instance(self):
+        pass
+
+    def test__remote_reference_diff(self, init_instance):
+        c = {'a':{'x':1}}
+        d1 = dumps(c, snippet_share_only=False, remote_reference=lambda instanceid, obj, depth: depth >= 1)
+        d2 = dumps(c, snippet_share_only=False)
+        e = diff(d1, d2)
+        assert e.deleted_member == [] and e.created_member == [] and e.updated_member == []
+        e = diff(d2, d1)
+        assert e.deleted_member == [] and e.created_member == [] and e.updated_member == []
+        c['a'] = {'x':2}
+        d3 = dumps(c, snippet_share_only=False, remote_reference=lambda instanceid, obj, depth: depth >= 1)
+        e = diff(d1, d3)
+        assert len(e.updated_member) == 1
+        assert e.created_instance[0].value == {'__type__':'remote'}